@@ -4,6 +4,7 @@
 OpenClaw Token CLI 工具 v3.1
 """
 
+import csv
 import json
 import os
 import sys
@@ -12,10 +13,13 @@ from pathlib import Path
 from datetime import datetime
 from collections import deque
 
+from OpenClawTokenCore import BackupStore, SessionStatsCache, iter_lines_reversed, token_counter
+
 OPENCLAW_DIR = Path.home() / ".openclaw"
 SESSIONS_DIR = OPENCLAW_DIR / "agents" / "main" / "sessions"
 SESSIONS_JSON = SESSIONS_DIR / "sessions.json"
 BACKUP_DIR = SESSIONS_DIR / "backups"
+STATS_CACHE_PATH = OPENCLAW_DIR / "session_stats_cache.json"
 
 class Colors:
     HEADER = '\033[95m'
@@ -27,126 +31,250 @@ class Colors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'
 
+# 机器可读输出的字段（csv 的列顺序）
+SESSION_FIELDS = ['key', 'session_id', 'model', 'total_tokens']
+STATS_FIELDS = ['key', 'session_id', 'model_provider', 'model', 'total_tokens', 'context_tokens',
+                'lines', 'messages', 'user', 'assistant', 'other', 'estimated_tokens', 'size']
+HISTORY_FIELDS = ['index', 'id', 'timestamp', 'role', 'text']
+
+def write_records(records, fmt, fields, out=None):
+    """把记录流写出为 json（数组）/ ndjson（每行一条）/ csv，逐条写出不先构建列表"""
+    out = out or sys.stdout
+    if fmt == 'ndjson':
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    elif fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+    else:
+        out.write("[")
+        for i, record in enumerate(records):
+            out.write(",\n" if i else "\n")
+            out.write(json.dumps(record, ensure_ascii=False))
+        out.write("\n]\n")
+    out.flush()
+
+def print_error(message, fmt='text'):
+    """输出错误（机器可读格式时写到 stderr，不混入数据）"""
+    if fmt == 'text':
+        print(f"{Colors.RED}错误: {message}{Colors.ENDC}")
+    else:
+        print(f"错误: {message}", file=sys.stderr)
+
 class TokenCLI:
-    def __init__(self):
+    def __init__(self, config_path=None):
         self.current_session_id = None
         self.current_jsonl_path = None
         self.initial_line_count = 0
+        self.config_path = config_path
+        self.config = None
+        # 估算 token 使用与查看器/后台服务相同的分词后端（统计缓存按后端分开保存）
+        token_counter.set_backend(self.load_config().token_counter_backend)
+        self.stats_cache = SessionStatsCache(STATS_CACHE_PATH)
         BACKUP_DIR.mkdir(exist_ok=True)
+    
+    def load_config(self):
+        """读取与查看器相同的配置文件（备份压缩方式、保留策略等），只读取一次"""
+        if self.config is None:
+            from OpenClawTokenEngine import CONFIG_PATH, load_config
+            self.config = load_config(path=self.config_path or CONFIG_PATH)
+        return self.config
         
-    def list_sessions(self):
+    def load_sessions_data(self):
+        """读取 sessions.json（不存在时返回空字典）"""
+        if not SESSIONS_JSON.exists():
+            return {}
+        with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def resolve_session(self, sid):
+        """按会话ID（或前缀/片段）查找完整ID，返回 (sid, jsonl_path)"""
+        jsonl_path = SESSIONS_DIR / f"{sid}.jsonl"
+        if not jsonl_path.exists():
+            try:
+                for key, value in self.load_sessions_data().items():
+                    full_sid = value.get('sessionId', '')
+                    if full_sid.startswith(sid) or sid in full_sid:
+                        sid = full_sid
+                        jsonl_path = SESSIONS_DIR / f"{sid}.jsonl"
+                        break
+            except:
+                pass
+        return sid, jsonl_path
+    
+    def iter_sessions(self):
+        """逐个产出 agent: 会话的概要记录"""
+        for key, value in self.load_sessions_data().items():
+            if key.startswith("agent:"):
+                yield {
+                    'key': key,
+                    'session_id': value.get('sessionId', 'unknown'),
+                    'model': value.get('model', 'unknown'),
+                    'total_tokens': value.get('totalTokens', 0),
+                }
+    
+    def iter_session_stats(self, session_id=None, agent_only=False):
+        """逐个产出会话详情 + 文件统计（统计在线程池中并发计算，按顺序产出）
+        
+        session_id 为 None 时产出全部会话，否则只产出第一个匹配的会话。
+        """
+        matched = []
+        for key, value in self.load_sessions_data().items():
+            if agent_only and not key.startswith("agent:"):
+                continue
+            sid = value.get('sessionId', '')
+            if not session_id or sid.startswith(session_id) or session_id in sid:
+                matched.append((key, value))
+                if session_id:
+                    break
+        
+        # 各会话文件的统计按 (路径, 大小, 修改时间) 缓存
+        paths = [SESSIONS_DIR / f"{value.get('sessionId', '')}.jsonl" for key, value in matched]
+        try:
+            for (key, value), stat in zip(matched, self.stats_cache.iter_many(paths)):
+                stat = stat or {'lines': 0, 'messages': 0, 'roles': {}, 'tokens': 0, 'size': 0}
+                roles = stat['roles']
+                yield {
+                    'key': key,
+                    'session_id': value.get('sessionId', ''),
+                    'model_provider': value.get('modelProvider'),
+                    'model': value.get('model'),
+                    'total_tokens': value.get('totalTokens', 0),
+                    'context_tokens': value.get('contextTokens', 262144),
+                    'lines': stat['lines'],
+                    'messages': stat['messages'],
+                    'user': roles.get('user', 0),
+                    'assistant': roles.get('assistant', 0),
+                    'other': stat['messages'] - roles.get('user', 0) - roles.get('assistant', 0),
+                    'estimated_tokens': stat['tokens'],
+                    'size': stat['size'],
+                }
+        finally:
+            self.stats_cache.save()
+    
+    def iter_history(self, jsonl_path, count=10, filter_role=None):
+        """产出最近 count 条消息（按时间顺序）
+        
+        从文件末尾向前按块读取，凑够 count 条即停止（不读入整个文件）。
+        """
+        messages = []
+        for line in iter_lines_reversed(jsonl_path):
+            try:
+                data = json.loads(line.decode('utf-8', errors='ignore').strip())
+                if data.get('type') == 'message':
+                    msg = data.get('message', {})
+                    role = msg.get('role', 'unknown')
+                    if filter_role and role != filter_role:
+                        continue
+                        
+                    content = msg.get('content', [])
+                    text = ""
+                    if content and isinstance(content, list):
+                        for item in content:
+                            if isinstance(item, dict) and item.get('type') == 'text':
+                                text = item.get('text', '')
+                                break
+                    
+                    messages.append({'id': data.get('id', ''), 'timestamp': data.get('timestamp', ''),
+                                     'role': role, 'text': text})
+                    if len(messages) >= count:
+                        break
+            except:
+                pass
+        for i, msg in enumerate(reversed(messages), 1):
+            yield dict(index=i, **msg)
+    
+    def list_sessions(self, fmt='text'):
         """列出所有会话"""
+        if fmt != 'text':
+            return write_records(self.iter_sessions(), fmt, SESSION_FIELDS)
+        
         print(f"{Colors.BOLD}可用会话列表:{Colors.ENDC}")
         print("-" * 60)
         
         try:
-            if SESSIONS_JSON.exists():
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                for key, value in data.items():
-                    if key.startswith("agent:"):
-                        session_id = value.get('sessionId', 'unknown')[:20]
-                        model = value.get('model', 'unknown')
-                        total = value.get('totalTokens', 0)
-                        print(f"{Colors.CYAN}{session_id}...{Colors.ENDC} | {model} | {total} tokens")
+            for session in self.iter_sessions():
+                print(f"{Colors.CYAN}{session['session_id'][:20]}...{Colors.ENDC} | "
+                      f"{session['model']} | {session['total_tokens']} tokens")
         except Exception as e:
             print(f"{Colors.RED}错误: {e}{Colors.ENDC}")
             
-    def show_session(self, session_id=None):
+    def show_session(self, session_id=None, fmt='text'):
         """显示会话详情"""
+        if fmt != 'text':
+            return write_records(self.iter_session_stats(session_id), fmt, STATS_FIELDS)
+        
         try:
-            if SESSIONS_JSON.exists():
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                for key, value in data.items():
-                    sid = value.get('sessionId', '')
-                    if not session_id or sid.startswith(session_id) or session_id in sid:
-                        print(f"{Colors.BOLD}会话:{Colors.ENDC} {value.get('sessionId')}")
-                        print(f"模型: {value.get('modelProvider')}/{value.get('model')}")
-                        
-                        total = value.get('totalTokens', 0)
-                        context = value.get('contextTokens', 262144)
-                        color = Colors.GREEN if total < 30000 else (Colors.YELLOW if total < 60000 else Colors.RED)
-                        print(f"Token: {color}{total:,}{Colors.ENDC} / {context:,} ({(total/context)*100:.1f}%)")
-                        
-                        jsonl_path = SESSIONS_DIR / f"{sid}.jsonl"
-                        if jsonl_path.exists():
-                            lines = sum(1 for _ in open(jsonl_path, 'r', encoding='utf-8', errors='ignore'))
-                            print(f"行数: {lines}")
-                        print()
-                        
-                        if session_id:
-                            self.current_session_id = sid
-                            self.current_jsonl_path = jsonl_path
-                            break
+            for info in self.iter_session_stats(session_id):
+                print(f"{Colors.BOLD}会话:{Colors.ENDC} {info['session_id']}")
+                print(f"模型: {info['model_provider']}/{info['model']}")
+                
+                total = info['total_tokens']
+                context = info['context_tokens']
+                color = Colors.GREEN if total < 30000 else (Colors.YELLOW if total < 60000 else Colors.RED)
+                print(f"Token: {color}{total:,}{Colors.ENDC} / {context:,} ({(total/context)*100:.1f}%)")
+                
+                if info['size'] or info['lines']:
+                    print(f"行数: {info['lines']}")
+                    print(f"消息: {info['messages']} (user {info['user']} / "
+                          f"assistant {info['assistant']})  拟合Token: {info['estimated_tokens']:,}")
+                print()
+                
+                if session_id:
+                    self.current_session_id = info['session_id']
+                    self.current_jsonl_path = SESSIONS_DIR / f"{info['session_id']}.jsonl"
         except Exception as e:
             print(f"{Colors.RED}错误: {e}{Colors.ENDC}")
             
-    def show_history(self, session_id=None, count=10, filter_role=None):
+    def show_history(self, session_id=None, count=10, filter_role=None, fmt='text'):
         """显示历史记录"""
         sid = session_id or self.current_session_id
         if not sid:
-            print(f"{Colors.RED}错误: 请指定会话ID{Colors.ENDC}")
+            print_error("请指定会话ID", fmt)
             return
             
         # 查找完整ID
-        jsonl_path = SESSIONS_DIR / f"{sid}.jsonl"
-        if not jsonl_path.exists():
-            try:
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key, value in data.items():
-                        full_sid = value.get('sessionId', '')
-                        if full_sid.startswith(sid) or sid in full_sid:
-                            sid = full_sid
-                            jsonl_path = SESSIONS_DIR / f"{sid}.jsonl"
-                            break
-            except:
-                pass
+        sid, jsonl_path = self.resolve_session(sid)
                 
         if not jsonl_path.exists():
-            print(f"{Colors.RED}错误: 文件不存在{Colors.ENDC}")
+            print_error("文件不存在", fmt)
             return
+        
+        if fmt != 'text':
+            return write_records(self.iter_history(jsonl_path, count, filter_role), fmt, HISTORY_FIELDS)
             
         print(f"{Colors.BOLD}最近 {count} 条消息:{Colors.ENDC}")
         print("-" * 60)
         
         try:
-            with open(jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                lines = f.readlines()
-                
-            messages = []
-            for line in reversed(lines):
-                try:
-                    data = json.loads(line.strip())
-                    if data.get('type') == 'message':
-                        msg = data.get('message', {})
-                        role = msg.get('role', 'unknown')
-                        if filter_role and role != filter_role:
-                            continue
-                            
-                        content = msg.get('content', [])
-                        text = ""
-                        if content and isinstance(content, list):
-                            for item in content:
-                                if isinstance(item, dict) and item.get('type') == 'text':
-                                    text = item.get('text', '')
-                                    break
-                        
-                        messages.append({'role': role, 'text': text[:100]})
-                        if len(messages) >= count:
-                            break
-                except:
-                    pass
-                    
-            for i, msg in enumerate(reversed(messages), 1):
+            for msg in self.iter_history(jsonl_path, count, filter_role):
                 color = Colors.GREEN if msg['role'] == 'user' else (Colors.BLUE if msg['role'] == 'assistant' else Colors.YELLOW)
-                print(f"{i}. {color}[{msg['role']}]{Colors.ENDC} {msg['text']}...")
+                print(f"{msg['index']}. {color}[{msg['role']}]{Colors.ENDC} {msg['text'][:100]}...")
                 
         except Exception as e:
             print(f"{Colors.RED}错误: {e}{Colors.ENDC}")
+    
+    def show_stats(self, session_id=None, all_sessions=False, fmt='text'):
+        """会话统计：--all 时遍历所有 agent: 会话，每个会话一条记录"""
+        if not session_id and not all_sessions:
+            print_error("请指定会话ID或使用 --all", fmt)
+            return
+        records = self.iter_session_stats(None if all_sessions else session_id,
+                                          agent_only=all_sessions)
+        if fmt != 'text':
+            return write_records(records, fmt, STATS_FIELDS)
+        
+        print(f"{Colors.BOLD}{'会话':<22}{'行数':>8}{'消息':>8}{'拟合Token':>12}{'官方Token':>12}{Colors.ENDC}")
+        print("-" * 66)
+        try:
+            for info in records:
+                print(f"{Colors.CYAN}{info['session_id'][:20]:<22}{Colors.ENDC}"
+                      f"{info['lines']:>8}{info['messages']:>8}"
+                      f"{info['estimated_tokens']:>12,}{info['total_tokens']:>12,}")
+        except Exception as e:
+            print(f"{Colors.RED}错误: {e}{Colors.ENDC}")
             
     def backup_file(self, session_id=None):
         """备份文件"""
@@ -161,32 +289,47 @@ class TokenCLI:
             return
             
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{sid}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(jsonl_path, backup_path)
-            print(f"{Colors.GREEN}已备份到: {backup_path}{Colors.ENDC}")
+            # 与界面共用去重备份仓库（只保存变化的分块），压缩方式和保留策略取自配置
+            config = self.load_config()
+            store = BackupStore(BACKUP_DIR, config.backup_compression)
+            name = store.snapshot(jsonl_path, sid, "命令行备份")
+            store.prune(config.backup_keep, config.backup_max_age_days, sid)
+            print(f"{Colors.GREEN}已备份到: {BACKUP_DIR / 'snapshots' / name}.json{Colors.ENDC}")
         except Exception as e:
             print(f"{Colors.RED}错误: {e}{Colors.ENDC}")
 
 def main():
     parser = argparse.ArgumentParser(description='OpenClaw Token CLI v3.1')
-    parser.add_argument('command', choices=['list', 'show', 'history', 'backup'])
+    parser.add_argument('command', choices=['list', 'show', 'history', 'stats', 'backup', 'daemon'])
     parser.add_argument('-s', '--session', help='会话ID')
     parser.add_argument('-n', '--count', type=int, default=10)
     parser.add_argument('--filter', choices=['user', 'assistant', 'toolResult'])
+    parser.add_argument('--format', choices=['text', 'json', 'ndjson', 'csv'], default='text',
+                        help='输出格式（json/ndjson/csv 便于脚本处理）')
+    parser.add_argument('--all', action='store_true', help='stats: 统计所有 agent 会话；daemon: 自动压缩所有 agent 会话')
+    parser.add_argument('--config', help='配置文件路径（默认与查看器相同；分词后端、备份设置和后台服务使用）')
     
     args = parser.parse_args()
-    cli = TokenCLI()
+    cli = TokenCLI(Path(args.config) if args.config else None)
     
-    if args.command == 'list':
-        cli.list_sessions()
-    elif args.command == 'show':
-        cli.show_session(args.session)
-    elif args.command == 'history':
-        cli.show_history(args.session, args.count, args.filter)
-    elif args.command == 'backup':
-        cli.backup_file(args.session)
+    try:
+        if args.command == 'list':
+            cli.list_sessions(args.format)
+        elif args.command == 'show':
+            cli.show_session(args.session, args.format)
+        elif args.command == 'history':
+            cli.show_history(args.session, args.count, args.filter, args.format)
+        elif args.command == 'stats':
+            cli.show_stats(args.session, args.all, args.format)
+        elif args.command == 'backup':
+            cli.backup_file(args.session)
+        elif args.command == 'daemon':
+            # 无界面后台服务：自动刷新、自动压缩、文件监控（按配置文件运行，Ctrl+C 停止）
+            from OpenClawTokenEngine import CONFIG_PATH, run_daemon
+            run_daemon(args.session, cli.config_path or CONFIG_PATH, args.all)
+    except BrokenPipeError:
+        # 输出被提前关闭（如管道到 head），静默退出
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,2343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenClaw Token 核心模块
+与界面无关的公共逻辑：会话文件增量读取/追加、会话解析模型等
+"""
+
+import bisect
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import copy
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+# 记忆 ID 常量
+COMPACT_ID = "baizhi01"     # compact标记（前文截止符）
+CHARACTER_ID = "baizhi00"   # 人设/初始化记忆（不变）
+LONG_TERM_ID = "baizhi52"   # 长期记忆
+MID_TERM_ID = "baizhi20"    # 中期记忆
+MODE_MESSAGE_ID = "baizhi21"  # 模式消息（长期/中期/短期/吐槽）
+SHORT_TERM_PREFIX = "白芷"   # 短期记忆前缀
+SHORT_TERM_COUNT = 19       # 白芷01 到 白芷19
+COMPACT_SUMMARY = "AI总结占位"  # compact标记的 summary 字段值
+
+# 记忆类型显示标签
+MEMORY_TYPE_LABELS = {
+    CHARACTER_ID: "【人设】",
+    LONG_TERM_ID: "【长期】",
+    MID_TERM_ID: "【中期】",
+}
+
+
+class FileTailer:
+    """按字节偏移增量读取文本文件（tail -f 方式）
+
+    记录上次读取到的字节偏移、inode、大小和修改时间：
+    - 文件未变化：只做一次 stat，不读取内容
+    - 文件只追加：只读取并解码新增的字节
+    - 文件被截断、替换或原地重写：回退为全量重新读取
+
+    只返回以换行符结尾的完整行，尚未写完的最后一行留到下次读取。
+    """
+
+    # 偏移前用于校验"原地重写"的字节数
+    SIGNATURE_SIZE = 64
+
+    def __init__(self, path=None):
+        self.reset(path)
+
+    def reset(self, path=None):
+        """重置读取状态（下次 poll 将全量读取）"""
+        if path is not None:
+            self.path = Path(path)
+        elif not hasattr(self, 'path'):
+            self.path = None
+        self.offset = 0          # 已消费的字节数（只含完整行）
+        self.inode = None
+        self.size = -1
+        self.mtime_ns = 0
+        self.signature = b''     # offset 之前的最后若干字节
+
+    def poll(self):
+        """检查文件变化
+
+        返回: (mode, lines)
+            mode: None（无变化）/ 'append'（只追加）/ 'reload'（需全量替换）
+            lines: 新读取的完整行（保留换行符）
+        """
+        if not self.path:
+            return None, []
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # 文件消失：之前有内容则通知清空
+            if self.inode is not None:
+                self.reset()
+                return 'reload', []
+            return None, []
+
+        if (st.st_ino == self.inode and st.st_size == self.size
+                and st.st_mtime_ns == self.mtime_ns):
+            return None, []
+
+        with open(self.path, 'rb') as f:
+            if self._is_continuation(f, st):
+                mode = 'append'
+                f.seek(self.offset)
+            else:
+                mode = 'reload'
+                f.seek(0)
+                self.offset = 0
+                self.signature = b''
+            data = f.read()
+
+        end = data.rfind(b'\n') + 1
+        complete = data[:end]
+
+        self.inode = st.st_ino
+        self.size = self.offset + len(data)
+        self.mtime_ns = st.st_mtime_ns
+        self.offset += end
+        if complete:
+            self.signature = (self.signature + complete[-self.SIGNATURE_SIZE:])[-self.SIGNATURE_SIZE:]
+
+        if mode == 'append' and not complete:
+            return None, []
+        return mode, split_lines(complete)
+
+    def _is_continuation(self, f, st):
+        """判断文件是否只是在上次读取的基础上追加"""
+        if self.inode is None or st.st_ino != self.inode:
+            return False
+        if st.st_size < self.offset:
+            return False
+        if self.signature:
+            f.seek(self.offset - len(self.signature))
+            if f.read(len(self.signature)) != self.signature:
+                return False
+        return True
+
+
+def split_lines(data):
+    """将字节数据解码并按 \\n 分行（与文本模式 readlines 一致，保留换行符）"""
+    if not data:
+        return []
+    text = data.decode('utf-8', errors='ignore')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    tail = lines.pop()
+    result = [line + '\n' for line in lines]
+    if tail:
+        result.append(tail)
+    return result
+
+
+def iter_lines_reversed(path, block_size=64 * 1024):
+    """从文件末尾向前按块读取，逆序逐行返回（bytes，不含换行符）
+
+    每次只读取 block_size 字节，取到足够的行后停止迭代即可不再读取，
+    耗时和内存只与读取的行数有关，与文件大小无关。
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''  # 上一块开头不完整的行
+        first = True
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + tail
+            lines = block.split(b'\n')
+            # 第一行可能只是一行的后半部分，留到读入前一块后再拼接
+            tail = lines.pop(0)
+            if first:
+                first = False
+                if lines and lines[-1] == b'':
+                    lines.pop()  # 文件末尾的换行
+            for line in reversed(lines):
+                yield line.rstrip(b'\r')
+        if not first:
+            yield tail.rstrip(b'\r')
+
+
+def append_lines(path, lines, fsync=False):
+    """以 O_APPEND 方式追加若干行（只写入新增字节，不读取/改写已有内容）
+
+    一次 write 完成追加；若文件末尾缺少换行则先补一个，避免和上一行粘连。
+    fsync=True 时写入后强制落盘。返回写入的字节数。
+    """
+    data = ''.join(lines).encode('utf-8')
+    if not data:
+        return 0
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fd = os.open(str(path), flags, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size > 0:
+            with open(path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        if fsync:
+            os.fsync(fd)
+        return written
+    finally:
+        os.close(fd)
+
+
+class ConcurrentRewriteError(Exception):
+    """改写期间文件被其他程序截断或替换（不是单纯追加），无法安全合并"""
+
+
+def atomic_rewrite(path, lines, base_size=None, fsync=True, max_attempts=5):
+    """原子改写文件：写入同目录临时文件 + fsync + os.replace
+
+    lines: 行列表、字符串或 bytes
+
+    不加锁，采用乐观并发：base_size 为生成 lines 时已读取的字节数，
+    提交前若原文件已增长（OpenClaw 同时在追加），把 base_size 之后新增的字节
+    接到新内容末尾再提交；提交前再次确认大小未变，否则继续合并（最多 max_attempts 次）。
+    替换后再检查一次旧文件，把确认与替换之间追加到旧文件的字节补追加到新文件。
+    base_size 为 None 时不合并，直接覆盖。
+
+    任一步失败时原文件保持不变（崩溃也不会留下写了一半的会话文件）。
+    返回合并进来的新增字节数。
+    """
+    path = Path(path)
+    if isinstance(lines, bytes):
+        data = lines
+    else:
+        data = (lines if isinstance(lines, str) else ''.join(lines)).encode('utf-8')
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    src = None
+    merged = 0
+    try:
+        if base_size is not None:
+            try:
+                src = open(path, 'rb')
+            except OSError:
+                base_size = None
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            ends_with_newline = not data or data.endswith(b'\n')
+            for attempt in range(max_attempts):
+                if src is not None:
+                    size = os.fstat(src.fileno()).st_size
+                    if size < base_size:
+                        raise ConcurrentRewriteError("会话文件已被其他程序改写，请刷新后重试")
+                    if size > base_size:
+                        src.seek(base_size)
+                        extra = src.read(size - base_size)
+                        if not ends_with_newline:
+                            f.write(b'\n')
+                            ends_with_newline = True
+                        f.write(extra)
+                        merged += len(extra)
+                        base_size += len(extra)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+                # 合并后文件没有再增长才提交
+                if src is None or os.fstat(src.fileno()).st_size == base_size:
+                    break
+            else:
+                raise ConcurrentRewriteError("会话文件持续写入中，改写失败，请稍后重试")
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except OSError:
+            pass
+        if src is not None and os.name == 'nt':
+            # Windows 不能替换仍被打开的文件
+            src.close()
+            src = None
+        os.replace(tmp_path, path)
+    except BaseException:
+        if src is not None:
+            src.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if src is not None:
+        # 确认大小之后、替换之前追加到旧文件的内容
+        with src:
+            src.seek(base_size)
+            extra = src.read()
+        if extra:
+            append_lines(path, [extra.decode('utf-8', errors='ignore')], fsync)
+            merged += len(extra)
+    if fsync:
+        # 目录项落盘（Windows 不支持打开目录，忽略）
+        try:
+            dir_fd = os.open(str(path.parent), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+    if merged:
+        print(f"[原子写入] 合并了改写期间新追加的 {merged} 字节: {path.name}")
+    return merged
+
+
+def parse_session_line(index, line):
+    """解析会话文件的一行，返回记录字典（每行只 JSON 解码一次）
+
+    message 类型的记录额外包含 role、timestamp、text（第一段文本）、
+    texts（全部文本）、attachments、memory_type 和 is_compact。
+    """
+    record = {
+        'index': index,
+        'line_num': index + 1,
+        'line': line,
+        'data': None,
+        'type': '',
+        'id': '',
+        'role': '',
+        'timestamp': '',
+        'text': '',
+        'texts': [],
+        'attachments': [],
+        'memory_type': '',
+        'is_compact': False,
+    }
+    try:
+        data = json.loads(line.strip())
+    except ValueError:
+        return record
+    if not isinstance(data, dict):
+        return record
+
+    msg_id = data.get('id', '')
+    record['data'] = data
+    record['type'] = data.get('type', '')
+    record['id'] = msg_id if isinstance(msg_id, str) else ''
+    if record['type'] != 'message':
+        return record
+
+    msg = data.get('message', {})
+    if not isinstance(msg, dict):
+        msg = {}
+    record['role'] = msg.get('role', 'unknown')
+    record['timestamp'] = data.get('timestamp', '') or ''
+
+    texts = record['texts']
+    attachments = record['attachments']
+    content = msg.get('content', [])
+    if content and isinstance(content, list):
+        for item in content:
+            if isinstance(item, dict):
+                if item.get('type') == 'text':
+                    texts.append(item.get('text', '') or '')
+                elif item.get('type') == 'image':
+                    attachments.append('[图片]')
+                elif item.get('type') == 'file':
+                    attachments.append("[文件]")
+    if texts:
+        record['text'] = texts[0]
+
+    # 标记记忆类型
+    msg_id = record['id']
+    if msg_id in MEMORY_TYPE_LABELS:
+        record['memory_type'] = MEMORY_TYPE_LABELS[msg_id]
+    elif msg_id.startswith(SHORT_TERM_PREFIX):
+        record['memory_type'] = "【短期】"
+    else:
+        record['memory_type'] = "普通"
+
+    # compact 标记：summary 字段，或文本中的占位标识（兼容旧版本）
+    if data.get('summary') == COMPACT_SUMMARY:
+        record['is_compact'] = True
+    else:
+        for text in texts:
+            if f'summary: {COMPACT_SUMMARY}' in text or '===COMPACT===' in text:
+                record['is_compact'] = True
+                break
+    return record
+
+
+class Tokenizer:
+    """分词后端接口：子类实现 count()，可按需重写 count_batch()"""
+
+    name = ''
+
+    def count(self, text):
+        raise NotImplementedError
+
+    def count_batch(self, texts):
+        return [self.count(text) for text in texts]
+
+
+class ApproxTokenizer(Tokenizer):
+    """离线近似分词（无需下载词表）
+
+    按 BPE 分词器的典型切分规律估算：
+    - 中日韩字符：约 0.7 token/字
+    - 字母单词：约 4 字符/token，至少 1 个
+    - 数字：约 3 位/token
+    - 标点符号：1 token/个；空白不计
+    """
+
+    name = 'approx'
+
+    CJK_RATIO = 0.7
+    PATTERN = re.compile(
+        r'(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)'
+        r'|(?P<word>[^\W\d_]+)'
+        r'|(?P<digit>\d+)'
+        r'|(?P<symbol>\S)'
+    )
+
+    def count(self, text):
+        if not text:
+            return 0
+        total = 0.0
+        for match in self.PATTERN.finditer(text):
+            kind = match.lastgroup
+            length = match.end() - match.start()
+            if kind == 'cjk':
+                total += length * self.CJK_RATIO
+            elif kind == 'word':
+                total += (length + 3) // 4
+            elif kind == 'digit':
+                total += (length + 2) // 3
+            else:
+                total += 1
+        return int(math.ceil(total))
+
+
+class TiktokenTokenizer(Tokenizer):
+    """tiktoken 分词（可选依赖，未安装时不可用）"""
+
+    name = 'tiktoken'
+    ENCODING = 'o200k_base'
+
+    def __init__(self):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(self.ENCODING)
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=())) if text else 0
+
+    def count_batch(self, texts):
+        return [len(tokens) for tokens in self.encoding.encode_batch(list(texts), disallowed_special=())]
+
+
+# 可用的分词后端（可通过 register_tokenizer 扩展）
+TOKENIZER_BACKENDS = {
+    ApproxTokenizer.name: ApproxTokenizer,
+    TiktokenTokenizer.name: TiktokenTokenizer,
+}
+
+
+def register_tokenizer(name, factory):
+    """注册分词后端，factory 无参调用后返回 Tokenizer 实例"""
+    TOKENIZER_BACKENDS[name] = factory
+
+
+class TokenCounter:
+    """Token 计数引擎 - 可插拔分词后端 + 按文本哈希缓存 + 批量计数
+
+    相同文本只计算一次；批量计数时未命中缓存的文本一次性交给后端。
+    后端不可用（如未安装 tiktoken）时退回离线近似分词。
+    """
+
+    MESSAGE_OVERHEAD = 4   # 每条消息的格式开销（角色、分隔符）
+    CACHE_SIZE = 50000
+
+    def __init__(self, backend=ApproxTokenizer.name):
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.set_backend(backend)
+
+    def set_backend(self, name):
+        """切换分词后端（清空缓存），返回实际使用的后端名"""
+        try:
+            tokenizer = TOKENIZER_BACKENDS[name]()
+        except Exception as e:
+            if name != ApproxTokenizer.name:
+                print(f"[Token计数] 后端 {name} 不可用，使用近似分词: {e}")
+            tokenizer = ApproxTokenizer()
+        with self.lock:
+            self.tokenizer = tokenizer
+            self.cache.clear()
+        return tokenizer.name
+
+    @staticmethod
+    def _key(text):
+        return hashlib.md5(text.encode('utf-8', errors='ignore')).digest()
+
+    def count(self, text):
+        """单段文本的 token 数"""
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts):
+        """批量计数，返回与 texts 顺序一致的列表"""
+        keys = [self._key(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    results[i] = self.cache[key]
+                else:
+                    missing.setdefault(key, []).append(i)
+            tokenizer = self.tokenizer
+
+        if missing:
+            order = list(missing)
+            counts = tokenizer.count_batch([texts[missing[key][0]] for key in order])
+            with self.lock:
+                for key, count in zip(order, counts):
+                    for i in missing[key]:
+                        results[i] = count
+                    self.cache[key] = count
+                while len(self.cache) > self.CACHE_SIZE:
+                    self.cache.popitem(last=False)
+        return results
+
+    def count_records(self, records):
+        """批量计算会话记录的 token 数，写入各记录的 'tokens' 字段"""
+        texts = []
+        for record in records:
+            texts.extend(record['texts'])
+        counts = iter(self.count_batch(texts))
+        for record in records:
+            tokens = sum(next(counts) for _ in record['texts'])
+            if record['type'] == 'message':
+                tokens += self.MESSAGE_OVERHEAD
+            record['tokens'] = tokens
+
+
+# 全局共享的 token 计数器
+token_counter = TokenCounter()
+
+
+class ParsedSession:
+    """会话解析模型 - 文件变化时构建一次，所有读取方共享
+
+    records 与文件行一一对应；messages 只包含 type == 'message' 的记录。
+    追加时只解析新增行；被改写时复用内容未变的行，只解析真正新增的行。
+
+    同时维护记忆结构索引（随追加/改写更新，查询无需再扫描文件）：
+    - memory_index: 人设/长期/中期记忆 ID -> 最后一条记录
+    - compact_index: 第一个 compact 标记的行位置（无则 -1）
+    - first_user_index: 第一条 user 消息的行位置（无则 -1）
+    - last_message_id: 最后一条 message 的 id
+
+    每行的 token 数（TokenCounter 计数）缓存在记录的 'tokens' 字段，
+    estimated_tokens 为累计和：追加时只累加新行，改写时复用未变行的缓存值。
+    """
+
+    MEMORY_IDS = (CHARACTER_ID, LONG_TERM_ID, MID_TERM_ID)
+
+    def __init__(self, lines=None, counter=None):
+        self.counter = counter or token_counter
+        self.records = []
+        self.load(lines or [])
+
+    def load(self, lines):
+        """全量构建（文件被截断/替换后调用），内容未变的行直接复用解析结果"""
+        previous = {record['line']: record for record in self.records}
+        self.records = []
+        self.messages = []
+        self.short_terms = []
+        self.message_positions = []
+        self.id_positions = {}
+        self.role_counts = {}
+        self.memory_index = {}
+        self.compact_index = -1
+        self.first_user_index = -1
+        self.last_message_id = None
+        self.estimated_tokens = 0
+
+        records = []
+        new_records = []
+        for index, line in enumerate(lines):
+            cached = previous.get(line)
+            if cached is None:
+                record = parse_session_line(index, line)
+                new_records.append(record)
+            else:
+                record = dict(cached)
+                record['index'] = index
+                record['line_num'] = index + 1
+            records.append(record)
+        self.counter.count_records(new_records)
+        for record in records:
+            self._add(record)
+
+    def append(self, lines):
+        """增量追加新行（新行的 token 数批量计算）"""
+        start = len(self.records)
+        records = [parse_session_line(start + i, line) for i, line in enumerate(lines)]
+        self.counter.count_records(records)
+        for record in records:
+            self._add(record)
+
+    def _add(self, record):
+        """追加一条记录并更新索引"""
+        index = record['index']
+        self.records.append(record)
+        self.estimated_tokens += record['tokens']
+        if record['id']:
+            self.id_positions[record['id']] = index
+        if record['type'] != 'message':
+            return
+
+        self.messages.append(record)
+        self.message_positions.append(index)
+        self.last_message_id = record['data'].get('id')
+        role = record['role']
+        self.role_counts[role] = self.role_counts.get(role, 0) + 1
+
+        if record['id'] in self.MEMORY_IDS:
+            self.memory_index[record['id']] = record
+        else:
+            self.short_terms.append(record)
+        if record['is_compact'] and self.compact_index == -1:
+            self.compact_index = index
+        if role == 'user' and self.first_user_index == -1:
+            self.first_user_index = index
+
+    def sync(self, mode, lines):
+        """应用 FileTailer.poll() 的结果"""
+        if mode == 'append':
+            self.append(lines)
+        elif mode == 'reload':
+            self.load(lines)
+
+    def dialog_message_count(self):
+        """对话条数（role 为 user 或 assistant 的 message）"""
+        return self.role_counts.get('user', 0) + self.role_counts.get('assistant', 0)
+
+    def position_of(self, msg_id):
+        """id 对应的最后一行位置（没有则返回 -1）"""
+        return self.id_positions.get(msg_id, -1)
+
+    def last_message_id_before(self, index):
+        """位置 index 之前最后一条 message 的 id（没有则返回 None）"""
+        i = bisect.bisect_left(self.message_positions, index)
+        if i == 0:
+            return None
+        return self.records[self.message_positions[i - 1]]['data'].get('id')
+
+    def memory_structure(self):
+        """记忆结构：人设/长期/中期各取最后一条，其余 message 均视为短期记忆"""
+        return {
+            'character': self.memory_index.get(CHARACTER_ID),
+            'long_term': self.memory_index.get(LONG_TERM_ID),
+            'mid_term': self.memory_index.get(MID_TERM_ID),
+            'short_terms': self.short_terms
+        }
+
+
+class SessionsRegistry:
+    """sessions.json 缓存读取 - 只在文件 mtime 或大小变化时重新解析
+
+    by_session_id: sessionId -> 会话条目（避免反复遍历 data.items()）
+    key_by_session_id: sessionId -> sessions.json 中的键（如 agent:main:main）
+    version: 每次重新加载后递增，调用方可据此判断是否有变化
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.signature = None
+        self.version = 0
+        self.data = {}
+        self.by_session_id = {}
+        self.key_by_session_id = {}
+
+    def refresh(self):
+        """文件有变化时重新加载，返回是否发生了变化"""
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            signature = None
+
+        with self.lock:
+            if signature == self.signature:
+                return False
+            data = {}
+            if signature is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    # 文件可能正在被写入，保留旧数据，下次再试
+                    return False
+                if not isinstance(data, dict):
+                    data = {}
+            self._index(data)
+            self.signature = signature
+            return True
+
+    def _index(self, data):
+        self.version += 1
+        self.data = data
+        self.by_session_id = {}
+        self.key_by_session_id = {}
+        for key, value in data.items():
+            if not isinstance(value, dict):
+                continue
+            session_id = value.get('sessionId')
+            # agent: 开头的条目优先
+            if session_id and (session_id not in self.by_session_id or key.startswith("agent:")):
+                self.by_session_id[session_id] = value
+                self.key_by_session_id[session_id] = key
+
+    def get(self, session_id):
+        """按 sessionId 获取会话条目（没有则返回 None）"""
+        self.refresh()
+        return self.by_session_id.get(session_id)
+
+    def agent_sessions(self):
+        """所有 agent: 会话，返回 [(key, value), ...]"""
+        self.refresh()
+        return [(key, value) for key, value in self.data.items()
+                if key.startswith("agent:") and isinstance(value, dict)]
+
+    def snapshot(self):
+        """返回当前数据的深拷贝（用于修改后 save）"""
+        self.refresh()
+        with self.lock:
+            return copy.deepcopy(self.data)
+
+    def save(self, data):
+        """写回 sessions.json 并同步缓存"""
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        with self.lock:
+            self._index(data)
+            try:
+                st = os.stat(self.path)
+                self.signature = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                self.signature = None
+
+
+def count_newlines(path, block_size=1024 * 1024):
+    """以二进制大块读取统计行数（不解码；最后一行没有换行符也算一行）"""
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            count += block.count(b'\n')
+            last = block[-1:]
+    return count if last == b'\n' else count + 1
+
+
+class SessionStatsCache:
+    """会话文件统计（行数、消息数、各角色条数、估算 token）的缓存
+
+    按 (路径, 大小, 修改时间) 缓存，可持久化到 cache_path，命令行多次运行间复用：
+    - 文件未变化：只做一次 stat
+    - 文件只追加：只统计新增的字节（同 FileTailer，用偏移前的末尾字节校验）
+    - 其它变化：全量重新统计
+    以二进制大块读取，换行数直接在 bytes 上统计，只有 message 行才做 JSON 解析。
+    估算 token 与分词后端有关：缓存文件按后端分开保存（{'backends': {后端名: entries}}），
+    使用不同后端的程序（命令行、后台服务）共用同一个文件也不会互相覆盖；后端切换后自动换用对应的条目。
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    SIGNATURE_SIZE = 64
+
+    def __init__(self, cache_path=None, counter=None):
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.counter = counter or token_counter
+        self.lock = threading.Lock()
+        self.backend = self.counter.tokenizer.name
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def read_sections(self):
+        """缓存文件中各后端的条目 {后端名: entries}（兼容只有一个后端的旧格式）"""
+        if not self.cache_path or not self.cache_path.exists():
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if 'backends' in data:
+                return dict(data['backends'])
+            return {data['backend']: data.get('entries', {})}
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            return {}
+
+    def load(self):
+        self.entries = self.read_sections().get(self.backend, {})
+
+    def sync_backend(self):
+        """分词后端已切换时，保存当前条目并换用新后端的条目"""
+        if self.counter.tokenizer.name == self.backend:
+            return
+        self.save()
+        with self.lock:
+            self.backend = self.counter.tokenizer.name
+            self.dirty = False
+        self.load()
+
+    def save(self):
+        """有更新时写回缓存文件（保留文件中其它后端的条目）"""
+        if not self.cache_path or not self.dirty:
+            return
+        sections = self.read_sections()
+        with self.lock:
+            sections[self.backend] = self.entries
+            data = {'backends': sections}
+            try:
+                self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+                # 命令行和后台服务可能同时写回，临时文件按进程区分
+                tmp_path = self.cache_path.with_suffix(f'.{os.getpid()}.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.cache_path)
+                self.dirty = False
+            except OSError as e:
+                print(f"[统计缓存] 写入失败: {e}")
+
+    @staticmethod
+    def public(entry):
+        """返回给调用方的统计结果（不含内部校验字段）"""
+        return {
+            'lines': entry['lines'] + (1 if entry['size'] > entry['offset'] else 0),
+            'messages': entry['messages'],
+            'roles': dict(entry['roles']),
+            'tokens': entry['tokens'],
+            'size': entry['size'],
+        }
+
+    def get(self, path):
+        """单个会话文件的统计（文件不存在时返回 None）"""
+        self.sync_backend()
+        return self._get(path)
+
+    def _get(self, path):
+        key = str(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return self.public(entry)
+        entry = self._scan(path, entry, st)
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty = True
+        return self.public(entry)
+
+    def get_many(self, paths, max_workers=8):
+        """并发统计多个文件，按 paths 顺序返回"""
+        return list(self.iter_many(paths, max_workers))
+
+    def iter_many(self, paths, max_workers=8):
+        """并发统计多个文件，按 paths 顺序逐个产出（前面的完成即可开始输出）"""
+        paths = list(paths)
+        self.sync_backend()
+        if len(paths) <= 1:
+            for path in paths:
+                yield self._get(path)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as pool:
+            for stat in pool.map(self._get, paths):
+                yield stat
+
+    def _scan(self, path, entry, st):
+        with open(path, 'rb') as f:
+            start = 0
+            if (entry and entry.get('inode') == st.st_ino
+                    and st.st_size >= entry['offset'] > 0):
+                # 只追加：偏移前的末尾字节未变
+                signature = bytes.fromhex(entry['signature'])
+                f.seek(entry['offset'] - len(signature))
+                if f.read(len(signature)) == signature:
+                    start = entry['offset']
+            if start:
+                entry = dict(entry, roles=dict(entry['roles']))
+            else:
+                entry = {'offset': 0, 'lines': 0, 'messages': 0, 'roles': {}, 'tokens': 0,
+                         'signature': ''}
+
+            f.seek(start)
+            offset = start
+            remainder = b''
+            while True:
+                block = f.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                data = remainder + block
+                cut = data.rfind(b'\n') + 1
+                if not cut:
+                    remainder = data
+                    continue
+                complete, remainder = data[:cut], data[cut:]
+                entry['lines'] += complete.count(b'\n')
+                self._count_messages(entry, complete)
+                offset += cut
+                entry['signature'] = complete[-self.SIGNATURE_SIZE:].hex()
+
+        entry.update(offset=offset, size=offset + len(remainder),
+                     mtime_ns=st.st_mtime_ns, inode=st.st_ino)
+        return entry
+
+    def _count_messages(self, entry, data):
+        """统计一段完整行中的 message（只解析含 message 类型的行）"""
+        records = []
+        for line in data.split(b'\n'):
+            if b'"message"' not in line:
+                continue
+            record = parse_session_line(0, line.decode('utf-8', errors='ignore'))
+            if record['type'] == 'message':
+                records.append(record)
+        self.counter.count_records(records)
+        for record in records:
+            entry['messages'] += 1
+            entry['roles'][record['role']] = entry['roles'].get(record['role'], 0) + 1
+            entry['tokens'] += record['tokens']
+
+
+# 本地测试接口端口（LocalStubServer）
+LOCAL_STUB_PORT = 18790
+# 本地测试接口 GET /v1/models 返回的 owned_by 标记（端口被占用时据此确认是测试接口而不是其它程序）
+LOCAL_STUB_MARKER = 'openclaw-local-stub'
+
+# API 配置
+API_TEMPLATES = {
+    'moonshot': {
+        'url': 'https://api.moonshot.cn/v1/chat/completions',
+        'models': ['kimi-k2.5', 'kimi-k2']
+    },
+    'kimicode': {
+        # Kimi Code 的正确 API 地址
+        # 参考: game_assistant/send/llm_clients/ask_kimi.py
+        'url': 'https://api.kimi.com/coding/v1/chat/completions',
+        'models': ['kimi-for-coding', 'kimi-k2.5'],  # 支持两种模型
+        # Kimi Code 需要特殊 headers
+        'headers': {
+            "User-Agent": "claude-code/0.1.0",
+            "X-Client-Name": "claude-code",
+        },
+    },
+    'local': {
+        # 本地 OpenAI 兼容测试接口（离线测试用，首次使用时自动启动）
+        'url': f'http://127.0.0.1:{LOCAL_STUB_PORT}/v1/chat/completions',
+        'models': ['local-stub'],
+        'needs_key': False,
+        'local_stub': True,
+    },
+}
+
+
+def register_provider(name, url, models, headers=None, needs_key=True):
+    """注册一个 OpenAI 兼容的服务商（如自建接口），注册后可用于路由和故障切换"""
+    template = {'url': url, 'models': list(models), 'needs_key': needs_key}
+    if headers:
+        template['headers'] = dict(headers)
+    API_TEMPLATES[name] = template
+
+
+def requires_api_key(provider):
+    """服务商是否需要 API Key"""
+    return API_TEMPLATES.get(provider, {}).get('needs_key', True)
+
+
+class BackendUnavailable(Exception):
+    """后端不可用（不发送请求、不重试；路由时该后端立即进入冷却）"""
+
+
+class ApiError(Exception):
+    """接口返回错误状态码"""
+
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"API 错误: {status_code} - {text[:500]}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """重试策略 - 指数退避 + 随机抖动
+
+    429、5xx、超时和连接失败会重试；服务端给出 Retry-After 时优先按其等待。
+    """
+
+    RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=30.0, max_retry_after=120.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def backoff(self, attempt):
+        """第 attempt 次重试前的等待秒数（一半固定 + 一半随机，避免多个请求同时重试）"""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def should_retry(self, status_code):
+        return status_code in self.RETRY_STATUS
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回等待秒数或 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class TokenBucket:
+    """令牌桶限流 - 每个服务商一个，平滑请求速率
+
+    rate_per_minute 为 0 时不限流。reserve() 预约一个令牌并返回需要等待的秒数，
+    同步代码 sleep、异步代码 await asyncio.sleep 即可共用同一个桶。
+    """
+
+    def __init__(self, rate_per_minute=0, burst=5):
+        self.lock = threading.Lock()
+        self.blocked_until = 0.0
+        self.configure(rate_per_minute, burst)
+
+    def configure(self, rate_per_minute, burst=5):
+        with self.lock:
+            self.rate = rate_per_minute / 60.0
+            self.capacity = max(1, burst)
+            self.tokens = float(self.capacity)
+            self.updated = time.monotonic()
+
+    def reserve(self):
+        """预约一个令牌，返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def pause(self, seconds):
+        """暂停发放令牌（收到 429 + Retry-After 时，同一服务商的请求一起等待）"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class ApiClient:
+    """AI 接口客户端 - 每个服务商复用一个保持连接的 HTTP 会话
+
+    - request：限流 + 失败重试（指数退避、Retry-After），chat / stream_chat 都经过这里
+    - post / chat：同步调用，走 requests.Session 连接池（省去每次 TCP+TLS 握手）
+    - chat_many：多个请求并发执行（线程池 + 共享连接池），耗时约等于最慢的一次
+    - stream_chat / stream_many：流式（SSE）调用，每收到一段文本就回调一次
+    - achat：asyncio 版本，装有 httpx 时使用 httpx.AsyncClient，否则放到线程池执行
+    - chat_routed / chat_routed_many：按 ProviderRegistry 选最快的可用后端，失败时切换到下一个
+    """
+
+    POOL_SIZE = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}        # provider -> requests.Session
+        self.async_clients = {}   # (provider, 事件循环 id) -> (事件循环, httpx.AsyncClient)，由 lock 保护
+        self.retry_policy = RetryPolicy()
+        self.rate_per_minute = 0  # 每个服务商每分钟最多请求数（0 为不限）
+        self.buckets = {}         # provider -> TokenBucket
+        self.global_bucket = TokenBucket(0)  # 所有服务商合计的请求预算（多会话并发压缩时共用）
+
+    def configure(self, max_retries=None, rate_per_minute=None, global_rate_per_minute=None):
+        """设置重试次数、每个服务商的请求速率和所有服务商合计的请求速率"""
+        if max_retries is not None:
+            self.retry_policy.max_retries = max(0, int(max_retries))
+        if rate_per_minute is not None:
+            with self.lock:
+                self.rate_per_minute = max(0, rate_per_minute)
+                for bucket in self.buckets.values():
+                    bucket.configure(self.rate_per_minute)
+        if global_rate_per_minute is not None:
+            self.global_bucket.configure(max(0, global_rate_per_minute))
+
+    def bucket(self, provider):
+        """服务商对应的令牌桶"""
+        with self.lock:
+            bucket = self.buckets.get(provider)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_minute)
+                self.buckets[provider] = bucket
+            return bucket
+
+    def session(self, provider):
+        """获取服务商对应的连接池会话（首次使用时创建）"""
+        if API_TEMPLATES[provider].get('local_stub'):
+            ensure_local_stub()  # 可能需要探测端口，不在连接池锁内执行
+        with self.lock:
+            session = self.sessions.get(provider)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[provider] = session
+            return session
+
+    def close(self):
+        """关闭所有连接"""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+    @staticmethod
+    def build_headers(provider, api_key):
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        # 服务商要求的额外 headers（如 Kimi Code）
+        headers.update(API_TEMPLATES[provider].get('headers', {}))
+        return headers
+
+    @staticmethod
+    def build_chat_data(model, prompt, max_tokens=2000):
+        # kimi-k2.5 模型只支持 temperature=1
+        temp = 1.0 if 'k2.5' in model else 0.3
+        return {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temp
+        }
+
+    def post(self, provider, api_key, data, timeout=60, stream=False):
+        """发送原始请求（不限流、不重试），返回 requests 的 Response"""
+        url = API_TEMPLATES[provider]['url']
+        return self.session(provider).post(
+            url, headers=self.build_headers(provider, api_key), json=data,
+            timeout=timeout, stream=stream)
+
+    def retry_delay(self, provider, attempt, error, max_retries=None):
+        """请求失败后决定是否重试：返回等待秒数，不再重试时抛出 error"""
+        policy = self.retry_policy
+        if max_retries is None:
+            max_retries = policy.max_retries
+        if attempt >= max_retries:
+            raise error
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = min(retry_after, policy.max_retry_after)
+            self.bucket(provider).pause(delay)
+        else:
+            delay = policy.backoff(attempt)
+        print(f"[API] {provider}: {error}，{delay:.1f}秒后重试（{attempt + 1}/{max_retries}）")
+        return delay
+
+    def request(self, provider, api_key, data, timeout=60, stream=False, max_retries=None):
+        """带限流和重试的请求，返回状态码 200 的 Response
+
+        不可重试的错误状态码（如 401）和重试用尽时抛出异常。
+        max_retries: 覆盖默认重试次数（有备选后端时用较小的值，尽快切换）
+        """
+        import requests
+        attempt = 0
+        while True:
+            wait = max(self.global_bucket.reserve(), self.bucket(provider).reserve())
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = self.post(provider, api_key, data, timeout=timeout, stream=stream)
+            except requests.exceptions.Timeout:
+                error = Exception("API 请求超时")
+            except requests.exceptions.ConnectionError:
+                error = Exception("无法连接到 API，请检查网络")
+            else:
+                if response.status_code == 200:
+                    return response
+                error = ApiError(response.status_code, response.text,
+                                 parse_retry_after(response.headers.get('Retry-After')))
+                response.close()
+                if not self.retry_policy.should_retry(response.status_code):
+                    raise error
+            time.sleep(self.retry_delay(provider, attempt, error, max_retries))
+            attempt += 1
+
+    def chat(self, provider, api_key, model, prompt, max_tokens=2000, timeout=60,
+             max_retries=None):
+        """同步调用对话接口，返回回复文本"""
+        if not api_key and requires_api_key(provider):
+            raise Exception("未设置 API Key")
+        data = self.build_chat_data(model, prompt, max_tokens)
+        response = self.request(provider, api_key, data, timeout=timeout,
+                                max_retries=max_retries)
+        return parse_chat_response(response.status_code, response.text)
+
+    def chat_many(self, provider, api_key, model, prompts, max_tokens=2000, timeout=60):
+        """并发调用多个对话请求，按 prompts 顺序返回回复文本
+
+        任一请求失败时抛出该请求的异常。
+        """
+        if len(prompts) <= 1:
+            return [self.chat(provider, api_key, model, p, max_tokens, timeout) for p in prompts]
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(len(prompts), self.POOL_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.chat, provider, api_key, model, p, max_tokens, timeout)
+                       for p in prompts]
+            return [future.result() for future in futures]
+
+    def stream_chat(self, provider, api_key, model, prompt, on_delta=None,
+                    max_tokens=2000, timeout=60, keep_partial=True, max_retries=None):
+        """流式调用对话接口（SSE），返回完整回复文本
+
+        on_delta(text): 每收到一段正文时调用（在调用线程中执行）
+        keep_partial: 传输中途断开时，已收到正文则返回已收到的部分而不是抛出异常
+        """
+        import requests
+        if not api_key and requires_api_key(provider):
+            raise Exception("未设置 API Key")
+        data = self.build_chat_data(model, prompt, max_tokens)
+        data["stream"] = True
+
+        # 连接建立前的失败（429、5xx 等）按重试策略处理，开始接收后不再重试
+        response = self.request(provider, api_key, data, timeout=timeout, stream=True,
+                                max_retries=max_retries)
+        content_parts = []
+        reasoning_parts = []
+        try:
+            with response:
+                for line in response.iter_lines():
+                    event = parse_stream_line(line)
+                    if event is None:
+                        continue
+                    if event is STREAM_DONE:
+                        break
+                    content, reasoning = event
+                    if content:
+                        content_parts.append(content)
+                        if on_delta:
+                            on_delta(content)
+                    if reasoning:
+                        reasoning_parts.append(reasoning)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if keep_partial and content_parts:
+                print(f"[API] 流式传输中断，使用已收到的 {len(content_parts)} 段内容: {e}")
+                return PartialResponse(''.join(content_parts).strip())
+            elif isinstance(e, requests.exceptions.Timeout):
+                raise Exception("API 请求超时")
+            else:
+                raise Exception("无法连接到 API，请检查网络")
+
+        # Kimi Code 可能只返回 reasoning_content
+        text = ''.join(content_parts) or ''.join(reasoning_parts)
+        return text.strip() if text.strip() else "(无回复)"
+
+    def stream_many(self, provider, api_key, model, prompts, on_delta=None,
+                    max_tokens=2000, timeout=60):
+        """并发流式调用多个请求，按 prompts 顺序返回
+
+        on_delta(index, text): index 为对应 prompt 的位置
+        """
+        def run(index, prompt):
+            callback = None
+            if on_delta:
+                callback = lambda text: on_delta(index, text)
+            return self.stream_chat(provider, api_key, model, prompt, callback, max_tokens, timeout)
+
+        if len(prompts) <= 1:
+            return [run(i, p) for i, p in enumerate(prompts)]
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(len(prompts), self.POOL_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run, i, p) for i, p in enumerate(prompts)]
+            return [future.result() for future in futures]
+
+    def chat_routed(self, registry, prompt, on_delta=None, stream=False,
+                    max_tokens=2000, timeout=60):
+        """按 registry 的排序依次尝试各后端，返回第一个成功的回复
+
+        每次调用都会把耗时或错误记入 registry；还有备选后端时只重试 1 次，
+        尽快切换，最后一个后端按默认重试策略处理。全部失败时抛出异常。
+        """
+        backends = registry.ranked()
+        if not backends:
+            raise Exception("没有可用的服务商，请先配置 API")
+        errors = []
+        for position, backend in enumerate(backends):
+            name = backend['name']
+            retries = 1 if position < len(backends) - 1 else None
+            start = time.time()
+            try:
+                if stream:
+                    text = self.stream_chat(backend['provider'], backend['api_key'],
+                                            backend['model'], prompt, on_delta,
+                                            max_tokens, timeout, max_retries=retries)
+                else:
+                    text = self.chat(backend['provider'], backend['api_key'],
+                                     backend['model'], prompt, max_tokens, timeout,
+                                     max_retries=retries)
+            except Exception as e:
+                registry.record(name, error=e)
+                errors.append(f"{name}: {e}")
+                if position < len(backends) - 1:
+                    print(f"[路由] {name} 失败，切换到下一个服务商: {e}")
+                continue
+            registry.record(name, time.time() - start)
+            return text
+        raise Exception("所有服务商均不可用: " + "; ".join(errors))
+
+    def chat_routed_many(self, registry, prompts, on_delta=None, stream=False,
+                         max_tokens=2000, timeout=60):
+        """并发执行多个路由请求，按 prompts 顺序返回
+
+        on_delta(index, text): 流式时每收到一段正文调用一次
+        """
+        def run(index, prompt):
+            callback = None
+            if on_delta:
+                callback = lambda text: on_delta(index, text)
+            return self.chat_routed(registry, prompt, callback, stream, max_tokens, timeout)
+
+        if len(prompts) <= 1:
+            return [run(i, p) for i, p in enumerate(prompts)]
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(len(prompts), self.POOL_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run, i, p) for i, p in enumerate(prompts)]
+            return [future.result() for future in futures]
+
+    async def achat(self, provider, api_key, model, prompt, max_tokens=2000, timeout=60):
+        """异步调用对话接口（asyncio），返回回复文本"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            import httpx
+        except ImportError:
+            # 没有 httpx：在线程池中执行同步调用（同样复用连接池）
+            return await loop.run_in_executor(
+                None, lambda: self.chat(provider, api_key, model, prompt, max_tokens, timeout))
+
+        if not api_key and requires_api_key(provider):
+            raise Exception("未设置 API Key")
+        if API_TEMPLATES[provider].get('local_stub'):
+            await loop.run_in_executor(None, ensure_local_stub)
+        key = (provider, id(loop))
+        with self.lock:
+            entry = self.async_clients.get(key)
+            # 事件循环 id 可能被已结束的循环复用，只复用属于当前循环的客户端
+            if entry is None or entry[0] is not loop:
+                limits = httpx.Limits(max_keepalive_connections=self.POOL_SIZE,
+                                      max_connections=self.POOL_SIZE)
+                entry = (loop, httpx.AsyncClient(limits=limits))
+                self.async_clients[key] = entry
+            client = entry[1]
+
+        attempt = 0
+        while True:
+            wait = max(self.global_bucket.reserve(), self.bucket(provider).reserve())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                response = await client.post(
+                    API_TEMPLATES[provider]['url'],
+                    headers=self.build_headers(provider, api_key),
+                    json=self.build_chat_data(model, prompt, max_tokens),
+                    timeout=timeout)
+            except httpx.TimeoutException:
+                error = Exception("API 请求超时")
+            except httpx.TransportError:
+                error = Exception("无法连接到 API，请检查网络")
+            else:
+                if response.status_code == 200:
+                    return parse_chat_response(response.status_code, response.text)
+                error = ApiError(response.status_code, response.text,
+                                 parse_retry_after(response.headers.get('Retry-After')))
+                if not self.retry_policy.should_retry(response.status_code):
+                    raise error
+            await asyncio.sleep(self.retry_delay(provider, attempt, error))
+            attempt += 1
+
+    async def achat_many(self, provider, api_key, model, prompts, max_tokens=2000, timeout=60):
+        """asyncio 并发调用多个对话请求，按 prompts 顺序返回"""
+        import asyncio
+        return await asyncio.gather(*[
+            self.achat(provider, api_key, model, p, max_tokens, timeout) for p in prompts])
+
+    async def aclose(self):
+        """关闭当前事件循环上的异步连接"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = [self.async_clients.pop(key)[1] for key, entry in list(self.async_clients.items())
+                       if entry[0] is loop]
+        for client in clients:
+            await client.aclose()
+
+
+def parse_chat_response(status_code, text):
+    """解析对话接口的响应，返回回复文本（出错时抛出异常）"""
+    if status_code != 200:
+        raise Exception(f"API 错误: {status_code} - {text[:500]}")
+    try:
+        result = json.loads(text)
+        # 检查 API 返回的错误
+        if 'error' in result:
+            raise Exception(f"API 返回错误: {result['error']}")
+        if 'choices' not in result or not result['choices']:
+            raise Exception(f"API 返回格式异常: {result}")
+        message = result['choices'][0].get('message', {})
+        if not message:
+            raise Exception(f"API 返回的 message 为空: {result['choices'][0]}")
+        # Kimi Code 可能返回 reasoning_content
+        content = message.get('content', '')
+        if not content:
+            content = message.get('reasoning_content', '')
+        return content.strip() if content else "(无回复)"
+    except (KeyError, IndexError, ValueError) as e:
+        raise Exception(f"解析 API 响应失败: {e}, 响应: {text[:500]}")
+
+
+class PartialResponse(str):
+    """传输中途断开时已收到的部分回复（可以使用，但不应写入缓存）"""
+
+
+# 流式响应结束标记
+STREAM_DONE = object()
+
+
+def parse_stream_line(line):
+    """解析 SSE 的一行
+
+    返回: None（非数据行）/ STREAM_DONE / (正文片段, 推理片段)
+    """
+    if not line:
+        return None
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='ignore')
+    if not line.startswith('data:'):
+        return None
+    payload = line[5:].strip()
+    if payload == '[DONE]':
+        return STREAM_DONE
+    try:
+        chunk = json.loads(payload)
+    except ValueError:
+        return None
+    if 'error' in chunk:
+        raise Exception(f"API 返回错误: {chunk['error']}")
+    choices = chunk.get('choices') or []
+    if not choices:
+        return None
+    delta = choices[0].get('delta') or {}
+    return delta.get('content') or '', delta.get('reasoning_content') or ''
+
+
+# 共享的 API 客户端（连接池在整个进程内复用）
+api_client = ApiClient()
+
+
+class ProviderRegistry:
+    """多服务商注册表 - 记录每个后端最近的延迟和错误率，用于路由和故障切换
+
+    后端为 dict: {'name', 'provider', 'model', 'api_key'}，name 默认为 "provider/model"。
+    - 每个后端保留最近 window 次调用的 (耗时, 是否成功)
+    - 连续失败 failure_threshold 次，或最近错误率超过 max_error_rate，
+      进入冷却 cooldown 秒（期间排在最后，仅在其它后端都失败时才尝试）
+    - ranked()：健康的后端按平均延迟从快到慢排序，尚无数据的排在最前（先探测一次）
+    """
+
+    def __init__(self, window=20, failure_threshold=3, cooldown=60.0, max_error_rate=0.5):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.lock = threading.Lock()
+        self.backends = []
+        self.stats = {}  # name -> {'samples', 'failures', 'down_until', 'last_error'}
+
+    def set_backends(self, backends):
+        """设置后端列表（同名后端保留已有统计）"""
+        from collections import deque
+        with self.lock:
+            self.backends = []
+            for backend in backends:
+                backend = dict(backend)
+                backend.setdefault('name', f"{backend['provider']}/{backend['model']}")
+                if any(b['name'] == backend['name'] for b in self.backends):
+                    continue
+                self.backends.append(backend)
+                if backend['name'] not in self.stats:
+                    self.stats[backend['name']] = {
+                        'samples': deque(maxlen=self.window),
+                        'failures': 0,
+                        'down_until': 0.0,
+                        'last_error': '',
+                    }
+
+    def record(self, name, latency=None, error=None):
+        """记录一次调用结果：成功传 latency（秒），失败传 error"""
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                return
+            if error is None:
+                stat['samples'].append((latency, True))
+                stat['failures'] = 0
+                stat['down_until'] = 0.0
+                return
+            stat['samples'].append((None, False))
+            stat['failures'] += 1
+            stat['last_error'] = str(error)[:200]
+            samples = stat['samples']
+            error_rate = sum(1 for _, ok in samples if not ok) / len(samples)
+            if (isinstance(error, BackendUnavailable)
+                    or stat['failures'] >= self.failure_threshold
+                    or (len(samples) >= 5 and error_rate > self.max_error_rate)):
+                stat['down_until'] = time.time() + self.cooldown
+
+    @staticmethod
+    def _summarize(stat):
+        latencies = [latency for latency, ok in stat['samples'] if ok]
+        total = len(stat['samples'])
+        return {
+            'latency': sum(latencies) / len(latencies) if latencies else None,
+            'error_rate': (total - len(latencies)) / total if total else 0.0,
+            'calls': total,
+        }
+
+    def healthy(self, name):
+        with self.lock:
+            stat = self.stats.get(name)
+            return stat is not None and time.time() >= stat['down_until']
+
+    def ranked(self):
+        """按路由顺序返回后端列表（健康且最快的在前，冷却中的在最后）"""
+        now = time.time()
+        with self.lock:
+            healthy = []
+            cooling = []
+            for backend in self.backends:
+                stat = self.stats[backend['name']]
+                if now < stat['down_until']:
+                    cooling.append((stat['down_until'], backend))
+                    continue
+                summary = self._summarize(stat)
+                latency = summary['latency'] if summary['latency'] is not None else 0.0
+                healthy.append(((stat['failures'] > 0, latency), backend))
+            healthy.sort(key=lambda item: item[0])
+            cooling.sort(key=lambda item: item[0])
+            return [b for _, b in healthy] + [b for _, b in cooling]
+
+    def describe(self):
+        """各后端状态的文字描述（每行一个）"""
+        now = time.time()
+        lines = []
+        with self.lock:
+            for backend in self.backends:
+                stat = self.stats[backend['name']]
+                summary = self._summarize(stat)
+                latency = (f"{summary['latency']:.2f}秒" if summary['latency'] is not None
+                           else "无数据")
+                line = (f"{backend['name']}: 平均延迟 {latency}，"
+                        f"错误率 {summary['error_rate']:.0%}（最近 {summary['calls']} 次）")
+                if now < stat['down_until']:
+                    line += f"，冷却中 {int(stat['down_until'] - now)}秒"
+                    if stat['last_error']:
+                        line += f"（{stat['last_error'][:80]}）"
+                lines.append(line)
+        return lines
+
+
+class LocalStubServer:
+    """本地 OpenAI 兼容测试接口 - 用于离线测试压缩、路由和故障切换
+
+    POST /v1/chat/completions：返回对最后一条用户消息的抽取式摘要（取每行开头），
+    支持 "stream": true（SSE）。GET /v1/models 返回带 LOCAL_STUB_MARKER 的模型列表。
+    latency 为每次响应前的延迟秒数，
+    fail_rate 为随机返回 503 的比例（用于测试故障切换）。
+    """
+
+    def __init__(self, host='127.0.0.1', port=LOCAL_STUB_PORT, latency=0.0, fail_rate=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    @staticmethod
+    def summarize(prompt, max_chars=2000):
+        """抽取式摘要：保留非空行的开头部分（压缩提示词只取"内容："之后的部分）"""
+        prompt = prompt.rsplit("内容：", 1)[-1]
+        lines = [line.strip() for line in prompt.splitlines() if line.strip()]
+        parts = [f"【本地测试摘要】共 {len(lines)} 行，{len(prompt)} 字"]
+        used = len(parts[0])
+        for line in lines:
+            part = line[:60]
+            if used + len(part) + 1 > max_chars:
+                break
+            parts.append(part)
+            used += len(part) + 1
+        return "\n".join(parts)
+
+    def start(self):
+        """在后台线程中启动（端口被占用时抛出 OSError）"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.rstrip('/') != '/v1/models':
+                    self.send_json(404, {'error': {'message': 'not found'}})
+                    return
+                self.send_json(200, {'object': 'list', 'data': [
+                    {'id': 'local-stub', 'object': 'model', 'owned_by': LOCAL_STUB_MARKER}]})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    data = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    self.send_json(400, {'error': {'message': 'invalid json'}})
+                    return
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.fail_rate and random.random() < stub.fail_rate:
+                    self.send_json(503, {'error': {'message': 'stub unavailable'}})
+                    return
+                messages = data.get('messages') or [{}]
+                prompt = messages[-1].get('content', '')
+                reply = stub.summarize(prompt, int(data.get('max_tokens') or 2000))
+                if not data.get('stream'):
+                    self.send_json(200, {
+                        'id': 'local-stub',
+                        'object': 'chat.completion',
+                        'model': data.get('model', 'local-stub'),
+                        'choices': [{'index': 0, 'finish_reason': 'stop',
+                                     'message': {'role': 'assistant', 'content': reply}}],
+                    })
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                for start in range(0, len(reply), 20):
+                    chunk = {'choices': [{'index': 0, 'delta': {'content': reply[start:start + 20]}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"[本地接口] 已启动: {self.url}")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+_local_stub = None
+_local_stub_lock = threading.Lock()
+
+
+def is_local_stub(port=LOCAL_STUB_PORT, timeout=2.0):
+    """端口上运行的是否为本地测试接口（GET /v1/models 带 LOCAL_STUB_MARKER）"""
+    import urllib.request
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/models", timeout=timeout) as response:
+            data = json.loads(response.read(65536))
+        return any(model.get('owned_by') == LOCAL_STUB_MARKER for model in data.get('data', []))
+    except Exception:
+        return False
+
+
+def ensure_local_stub():
+    """确保本地测试接口在运行
+
+    端口已被占用时先确认占用者是本地测试接口（其它进程启动的实例）才使用；
+    被其它程序占用时抛出 BackendUnavailable，不把会话内容发给未知程序（下次使用时重新检查）。
+    """
+    global _local_stub
+    with _local_stub_lock:
+        if _local_stub is None:
+            try:
+                _local_stub = LocalStubServer().start()
+            except OSError as e:
+                if not is_local_stub():
+                    raise BackendUnavailable(f"本地测试接口端口 {LOCAL_STUB_PORT} 被其它程序占用: {e}")
+                print(f"[本地接口] 端口 {LOCAL_STUB_PORT} 上已有本地测试接口在运行，直接使用")
+                _local_stub = False
+        return _local_stub
+
+
+class MapReduceSummarizer:
+    """分层（map-reduce）摘要 - 处理任意长度的对话历史
+
+    1. 按 token 预算把全部历史切成若干块（单条超长消息按字数再切开）
+    2. map：用有限大小的线程池并发摘要每一块
+    3. reduce：分块摘要若仍超出预算则继续分组摘要，直到能放进一次请求
+
+    condense() 返回可直接用于最终请求的内容：历史本身不超过预算时原样返回，
+    否则返回各块摘要的合并文本。每次请求的大小都不超过 chunk_tokens
+    （摘要无法再变短时按比例截断各段摘要）。
+    """
+
+    def __init__(self, summarize, chunk_tokens=6000, max_workers=4, counter=None):
+        self.summarize = summarize          # summarize(content) -> 摘要文本
+        self.chunk_tokens = max(500, chunk_tokens)
+        self.max_workers = max(1, max_workers)
+        self.counter = counter or token_counter
+
+    def split_chunks(self, texts):
+        """按 token 预算分块，返回 [[text, ...], ...]（保持原有顺序）"""
+        chunks = []
+        current = []
+        current_tokens = 0
+        for text in texts:
+            if not text:
+                continue
+            tokens = self.counter.count(text)
+            if tokens > self.chunk_tokens:
+                # 单条超长：按字数均分成若干段
+                pieces = math.ceil(tokens / self.chunk_tokens)
+                size = math.ceil(len(text) / pieces)
+                parts = [text[i:i + size] for i in range(0, len(text), size)]
+            else:
+                parts = [text]
+            for part in parts:
+                part_tokens = tokens if len(parts) == 1 else self.counter.count(part)
+                if current and current_tokens + part_tokens > self.chunk_tokens:
+                    chunks.append(current)
+                    current = []
+                    current_tokens = 0
+                current.append(part)
+                current_tokens += part_tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def map(self, chunks, level=1):
+        """并发摘要每一块，按顺序返回摘要列表"""
+        total = len(chunks)
+        title = "对话片段" if level == 1 else "分段摘要"
+        contents = [f"【{title} {i + 1}/{total}】\n\n" + "\n\n".join(chunk)
+                    for i, chunk in enumerate(chunks)]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, total)) as pool:
+            return list(pool.map(self.summarize, contents))
+
+    def condense(self, texts, separator="\n\n"):
+        """把任意长的文本列表压缩到一次请求的预算以内"""
+        chunks = self.split_chunks(texts)
+        level = 0
+        while len(chunks) > 1:
+            level += 1
+            print(f"[摘要] 第{level}层: {len(chunks)} 块并发摘要")
+            summaries = self.map(chunks, level)
+            regrouped = self.split_chunks(summaries)
+            if len(regrouped) >= len(chunks):
+                # 摘要没有变短（预算过小）：截断到预算以内再合并，避免无限循环
+                chunks = [self.truncate(summaries)]
+                break
+            chunks = regrouped
+        if not chunks:
+            return ""
+        return separator.join(chunks[0])
+
+    def truncate(self, texts):
+        """按比例截断各段文本，使合计 token 不超过 chunk_tokens（每段保留开头）"""
+        share = self.chunk_tokens // max(1, len(texts))
+        while True:
+            result = []
+            for text in texts:
+                tokens = self.counter.count(text)
+                if tokens > share:
+                    text = text[:max(1, len(text) * share // tokens - 1)] + "…"
+                result.append(text)
+            if share <= 1 or sum(self.counter.count(text) for text in result) <= self.chunk_tokens:
+                return result
+            share = share * 9 // 10
+
+
+class SummaryCache:
+    """摘要结果的持久缓存（按内容寻址）
+
+    键为 (提示词, 模型, 输入内容) 的 SHA-256，每条摘要存为目录下的一个文件，
+    命中时更新文件修改时间，总大小超出上限时按最久未使用（LRU）淘汰。
+    历史未变化的分块直接复用已有摘要，只有新增内容才需要调用 API。
+    """
+
+    def __init__(self, directory, max_bytes=20 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None   # 文件名 -> [大小, 最近使用时间]（首次使用时扫描目录）
+        self.total_bytes = 0
+
+    @staticmethod
+    def make_key(prompt, model, content):
+        digest = hashlib.sha256()
+        for part in (prompt, model, content):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _load_index(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        self.total_bytes = 0
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith('.txt'):
+                    st = entry.stat()
+                    self.entries[entry.name] = [st.st_size, st.st_mtime]
+                    self.total_bytes += st.st_size
+        except OSError:
+            pass
+
+    def get(self, key):
+        """读取缓存的摘要（没有则返回 None）"""
+        name = key + '.txt'
+        path = self.directory / name
+        with self.lock:
+            self._load_index()
+            if name not in self.entries:
+                return None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                os.utime(path)
+                self.entries[name][1] = time.time()
+                return text
+            except OSError:
+                self.total_bytes -= self.entries.pop(name)[0]
+                return None
+
+    def put(self, key, text):
+        """写入摘要，并在超出大小上限时淘汰最久未使用的条目"""
+        name = key + '.txt'
+        path = self.directory / name
+        data = text.encode('utf-8')
+        with self.lock:
+            self._load_index()
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix('.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"[摘要缓存] 写入失败: {e}")
+                return
+            if name in self.entries:
+                self.total_bytes -= self.entries[name][0]
+            self.entries[name] = [len(data), time.time()]
+            self.total_bytes += len(data)
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        """修改大小上限（变小时立即按 LRU 淘汰）"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            if self.entries is not None:
+                self._evict()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for name, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self.directory / name)
+            except OSError:
+                pass
+            del self.entries[name]
+            self.total_bytes -= size
+
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self._load_index()
+            for name in list(self.entries):
+                try:
+                    os.remove(self.directory / name)
+                except OSError:
+                    pass
+            self.entries = {}
+            self.total_bytes = 0
+
+
+class BackupStore:
+    """会话备份仓库 - 按内容寻址、分块去重，备份开销只和变化的部分成正比
+
+    目录结构：
+        chunks/<哈希前2位>/<sha256>.<编码>   分块内容（zstd / gz / raw）
+        snapshots/<会话ID>_<时间>.json        快照清单：按顺序列出分块
+
+    按行切块，块边界由行内容决定（内容定义分块）：追加只产生新的尾部块，
+    删除开头若干行后后面的块仍然相同，都不会重复保存未变化的内容。
+    与上一个快照内容完全相同时不新建快照。
+
+    多个进程（查看器、后台服务、CLI）可能同时使用同一个仓库：临时文件名各不相同，
+    清理分块时跳过临时文件和最近写入/复用过的分块（GC_GRACE 秒内），避免删掉正在写入的快照所需的分块。
+    """
+
+    MIN_CHUNK = 16 * 1024
+    MAX_CHUNK = 256 * 1024
+    BOUNDARY_MASK = 0x1F   # 达到最小块大小后，约每 32 行出现一个边界
+    CODECS = ('zstd', 'gzip', 'none')
+    SUFFIXES = {'zstd': '.zst', 'gzip': '.gz', 'none': '.raw'}
+    GC_GRACE = 3600  # 秒：修改时间在此之内的分块不清理
+
+    def __init__(self, directory, compression='auto'):
+        self.directory = Path(directory)
+        self.chunk_dir = self.directory / "chunks"
+        self.snapshot_dir = self.directory / "snapshots"
+        self.lock = threading.Lock()
+        self.codec = self.resolve_codec(compression)
+
+    @staticmethod
+    def resolve_codec(compression):
+        """auto：装有 zstandard 用 zstd，否则 gzip；指定 zstd 但未安装时退回 gzip"""
+        if compression in ('auto', 'zstd'):
+            try:
+                import zstandard  # noqa: F401
+                return 'zstd'
+            except ImportError:
+                return 'gzip'
+        return compression if compression in BackupStore.CODECS else 'gzip'
+
+    @staticmethod
+    def encode(data, codec):
+        if codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        if codec == 'gzip':
+            import zlib
+            return zlib.compress(data, 6)
+        return data
+
+    @staticmethod
+    def decode(data, codec):
+        if codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data)
+        if codec == 'gzip':
+            import zlib
+            return zlib.decompress(data)
+        return data
+
+    def split_chunks(self, data):
+        """按行切块，返回 bytes 列表"""
+        import zlib
+        chunks = []
+        start = 0
+        pos = 0
+        end = len(data)
+        while pos < end:
+            newline = data.find(b'\n', pos)
+            line_end = end if newline == -1 else newline + 1
+            size = line_end - start
+            if size >= self.MAX_CHUNK or (
+                    size >= self.MIN_CHUNK
+                    and zlib.crc32(data[pos:line_end]) & self.BOUNDARY_MASK == 0):
+                chunks.append(data[start:line_end])
+                start = line_end
+            pos = line_end
+        if start < end:
+            chunks.append(data[start:])
+        return chunks
+
+    def chunk_path(self, digest, codec):
+        return self.chunk_dir / digest[:2] / (digest + self.SUFFIXES[codec])
+
+    def find_chunk(self, digest):
+        """已保存的分块（任意编码）：返回 (路径, 编码) 或 None"""
+        for codec in self.CODECS:
+            path = self.chunk_path(digest, codec)
+            if path.exists():
+                return path, codec
+        return None
+
+    @staticmethod
+    def write_atomic(path, data):
+        """写入同目录下的唯一临时文件后替换（并发写入同一路径时不会互相覆盖临时文件）"""
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def put_chunk(self, data):
+        """保存分块（已存在则跳过），返回 (sha256, 编码, 是否新写入)"""
+        digest = hashlib.sha256(data).hexdigest()
+        found = self.find_chunk(digest)
+        if found:
+            try:
+                # 更新修改时间：快照清单写入之前，其他进程的清理不会删除复用的分块
+                os.utime(found[0])
+                return digest, found[1], False
+            except OSError:
+                pass  # 刚被清理，重新写入
+        path = self.chunk_path(digest, self.codec)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.write_atomic(path, self.encode(data, self.codec))
+        return digest, self.codec, True
+
+    def snapshot(self, path, session_id, label=""):
+        """备份文件，返回快照名（内容与上一个快照相同时返回上一个快照名）"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        file_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            previous = self.list_snapshots(session_id)
+            if previous and previous[0].get('sha256') == file_hash:
+                return previous[0]['name']
+
+            chunks = []
+            new_bytes = 0
+            for chunk in self.split_chunks(data):
+                digest, codec, created = self.put_chunk(chunk)
+                chunks.append([digest, len(chunk), codec])
+                if created:
+                    new_bytes += len(chunk)
+
+            self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            name = f"{session_id}_{stamp}"
+            suffix = 1
+            while (self.snapshot_dir / f"{name}.json").exists():
+                suffix += 1
+                name = f"{session_id}_{stamp}_{suffix}"
+            manifest = {
+                'name': name,
+                'session': session_id,
+                'source': str(path),
+                'created': time.time(),
+                'label': label,
+                'size': len(data),
+                'sha256': file_hash,
+                'chunks': chunks,
+            }
+            manifest_path = self.snapshot_dir / f"{name}.json"
+            self.write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+        print(f"[备份] {name}: {len(chunks)} 块，新写入 {new_bytes}/{len(data)} 字节")
+        return name
+
+    def load_manifest(self, name):
+        with open(self.snapshot_dir / f"{name}.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def list_snapshots(self, session_id=None):
+        """快照清单列表（新的在前），session_id 为 None 时列出全部会话"""
+        if not self.snapshot_dir.exists():
+            return []
+        pattern = f"{session_id}_*.json" if session_id else "*.json"
+        manifests = []
+        for path in self.snapshot_dir.glob(pattern):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if session_id and manifest.get('session') != session_id:
+                continue
+            manifests.append(manifest)
+        manifests.sort(key=lambda m: m.get('created', 0), reverse=True)
+        return manifests
+
+    def read_snapshot(self, name):
+        """还原快照内容（bytes），并校验完整性"""
+        manifest = self.load_manifest(name)
+        parts = []
+        for digest, size, codec in manifest['chunks']:
+            found = self.find_chunk(digest)
+            if not found:
+                raise Exception(f"备份分块缺失: {digest[:12]}")
+            with open(found[0], 'rb') as f:
+                parts.append(self.decode(f.read(), found[1]))
+        data = b''.join(parts)
+        if hashlib.sha256(data).hexdigest() != manifest['sha256']:
+            raise Exception(f"备份校验失败: {name}")
+        return data
+
+    def restore(self, name, target):
+        """把快照原子写回 target，返回写入的字节数"""
+        data = self.read_snapshot(name)
+        atomic_rewrite(target, data)
+        return len(data)
+
+    def prune(self, keep=None, max_age_days=None, session_id=None):
+        """按保留策略删除旧快照（每个会话保留最近 keep 个 / 删除超过 max_age_days 天的），
+        然后清理不再被引用的分块。最新的快照总是保留。返回删除的快照数。
+        """
+        removed = 0
+        now = time.time()
+        with self.lock:
+            by_session = {}
+            for manifest in self.list_snapshots(session_id):
+                by_session.setdefault(manifest.get('session'), []).append(manifest)
+            for manifests in by_session.values():
+                for position, manifest in enumerate(manifests):
+                    if position == 0:
+                        continue
+                    too_many = keep is not None and keep > 0 and position >= keep
+                    too_old = (max_age_days is not None and max_age_days > 0
+                               and now - manifest.get('created', now) > max_age_days * 86400)
+                    if too_many or too_old:
+                        try:
+                            os.remove(self.snapshot_dir / f"{manifest['name']}.json")
+                            removed += 1
+                        except OSError:
+                            pass
+            if removed:
+                self._collect_garbage()
+        return removed
+
+    def _collect_garbage(self):
+        """删除没有任何快照引用的分块（跳过临时文件和 GC_GRACE 秒内写入/复用过的分块）"""
+        referenced = set()
+        for manifest in self.list_snapshots():
+            referenced.update(chunk[0] for chunk in manifest['chunks'])
+        freed = 0
+        cutoff = time.time() - self.GC_GRACE
+        for path in self.chunk_dir.glob("*/*"):
+            if path.name.startswith('.') or path.name.endswith('.tmp'):
+                continue
+            if path.name.split('.')[0] not in referenced:
+                try:
+                    stat = path.stat()
+                    if stat.st_mtime > cutoff:
+                        continue
+                    os.remove(path)
+                    freed += stat.st_size
+                except OSError:
+                    pass
+        if freed:
+            print(f"[备份] 清理未引用分块 {freed} 字节")
+
+    def usage(self):
+        """(快照数, 分块占用字节数)"""
+        size = sum(p.stat().st_size for p in self.chunk_dir.glob("*/*")) if self.chunk_dir.exists() else 0
+        return len(self.list_snapshots()), size
+
+
+class JobCancelled(Exception):
+    """压缩任务已被取消或已超时"""
+
+
+class CompressionJob:
+    """一个压缩任务
+
+    state: queued（排队）/ running（执行中）/ done / failed / cancelled / timeout
+    任务函数 func(job) 应在耗时步骤之间（以及写入会话等副作用之前）调用 job.check()，取消或超时后尽快结束；
+    func 正常返回即为 done（副作用可能已经发生，不再按超时或取消处理）。
+    """
+
+    def __init__(self, key, func, timeout=None, on_done=None, name=""):
+        self.key = key
+        self.func = func
+        self.timeout = timeout
+        self.on_done = on_done
+        self.name = name
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.state in ('queued', 'running')
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def timed_out(self):
+        return (self.timeout is not None and self.started is not None
+                and time.time() - self.started > self.timeout)
+
+    def cancel(self):
+        """请求取消（排队中的任务不再执行，执行中的任务在下一个检查点结束）"""
+        self.cancel_event.set()
+
+    def check(self):
+        """检查点：已取消或超时则抛出 JobCancelled"""
+        if self.cancelled:
+            raise JobCancelled("任务已取消")
+        if self.timed_out():
+            raise JobCancelled(f"任务超时（{self.timeout}秒）")
+
+    def describe(self):
+        """任务状态的简短描述"""
+        labels = {
+            'queued': "排队中", 'running': "执行中", 'done': "已完成",
+            'failed': "失败", 'cancelled': "已取消", 'timeout': "已超时",
+        }
+        text = f"{self.name or '压缩任务'}{labels.get(self.state, self.state)}"
+        if self.state == 'running' and self.started:
+            text += f" {int(time.time() - self.started)}秒"
+        if self.state == 'failed' and self.error:
+            text += f": {self.error}"
+        return text
+
+
+class CompressionJobQueue:
+    """压缩任务队列 - 限制并发，防止任务堆积
+
+    - 同一个 key（会话）同时最多一个排队或执行中的任务，重复触发直接返回已有任务
+    - 最多 max_workers 个任务同时执行，排队任务超过 max_pending 时拒绝新任务
+    - 支持取消和超时，任务状态可随时查询
+    """
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = []       # 排队中的任务（先进先出）
+        self.active = {}        # key -> 排队或执行中的任务
+        self.last = {}          # key -> 最近一个任务（包括已结束的）
+        self.running = 0
+
+    def submit(self, key, func, timeout=None, on_done=None, name=""):
+        """提交任务
+
+        返回: (job, created) - 同一会话已有任务时返回已有任务且 created=False；
+              队列已满时返回 (None, False)
+        """
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None and job.active:
+                return job, False
+            if len(self.pending) >= self.max_pending:
+                return None, False
+            job = CompressionJob(key, func, timeout, on_done, name)
+            self.pending.append(job)
+            self.active[key] = job
+            self.last[key] = job
+            self._start_workers()
+            return job, True
+
+    def _start_workers(self):
+        while self.running < self.max_workers and self.pending:
+            job = self.pending.pop(0)
+            self.running += 1
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        while job is not None:
+            self._execute(job)
+            with self.lock:
+                if self.active.get(job.key) is job:
+                    del self.active[job.key]
+                job = self.pending.pop(0) if self.pending else None
+                if job is None:
+                    self.running -= 1
+
+    def _execute(self, job):
+        if job.cancelled:
+            job.state = 'cancelled'
+        else:
+            job.state = 'running'
+            job.started = time.time()
+            try:
+                job.result = job.func(job)
+                job.state = 'done'
+            except JobCancelled:
+                job.state = 'timeout' if job.timed_out() and not job.cancelled else 'cancelled'
+            except Exception as e:
+                job.error = str(e) if str(e) else "未知错误"
+                job.state = 'failed'
+                import traceback
+                traceback.print_exc()
+        job.finished = time.time()
+        if job.on_done:
+            try:
+                job.on_done(job)
+            except Exception as e:
+                print(f"[压缩任务] 完成回调出错: {e}")
+
+    def get(self, key):
+        """会话最近一个任务（没有则返回 None）"""
+        with self.lock:
+            return self.last.get(key)
+
+    def cancel(self, key=None):
+        """取消指定会话（key=None 时为全部）的排队和执行中任务"""
+        with self.lock:
+            jobs = [job for k, job in self.active.items() if key is None or k == key]
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def jobs(self):
+        """所有排队或执行中的任务"""
+        with self.lock:
+            return list(self.active.values())
@@ -0,0 +1,1579 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenClaw Token 会话引擎 - 与界面无关的核心流程
+配置读写、会话同步、记忆压缩、外部文件导入，以及无界面后台服务（asyncio）
+桌面查看器（OpenClawTokenViewer）和 CLI 的 daemon 命令共用这里的逻辑
+"""
+
+import asyncio
+import base64
+import json
+import os
+import re
+import signal
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from OpenClawTokenCore import (
+    FileTailer, ParsedSession, SessionsRegistry, token_counter, append_lines, atomic_rewrite,
+    BackupStore, SessionStatsCache, iter_lines_reversed, parse_session_line,
+    API_TEMPLATES, api_client, register_provider, requires_api_key, ProviderRegistry,
+    MapReduceSummarizer, SummaryCache, PartialResponse,
+    CompressionJobQueue, JobCancelled,
+    CHARACTER_ID, LONG_TERM_ID, MID_TERM_ID, MODE_MESSAGE_ID,
+)
+
+# 配置路径（可修改）
+OPENCLAW_DIR = Path.home() / ".openclaw"
+SESSIONS_DIR = OPENCLAW_DIR / "agents" / "main" / "sessions"
+SESSIONS_JSON = SESSIONS_DIR / "sessions.json"
+BACKUP_DIR = SESSIONS_DIR / "backups"
+SUMMARY_CACHE_DIR = OPENCLAW_DIR / "summary_cache"  # AI 摘要缓存
+STATS_CACHE_PATH = OPENCLAW_DIR / "session_stats_cache.json"  # 会话统计缓存（与 CLI 共用）
+DAEMON_LOCK_PATH = OPENCLAW_DIR / "token_daemon.lock"  # 后台服务锁文件（查看器据此避让）
+
+# 配置文件路径（可自定义）
+CONFIG_FILENAME = "token_viewer_config.json"  # 修改这里可更改配置文件名
+CONFIG_PATH = OPENCLAW_DIR / CONFIG_FILENAME
+
+def encode_key(key):
+    """简单编码 API key（非加密，只是防止明文）"""
+    return base64.b64encode(key.encode()).decode()
+
+def decode_key(encoded_key):
+    """解码 API key"""
+    try:
+        return base64.b64decode(encoded_key.encode()).decode()
+    except:
+        return ""
+
+# 默认配置常量 - 修改这里即可改变所有默认值
+DEFAULT_CONFIG = {
+    # API设置
+    'api_provider': 'moonshot',
+    'model': 'kimi-k2.5',
+    'api_key_encoded': '',
+    'api_max_retries': 4,         # 429/5xx/超时的最大重试次数（指数退避）
+    'api_rate_limit': 30,         # 每个服务商每分钟最多请求数（0 为不限）
+    'api_global_rate_limit': 60,  # 所有服务商合计每分钟最多请求数（多会话并发压缩时的总预算，0 为不限）
+    # 备用服务商（配置后压缩请求按延迟路由到最快的可用后端，失败自动切换）
+    # 每项: {"provider", "model", "api_key_encoded"}，自建接口再加 "url"（及可选 "models"/"needs_key"）
+    'api_backends': [],
+
+    # 压缩设置
+    'compress_mode': '长期模式',  # 默认模式：长期/中期/短期/吐槽/增量
+    'auto_compress_enabled': False,  # 默认关闭自动压缩
+    'auto_compress_interval': 300,  # 自动压缩间隔（秒）
+    'compress_job_timeout': 300,  # 单次压缩任务超时（秒）
+    'auto_compress_all_sessions': False,  # 后台服务自动压缩所有 agent 会话（关闭时只管理一个会话）
+    'auto_compress_parallelism': 2,  # 多会话自动压缩时同时执行的任务数
+    'silent_mode': False,  # 静默模式（关闭弹窗）
+    'stream_output': True,  # 流式输出（边生成边显示压缩结果）
+
+    # 文件监控设置
+    'file_monitor_enabled': False,
+    'file_monitor_path': '',  # 默认监控文件路径
+    'file_monitor_interval': 1.0,  # 监控频率（Hz）
+    'file_monitor_fsync': False,  # 导入后强制落盘（更安全，但高频导入时更慢）
+
+    # 备份设置（去重备份仓库，只保存变化的分块）
+    'backup_keep': 50,             # 每个会话最多保留的快照数（0 为不限）
+    'backup_max_age_days': 7,      # 删除超过天数的快照（0 为不限，最新快照总是保留）
+    'backup_compression': 'auto',  # 分块压缩：auto（有 zstandard 用 zstd，否则 gzip）/ zstd / gzip / none
+
+    # 阈值设置
+    'long_term_threshold': 5000,   # 长期记忆触发阈值（默认5000）
+    'mid_term_threshold': 2000,    # 中期记忆触发阈值（默认2000）
+    'short_term_keep': 5,          # 短期记忆保留条数
+    'min_message_count': 10,       # 自动压缩最小对话条数
+    'min_token_count': 20000,      # 自动压缩最小token数
+
+    # 分层摘要设置（历史过长时先分块并发摘要再合并）
+    'summary_chunk_tokens': 6000,  # 每块（每次请求）的 token 预算
+    'summary_workers': 4,          # 并发摘要的最大请求数
+    'summary_cache_enabled': True, # 缓存摘要结果（内容未变的分块不再重复请求）
+    'summary_cache_size_mb': 20,   # 摘要缓存大小上限（MB）
+
+    # Token计数设置
+    'token_counter_backend': 'approx',  # 分词后端：approx（离线近似）/ tiktoken
+
+    # 后台服务设置（OpenClawTokenCLI.py daemon）
+    'daemon_session': '',          # 后台服务管理的会话ID（空为 agent:main:main，没有则取第一个 agent 会话）
+
+    # UI设置
+    'auto_refresh_enabled': True,  # 默认开启自动刷新
+    'auto_refresh_interval': 1,    # 自动刷新间隔（秒）
+}
+
+class AICompressionConfig:
+    """AI 压缩配置 - 从DEFAULT_CONFIG加载默认值"""
+    def __init__(self):
+        # 从默认配置加载
+        self.enabled = False
+        self.api_provider = DEFAULT_CONFIG['api_provider']
+        self.api_url = API_TEMPLATES[DEFAULT_CONFIG['api_provider']]['url']
+        self.api_key_encoded = DEFAULT_CONFIG['api_key_encoded']
+        self.api_max_retries = DEFAULT_CONFIG['api_max_retries']
+        self.api_rate_limit = DEFAULT_CONFIG['api_rate_limit']
+        self.api_global_rate_limit = DEFAULT_CONFIG['api_global_rate_limit']
+        self.api_backends = list(DEFAULT_CONFIG['api_backends'])
+        self.model = DEFAULT_CONFIG['model']
+        self.compress_mode = DEFAULT_CONFIG['compress_mode']
+        self.auto_compress_enabled = DEFAULT_CONFIG['auto_compress_enabled']
+        self.auto_compress_interval = DEFAULT_CONFIG['auto_compress_interval']
+        self.compress_job_timeout = DEFAULT_CONFIG['compress_job_timeout']
+        self.auto_compress_all_sessions = DEFAULT_CONFIG['auto_compress_all_sessions']
+        self.auto_compress_parallelism = DEFAULT_CONFIG['auto_compress_parallelism']
+        self.silent_mode = DEFAULT_CONFIG['silent_mode']
+        self.stream_output = DEFAULT_CONFIG['stream_output']
+        # 文件监控配置
+        self.file_monitor_enabled = DEFAULT_CONFIG['file_monitor_enabled']
+        self.file_monitor_path = DEFAULT_CONFIG['file_monitor_path']
+        self.file_monitor_interval = DEFAULT_CONFIG['file_monitor_interval']
+        self.file_monitor_fsync = DEFAULT_CONFIG['file_monitor_fsync']
+        # 备份配置
+        self.backup_keep = DEFAULT_CONFIG['backup_keep']
+        self.backup_max_age_days = DEFAULT_CONFIG['backup_max_age_days']
+        self.backup_compression = DEFAULT_CONFIG['backup_compression']
+        # 阈值配置
+        self.long_term_threshold = DEFAULT_CONFIG['long_term_threshold']  # 5000
+        self.mid_term_threshold = DEFAULT_CONFIG['mid_term_threshold']    # 2000
+        self.short_term_keep = DEFAULT_CONFIG['short_term_keep']
+        self.min_message_count = DEFAULT_CONFIG['min_message_count']
+        self.min_token_count = DEFAULT_CONFIG['min_token_count']
+        # 分层摘要配置
+        self.summary_chunk_tokens = DEFAULT_CONFIG['summary_chunk_tokens']
+        self.summary_workers = DEFAULT_CONFIG['summary_workers']
+        self.summary_cache_enabled = DEFAULT_CONFIG['summary_cache_enabled']
+        self.summary_cache_size_mb = DEFAULT_CONFIG['summary_cache_size_mb']
+        # Token计数配置
+        self.token_counter_backend = DEFAULT_CONFIG['token_counter_backend']
+        # 后台服务配置
+        self.daemon_session = DEFAULT_CONFIG['daemon_session']
+        # UI设置
+        self.auto_refresh_enabled = DEFAULT_CONFIG['auto_refresh_enabled']
+        self.auto_refresh_interval = DEFAULT_CONFIG['auto_refresh_interval']
+        # 压缩提示词
+        self.compression_prompt = """请将以下对话历史压缩为关键信息摘要。要求：
+1. 低失真，保留重要决策、代码变更和关键上下文
+2. 纯文本输出，不要Markdown格式
+3. 少用符号，避免特殊字符
+4. 不要分段，用逗号或分号连接
+5. 字数越多越好，尽量详细，控制在8000字以内
+6. 保留完整的技术细节和决策依据
+
+内容："""
+        # 吐槽模式提示词
+        self.tsukkomi_prompt = """请对以下对话历史进行吐槽，指出其中的问题、矛盾或有趣的地方。用轻松幽默的语气，直接输出吐槽内容，不要加标题或前缀：
+
+内容："""
+
+    def to_dict(self):
+        return {
+            'enabled': self.enabled,
+            'api_provider': self.api_provider,
+            'api_url': self.api_url,
+            'api_key_encoded': self.api_key_encoded,
+            'api_max_retries': self.api_max_retries,
+            'api_rate_limit': self.api_rate_limit,
+            'api_global_rate_limit': self.api_global_rate_limit,
+            'api_backends': self.api_backends,
+            'model': self.model,
+            'compress_mode': self.compress_mode,
+            'auto_compress_enabled': self.auto_compress_enabled,
+            'auto_compress_interval': self.auto_compress_interval,
+            'compress_job_timeout': self.compress_job_timeout,
+            'auto_compress_all_sessions': self.auto_compress_all_sessions,
+            'auto_compress_parallelism': self.auto_compress_parallelism,
+            'silent_mode': self.silent_mode,
+            'stream_output': self.stream_output,
+            'file_monitor_enabled': self.file_monitor_enabled,
+            'file_monitor_path': self.file_monitor_path,
+            'file_monitor_interval': self.file_monitor_interval,
+            'file_monitor_fsync': self.file_monitor_fsync,
+            'backup_keep': self.backup_keep,
+            'backup_max_age_days': self.backup_max_age_days,
+            'backup_compression': self.backup_compression,
+            'long_term_threshold': self.long_term_threshold,
+            'mid_term_threshold': self.mid_term_threshold,
+            'short_term_keep': self.short_term_keep,
+            'min_message_count': self.min_message_count,
+            'min_token_count': self.min_token_count,
+            'summary_chunk_tokens': self.summary_chunk_tokens,
+            'summary_workers': self.summary_workers,
+            'summary_cache_enabled': self.summary_cache_enabled,
+            'summary_cache_size_mb': self.summary_cache_size_mb,
+            'token_counter_backend': self.token_counter_backend,
+            'daemon_session': self.daemon_session,
+            'compression_prompt': self.compression_prompt,
+            'tsukkomi_prompt': self.tsukkomi_prompt,
+            'auto_refresh_enabled': self.auto_refresh_enabled,
+            'auto_refresh_interval': self.auto_refresh_interval
+        }
+
+    def from_dict(self, d):
+        self.enabled = d.get('enabled', False)
+        self.api_provider = d.get('api_provider', 'moonshot')
+        self.api_url = d.get('api_url', API_TEMPLATES['moonshot']['url'])
+        self.api_key_encoded = d.get('api_key_encoded', "")
+        self.api_max_retries = d.get('api_max_retries', DEFAULT_CONFIG['api_max_retries'])
+        self.api_rate_limit = d.get('api_rate_limit', DEFAULT_CONFIG['api_rate_limit'])
+        self.api_global_rate_limit = d.get('api_global_rate_limit', DEFAULT_CONFIG['api_global_rate_limit'])
+        self.api_backends = d.get('api_backends', list(DEFAULT_CONFIG['api_backends']))
+        self.model = d.get('model', 'kimi-k2.5')
+        self.compress_mode = d.get('compress_mode', '长期模式')
+        self.auto_compress_enabled = d.get('auto_compress_enabled', False)
+        self.auto_compress_interval = d.get('auto_compress_interval', 300)
+        self.compress_job_timeout = d.get('compress_job_timeout', DEFAULT_CONFIG['compress_job_timeout'])
+        self.auto_compress_all_sessions = d.get('auto_compress_all_sessions', DEFAULT_CONFIG['auto_compress_all_sessions'])
+        self.auto_compress_parallelism = d.get('auto_compress_parallelism', DEFAULT_CONFIG['auto_compress_parallelism'])
+        self.silent_mode = d.get('silent_mode', False)
+        self.stream_output = d.get('stream_output', DEFAULT_CONFIG['stream_output'])
+        self.file_monitor_enabled = d.get('file_monitor_enabled', False)
+        self.file_monitor_path = d.get('file_monitor_path', "")
+        self.file_monitor_interval = d.get('file_monitor_interval', 1.0)
+        self.file_monitor_fsync = d.get('file_monitor_fsync', DEFAULT_CONFIG['file_monitor_fsync'])
+        self.backup_keep = d.get('backup_keep', DEFAULT_CONFIG['backup_keep'])
+        self.backup_max_age_days = d.get('backup_max_age_days', DEFAULT_CONFIG['backup_max_age_days'])
+        self.backup_compression = d.get('backup_compression', DEFAULT_CONFIG['backup_compression'])
+        self.long_term_threshold = d.get('long_term_threshold', DEFAULT_CONFIG['long_term_threshold'])
+        self.mid_term_threshold = d.get('mid_term_threshold', DEFAULT_CONFIG['mid_term_threshold'])
+        self.short_term_keep = d.get('short_term_keep', DEFAULT_CONFIG['short_term_keep'])
+        self.min_message_count = d.get('min_message_count', DEFAULT_CONFIG['min_message_count'])
+        self.min_token_count = d.get('min_token_count', DEFAULT_CONFIG['min_token_count'])
+        self.summary_chunk_tokens = d.get('summary_chunk_tokens', DEFAULT_CONFIG['summary_chunk_tokens'])
+        self.summary_workers = d.get('summary_workers', DEFAULT_CONFIG['summary_workers'])
+        self.summary_cache_enabled = d.get('summary_cache_enabled', DEFAULT_CONFIG['summary_cache_enabled'])
+        self.summary_cache_size_mb = d.get('summary_cache_size_mb', DEFAULT_CONFIG['summary_cache_size_mb'])
+        self.token_counter_backend = d.get('token_counter_backend', DEFAULT_CONFIG['token_counter_backend'])
+        self.daemon_session = d.get('daemon_session', DEFAULT_CONFIG['daemon_session'])
+        self.compression_prompt = d.get('compression_prompt', self.compression_prompt)
+        self.auto_refresh_enabled = d.get('auto_refresh_enabled', DEFAULT_CONFIG['auto_refresh_enabled'])
+        self.auto_refresh_interval = d.get('auto_refresh_interval', DEFAULT_CONFIG['auto_refresh_interval'])
+        self.tsukkomi_prompt = d.get('tsukkomi_prompt', self.tsukkomi_prompt)
+
+    def get_api_key(self):
+        """获取解码后的 API key"""
+        return decode_key(self.api_key_encoded)
+
+    def set_api_key(self, key):
+        """设置并编码 API key"""
+        self.api_key_encoded = encode_key(key)
+
+
+def load_config(config=None, path=CONFIG_PATH):
+    """从配置文件加载（文件不存在或无法解析时保留默认值）"""
+    config = config or AICompressionConfig()
+    path = Path(path)
+    if path.exists():
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config.from_dict(json.load(f))
+        except:
+            pass
+    return config
+
+
+def save_config(config, path=CONFIG_PATH):
+    """保存配置到文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+def apply_config(config):
+    """把配置应用到共享的分词器、API 客户端和服务商表"""
+    token_counter.set_backend(config.token_counter_backend)
+    api_client.configure(max_retries=config.api_max_retries,
+                         rate_per_minute=config.api_rate_limit,
+                         global_rate_per_minute=config.api_global_rate_limit)
+    register_custom_providers(config)
+
+
+def register_custom_providers(config):
+    """注册备用服务商中配置了 url 的自建接口"""
+    for backend in config.api_backends:
+        if backend.get('url') and backend.get('provider'):
+            register_provider(backend['provider'], backend['url'],
+                              backend.get('models') or [backend.get('model', '')],
+                              backend.get('headers'), backend.get('needs_key', True))
+
+
+# ========== 消息与记忆结构 ==========
+
+def extract_message_text(msg_data):
+    """从消息数据中提取文本"""
+    msg = msg_data.get('message', {})
+    content = msg.get('content', [])
+    if content and isinstance(content, list):
+        for item in content:
+            if isinstance(item, dict) and item.get('type') == 'text':
+                return item.get('text', '')
+    return ''
+
+
+def create_memory_message(msg_id, text, role='assistant'):
+    """创建记忆消息（默认role=assistant，让AI助手能读取）"""
+    return {
+        "type": "message",
+        "id": msg_id,
+        "timestamp": datetime.now().isoformat() + "Z",
+        "message": {
+            "role": role,
+            "content": [{"type": "text", "text": text}]
+        }
+    }
+
+
+def is_ai_outputting(records):
+    """检查AI是否正在输出（近10秒内有assistant消息且id非extern）
+
+    records 为会话末尾的解析记录（只检查最近10条），用于避免在AI输出期间触发自动压缩
+    """
+    current_time = time.time()
+
+    # 检查最近的消息
+    for record in reversed(records[-10:]):
+        if record['type'] == 'message':
+            # 如果是assistant角色且id非extern
+            if record['role'] == 'assistant' and not record['id'].startswith('extern'):
+                # 解析时间戳
+                try:
+                    msg_time = datetime.fromisoformat(record['timestamp'].replace('Z', '+00:00'))
+                    # 如果在近10秒内
+                    if current_time - msg_time.timestamp() < 10:
+                        return True
+                except:
+                    pass
+
+    return False
+
+
+def tail_records(path, count=10):
+    """从文件末尾读取最近 count 行的解析记录（按文件顺序，不加载整个会话）"""
+    lines = []
+    for line in iter_lines_reversed(path):
+        if line.strip():
+            lines.append(line.decode('utf-8', errors='ignore'))
+            if len(lines) >= count:
+                break
+    return [parse_session_line(0, line) for line in reversed(lines)]
+
+
+def pick_effective_tokens(state, estimated_tokens, registry, session_id):
+    """有效Token数的选择策略
+
+    - 压缩后30秒内：使用拟合Token
+    - 30秒后：如果官方Token更新了，使用官方Token
+
+    state 需有 last_compression_time / official_tokens / use_official_tokens 属性
+    （查看器和 SessionEngine 各自保存），选择结果会更新到 state 上。
+    """
+    # 压缩后30秒内，使用拟合Token
+    if time.time() - state.last_compression_time < 30:
+        state.use_official_tokens = False
+        return estimated_tokens
+
+    # 30秒后，尝试使用官方Token
+    try:
+        value = registry.get(session_id)
+        if value:
+            official = value.get('totalTokens', 0)
+            # 如果官方Token变化了，说明已更新
+            if official != state.official_tokens and official > 0:
+                state.official_tokens = official
+                state.use_official_tokens = True
+    except:
+        pass
+
+    # 如果官方数据可用且已更新，使用官方；否则使用拟合
+    if state.use_official_tokens and state.official_tokens > 0:
+        return state.official_tokens
+    return estimated_tokens
+
+
+def evaluate_compression_conditions(total_tokens, message_count, config):
+    """检查是否满足自动压缩条件（与关系：同时满足才触发）
+    返回: (是否满足, 原因)
+    """
+    min_tokens = config.min_token_count
+    min_messages = config.min_message_count
+
+    token_ok = total_tokens >= min_tokens
+    msg_ok = message_count >= min_messages
+
+    if not token_ok and not msg_ok:
+        return False, f"Token {total_tokens}/{min_tokens}，对话 {message_count}/{min_messages}，均未满足"
+    elif not token_ok:
+        return False, f"Token {total_tokens} < {min_tokens}，对话 {message_count} 已满足"
+    elif not msg_ok:
+        return False, f"Token {total_tokens} 已满足，对话 {message_count} < {min_messages}"
+
+    return True, f"条件满足：Token {total_tokens}/{min_tokens}，对话 {message_count}/{min_messages}"
+
+
+def update_session_tokens(registry, session_id, estimated_tokens):
+    """压缩后更新 sessions.json 中的 token 统计（只更新 agent: 开头的会话）"""
+    if not registry.path.exists():
+        return
+    data = registry.snapshot()
+    key = registry.key_by_session_id.get(session_id)
+    if key and key.startswith("agent:"):
+        value = data[key]
+        # 更新 token 数（取估计值和原值的较小者，避免过度估算）
+        old_tokens = value.get('totalTokens', 0)
+        new_tokens = min(estimated_tokens, old_tokens) if old_tokens > 0 else estimated_tokens
+        value['totalTokens'] = new_tokens
+        value['inputTokens'] = int(new_tokens * 0.7)  # 估算输入占 70%
+        value['outputTokens'] = int(new_tokens * 0.3)  # 估算输出占 30%
+        registry.save(data)
+
+
+# ========== 压缩流程 ==========
+
+class CompressionClient:
+    """压缩请求 - 摘要缓存 + 多服务商路由 + 流式回调 + 分层摘要
+
+    summary_cache 和 provider_registry 跨多次压缩保留；
+    服务商、模型和 Key 由调用方传入（界面取自输入框，后台服务取自配置）。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.provider_registry = ProviderRegistry()  # 各后端的延迟/错误率统计
+        self.summary_cache = SummaryCache(SUMMARY_CACHE_DIR, config.summary_cache_size_mb * 1024 * 1024)
+
+    def configure(self, config):
+        """配置重新加载后更新（摘要缓存上限立即生效，已有缓存和后端统计保留）"""
+        self.config = config
+        self.summary_cache.set_max_bytes(config.summary_cache_size_mb * 1024 * 1024)
+
+    def build_backends(self, provider, model, api_key):
+        """压缩使用的后端列表：当前选择的服务商 + 配置的备用服务商"""
+        backends = [{'provider': provider, 'model': model, 'api_key': api_key}]
+        for backend in self.config.api_backends:
+            name = backend.get('provider')
+            if name not in API_TEMPLATES:
+                continue
+            backends.append({
+                'provider': name,
+                'model': backend.get('model') or API_TEMPLATES[name]['models'][0],
+                'api_key': decode_key(backend.get('api_key_encoded', '')),
+            })
+        return backends
+
+    def summarize_many(self, contents, provider, model, api_key, on_delta=None):
+        """并发调用 AI 压缩多段内容，按顺序返回结果（总耗时约为一次往返）
+
+        提供 on_delta(index, text) 时使用流式输出，各段内容边生成边回调；
+        传输中途断开时返回已收到的部分，仍可用于应用压缩。
+        开启摘要缓存时，(提示词, 模型, 内容) 相同的请求直接复用上次的结果。
+        配置了备用服务商时，每段请求路由到延迟最低的可用后端，失败自动切换。
+        """
+        if not api_key and requires_api_key(provider):
+            raise Exception("未设置 API Key")
+        compression_prompt = self.config.compression_prompt
+
+        # 查缓存，只请求未命中的部分
+        results = [None] * len(contents)
+        keys = [None] * len(contents)
+        if self.config.summary_cache_enabled:
+            for i, content in enumerate(contents):
+                keys[i] = SummaryCache.make_key(compression_prompt, model, content)
+                results[i] = self.summary_cache.get(keys[i])
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) < len(contents):
+            print(f"[摘要缓存] 命中 {len(contents) - len(missing)}/{len(contents)}")
+
+        prompts = [f"""{compression_prompt}
+
+{contents[i]}""" for i in missing]
+
+        backends = self.build_backends(provider, model, api_key)
+        routed = len(backends) > 1
+        if routed:
+            self.provider_registry.set_backends(backends)
+
+        if on_delta:
+            for i, result in enumerate(results):
+                if result is not None:
+                    on_delta(i, result)
+            callback = lambda j, text: on_delta(missing[j], text)
+            if routed:
+                texts = api_client.chat_routed_many(self.provider_registry, prompts, callback,
+                                                    stream=True)
+            else:
+                texts = api_client.stream_many(provider, api_key, model, prompts, callback)
+        elif routed:
+            texts = api_client.chat_routed_many(self.provider_registry, prompts)
+        else:
+            texts = api_client.chat_many(provider, api_key, model, prompts)
+
+        for i, text in zip(missing, texts):
+            results[i] = text
+            # 不完整或空的回复不缓存
+            if keys[i] and text != "(无回复)" and not isinstance(text, PartialResponse):
+                self.summary_cache.put(keys[i], text)
+        return results
+
+    def condense(self, texts, summarize):
+        """把对话历史压到一次请求的预算内
+
+        不超过 summary_chunk_tokens 时原样拼接；否则按预算分块，
+        并发摘要各块（最多 summary_workers 个请求）后再合并（map-reduce）。
+        summarize(content) 返回单段内容的摘要。
+        """
+        summarizer = MapReduceSummarizer(summarize,
+                                         chunk_tokens=self.config.summary_chunk_tokens,
+                                         max_workers=self.config.summary_workers)
+        return summarizer.condense(texts)
+
+
+def build_incremental_plan(memory, condense):
+    """增量压缩：找出上次压缩之后的新对话，构建长期/中期记忆的请求内容
+
+    高水位标记记录在长期记忆消息的 foldedUntil 字段（上次合并进记忆的最后一条消息 id）。
+    只发送已有长期记忆 + 标记之后的消息，请求大小不随会话变长而增长。
+    没有标记时（旧文件或首次压缩）从长期记忆之后开始，没有长期记忆则使用全部短期记忆。
+
+    返回: {'long', 'mid', 'folded_until', 'count'}，没有新增对话时返回 None
+    """
+    long_record = memory['long_term']
+    shorts = memory['short_terms']
+    old_long = ""
+    if long_record:
+        old_long = extract_message_text(long_record['data'])
+        # 长期记忆之后的消息才可能是新对话
+        shorts = [short for short in shorts if short['index'] > long_record['index']]
+        mark = long_record['data'].get('foldedUntil')
+        if mark:
+            for pos, short in enumerate(shorts):
+                if short['id'] == mark:
+                    shorts = shorts[pos + 1:]
+                    break
+
+    new_shorts = []
+    for short in shorts:
+        text = extract_message_text(short['data'])
+        if text and len(text) > 10:
+            new_shorts.append((short['id'], text))
+    if not new_shorts:
+        return None
+
+    new_texts = [text for _, text in new_shorts]
+    history_text = condense(new_texts)
+    if old_long:
+        long_content = (f"【已有长期记忆】\n{old_long}\n\n"
+                        f"【新增对话】（请将新增对话合并进已有长期记忆，输出完整的新长期记忆）\n\n{history_text}")
+    else:
+        long_content = f"【对话历史】\n\n{history_text}"
+    mid_content = f"【最近对话历史】\n\n{condense(new_texts[-10:])}"
+
+    return {
+        'long': long_content,
+        'mid': mid_content,
+        'folded_until': new_shorts[-1][0] or None,
+        'count': len(new_shorts),
+    }
+
+
+# 自动压缩支持的模式；界面默认的"正常模式"（压缩全部对话）按长期模式执行，同时生成长期和中期记忆
+AUTO_COMPRESS_MODES = ('增量模式', '长期模式', '中期模式', '吐槽模式')
+AUTO_COMPRESS_MODE_ALIASES = {'正常模式': '长期模式'}
+
+
+def compress_memory(memory, mode, config, summarize_many, condense):
+    """按模式生成新的长期/中期记忆（自动压缩的后台步骤，不读写会话文件）
+
+    summarize_many(contents, labels) 并发请求多段内容，condense(texts) 把历史压到一次请求的预算内。
+    返回: (new_long_text, new_mid_text, folded_until)；没有可压缩的对话时返回 None
+    不支持的模式抛出异常（不当作"没有新增对话"跳过）
+    """
+    mode = AUTO_COMPRESS_MODE_ALIASES.get(mode, mode)
+    if mode not in AUTO_COMPRESS_MODES:
+        raise Exception(f"自动压缩不支持的模式: {mode}")
+
+    # 提取长期和中期记忆内容
+    long_content = ""
+    if memory['long_term']:
+        long_content = extract_message_text(memory['long_term']['data'])
+
+    mid_content = ""
+    if memory['mid_term']:
+        mid_content = extract_message_text(memory['mid_term']['data'])
+
+    # 收集短期记忆内容（完整保留，过长时分层摘要）
+    short_contents = []
+    for short in memory['short_terms']:
+        text = extract_message_text(short['data'])
+        if text and len(text) > 10:
+            short_contents.append(text)
+
+    if not short_contents:
+        return None
+
+    folded_until = None  # 本次合并进记忆的最后一条消息（增量模式）
+
+    if mode == '增量模式':
+        # 增量模式：只发送已有长期记忆 + 上次压缩之后的新对话
+        plan = build_incremental_plan(memory, condense)
+        if not plan:
+            return None
+        new_long_text, new_mid_text = summarize_many(
+            [plan['long'], plan['mid']], ["【新的长期记忆】", "【新的中期记忆】"])
+        folded_until = plan['folded_until']
+
+    elif mode == '长期模式':
+        # 长期模式：全部短期记忆分层摘要后作为新的长期记忆
+        # 不传入旧的长期记忆内容，避免累积
+        history_text = condense(short_contents)
+        combined_prompt = f"{config.compression_prompt}\n\n【对话历史】\n\n{history_text}"
+
+        # 中期记忆使用最近10条单独压缩
+        recent_history = condense(short_contents[-10:])
+        mid_prompt = f"{config.compression_prompt}\n\n【最近对话历史】\n\n{recent_history}"
+
+        # 长期和中期两个请求并发执行
+        new_long_text, new_mid_text = summarize_many(
+            [combined_prompt, mid_prompt], ["【新的长期记忆】", "【新的中期记忆】"])
+
+    elif mode == '中期模式':
+        new_long_text = long_content if long_content else "（无长期记忆）"
+
+        recent_history = condense(short_contents[-10:])
+        mid_prompt = f"{config.compression_prompt}\n\n【最近对话历史】\n\n{recent_history}"
+        new_mid_text = summarize_many([mid_prompt], ["【新的中期记忆】"])[0]
+
+    else:  # 吐槽模式
+        new_long_text = long_content if long_content else "（无长期记忆）"
+        new_mid_text = mid_content if mid_content else "（无中期记忆）"
+
+    return new_long_text, new_mid_text, folded_until
+
+
+def build_compressed_lines(session, all_lines, new_long_text, new_mid_text, recent_shorts,
+                           mode_content=None, folded_until=None):
+    """构建压缩后的会话文件内容
+
+    首次：第一个user的位置替换为compact标记；后续：从compact标记开始替换。
+    之后依次是长期记忆、中期记忆、recent_shorts（保留的短期记忆），
+    吐槽模式再追加 mode_content（baizhi21）。
+    folded_until: 已合并进记忆的最后一条消息 id（增量模式的高水位标记），
+                  记录在长期记忆消息的 foldedUntil 字段中
+
+    返回新的行列表；首次压缩但没有user消息时返回 None
+    """
+    new_lines = []
+    compact_index = session.compact_index
+
+    if compact_index == -1:
+        # 首次压缩：找到第一个user，将其位置替换为compact标记
+        first_user_index = session.first_user_index
+        if first_user_index == -1:
+            return None
+        # 保留第一个user之前的所有行
+        new_lines.extend(all_lines[:first_user_index])
+    else:
+        # 后续压缩：保留compact标记之前的所有行
+        new_lines.extend(all_lines[:compact_index])
+
+    # 找到最后一个保留的message的id作为compact的parentId
+    last_retained_msg_id = session.last_message_id_before(len(new_lines))
+
+    # 创建 compact 标记消息（包含 summary 字段作为标识符）
+    compact_msg = create_memory_message(CHARACTER_ID, "===COMPACT===\nsummary: AI总结占位")
+    compact_msg['summary'] = "AI总结占位"  # 添加标识字段
+    compact_msg['parentId'] = last_retained_msg_id
+    new_lines.append(json.dumps(compact_msg, ensure_ascii=False) + "\n")
+
+    # 添加 baizhi52 长期记忆
+    long_msg = create_memory_message(LONG_TERM_ID, new_long_text)
+    long_msg['parentId'] = CHARACTER_ID
+    if folded_until:
+        long_msg['foldedUntil'] = folded_until
+    new_lines.append(json.dumps(long_msg, ensure_ascii=False) + "\n")
+
+    # 添加 baizhi20 中期记忆
+    mid_msg = create_memory_message(MID_TERM_ID, new_mid_text)
+    mid_msg['parentId'] = LONG_TERM_ID
+    new_lines.append(json.dumps(mid_msg, ensure_ascii=False) + "\n")
+
+    last_short_id = None
+    for i, short in enumerate(recent_shorts):
+        short_data = short['data'].copy()
+        if i == 0:
+            # 第一条短期记忆的parentId指向中期记忆
+            short_data['parentId'] = MID_TERM_ID
+        new_lines.append(json.dumps(short_data, ensure_ascii=False) + "\n")
+        last_short_id = short_data.get('id')
+
+    # 只有吐槽模式才添加第6条（baizhi21）
+    if mode_content:
+        mode_msg = create_memory_message(MODE_MESSAGE_ID, mode_content)
+        mode_msg['parentId'] = last_short_id or MID_TERM_ID
+        new_lines.append(json.dumps(mode_msg, ensure_ascii=False) + "\n")
+
+    return new_lines
+
+
+# ========== 外部文件导入 ==========
+
+class ExternalFileReader:
+    """外部监控文件的增量读取状态（按字节偏移只读新增内容）"""
+
+    def __init__(self):
+        self.tailer = FileTailer()
+        self.line_count = 0  # 已读取的非空行数（用于生成外部消息ID）
+
+    def reset(self, path=None):
+        """清空读取状态（下次读取时从头导入）"""
+        self.tailer.reset(path or None)
+        self.line_count = 0
+
+    def read_lines(self, file_path):
+        """读取新增的非空行
+
+        文件被轮转（替换）或截断时从头读取新文件。
+        返回: (new_lines, start_index)
+        """
+        tailer = self.tailer
+        if tailer.path != Path(file_path):
+            # 监控文件已更换
+            self.reset(file_path)
+
+        had_read = tailer.inode is not None
+        mode, lines = tailer.poll()
+        if mode == 'reload':
+            if had_read:
+                print(f"[文件监控] 文件被轮转或截断，从头读取")
+            self.line_count = 0
+
+        start_index = self.line_count
+        new_lines = [line.strip() for line in lines if line.strip()]
+        self.line_count += len(new_lines)
+        return new_lines, start_index
+
+
+def extract_timestamp(line):
+    """从行中提取时间戳"""
+    patterns = [
+        r'(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)',
+        r'\[(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)[^\]]*\]',
+        r'm:\[(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)[^\]]*\]',
+    ]
+
+    for pattern in patterns:
+        match = re.search(pattern, line)
+        if match:
+            ts_str = match.group(1)
+            try:
+                return datetime.fromisoformat(ts_str.replace('Z', '+00:00').replace(' ', 'T'))
+            except:
+                try:
+                    return datetime.strptime(ts_str, '%Y-%m-%d %H:%M:%S')
+                except:
+                    pass
+    return None
+
+
+def remove_timestamp(line):
+    """移除行中的时间戳，只保留内容
+
+    支持的时间戳格式：
+    - 2024-01-01 12:00:00.123
+    - 2024-01-01T12:00:00.123
+    - [2024-01-01 12:00:00]
+    - m:[2024-01-01 12:00:00]
+    """
+    # 匹配常见时间戳格式
+    patterns = [
+        r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?\s*',  # 2024-01-01 12:00:00.123
+        r'^\[\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?\]\s*',  # [2024-01-01 12:00:00]
+        r'^m:\[\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?[^\]]*\]\s*',  # m:[2024-01-01 12:00:00 GMT+8]
+    ]
+
+    for pattern in patterns:
+        line = re.sub(pattern, '', line)
+
+    return line.strip()
+
+
+def wrap_external_message(data, line_index=0):
+    """将外部数据包装成标准message格式（外部文件保持toolResult）
+
+    Args:
+        data: 可以是字符串或字典
+        line_index: 行号，用于生成唯一ID
+    """
+    if isinstance(data, dict):
+        content = data.get('content', data.get('text', str(data)))
+        role = data.get('role', 'toolResult')  # 外部文件保持toolResult
+    else:
+        content = str(data)
+        role = 'toolResult'  # 外部文件保持toolResult
+
+    # 使用简洁的ID格式：extern + 序号
+    msg_id = f"extern{line_index:04d}"
+
+    return {
+        "type": "message",
+        "id": msg_id,
+        "timestamp": datetime.now().isoformat() + "Z",
+        "message": {
+            "role": role,
+            "content": [{"type": "text", "text": content}]
+        }
+    }
+
+
+def merge_messages_by_time_window(lines, start_index=0, window_seconds=5):
+    """双5秒合并策略：本地5秒+时间戳5秒，去除重复内容
+
+    合并规则：
+    1. 去重：基于内容（去掉时间戳后）去重
+    2. 双5秒：满足任一条件即合并
+       - 本地5秒：相邻行索引差 <= 10（假设每秒2条）
+       - 时间戳5秒：时间戳差值 <= 5秒
+    3. 上限：每批最多10条
+
+    Args:
+        lines: 消息行列表
+        start_index: 起始行号（用于生成ID）
+        window_seconds: 时间窗口大小（秒），默认5
+
+    Returns:
+        合并后的消息列表
+    """
+    if not lines:
+        return []
+
+    # 解析每行的时间戳和内容
+    parsed_lines = []
+    for i, line in enumerate(lines):
+        parsed_lines.append({
+            'original': line,
+            'timestamp': extract_timestamp(line),
+            'content': remove_timestamp(line),
+            'index': i
+        })
+
+    # 去重：基于内容（去掉时间戳后）
+    seen_contents = set()
+    unique_lines = []
+    for pl in parsed_lines:
+        content_key = pl['content'].strip()
+        if content_key and content_key not in seen_contents:
+            seen_contents.add(content_key)
+            unique_lines.append(pl)
+
+    if not unique_lines:
+        return []
+
+    # 如果只有一行，直接返回
+    if len(unique_lines) == 1:
+        return [wrap_external_message(unique_lines[0]['original'], start_index)]
+
+    # 双5秒合并策略
+    merged = []
+    current_batch = [unique_lines[0]]
+    current_start_idx = start_index
+
+    for i in range(1, len(unique_lines)):
+        current_line = unique_lines[i]
+        first_line = current_batch[0]
+
+        # 本地5秒：索引差 <= 10（假设每秒2条，5秒=10条）
+        index_diff = current_line['index'] - first_line['index']
+        local_window_ok = (index_diff <= 10)
+
+        # 时间戳5秒
+        timestamp_window_ok = False
+        if first_line['timestamp'] and current_line['timestamp']:
+            time_diff = (current_line['timestamp'] - first_line['timestamp']).total_seconds()
+            timestamp_window_ok = (time_diff <= window_seconds)
+
+        # 双5秒：满足任一条件即可合并；如果在任一窗口内且批次未满10条，加入当前批次
+        if (local_window_ok or timestamp_window_ok) and len(current_batch) < 10:
+            current_batch.append(current_line)
+        else:
+            # 合并当前批次
+            merged_content = "\n".join([cl['original'] for cl in current_batch])
+            merged.append(wrap_external_message(merged_content, current_start_idx))
+
+            # 开始新批次
+            current_batch = [current_line]
+            current_start_idx = start_index + current_line['index']
+
+    # 处理最后一批
+    if current_batch:
+        merged_content = "\n".join([cl['original'] for cl in current_batch])
+        merged.append(wrap_external_message(merged_content, current_start_idx))
+
+    return merged
+
+
+def external_message_lines(messages, last_parent_id=None):
+    """外部消息转为待追加的 jsonl 行（第一条接在会话最后一条消息之后）"""
+    new_lines = []
+    for i, msg in enumerate(messages):
+        if i == 0 and last_parent_id:
+            msg['parentId'] = last_parent_id
+        new_lines.append(json.dumps(msg, ensure_ascii=False) + "\n")
+    return new_lines
+
+
+# ========== 无界面会话引擎 ==========
+
+class SessionEngine:
+    """单个会话的无界面状态：增量同步、有效Token、压缩条件、应用压缩、追加外部消息
+
+    不是线程安全的：TokenDaemon 把所有读写会话状态的调用放在同一个线程里执行，
+    压缩任务线程只拿记忆结构的快照去请求 AI，应用结果时再交回这个线程。
+    """
+
+    def __init__(self, session_id, jsonl_path, registry, backup_store, config):
+        self.session_id = session_id
+        self.jsonl_path = Path(jsonl_path)
+        self.registry = registry
+        self.backup_store = backup_store
+        self.config = config
+        self.tailer = FileTailer(self.jsonl_path)
+        self.all_lines = []
+        self.session = ParsedSession()
+        # Token计算相关（同查看器：压缩后30秒内用拟合值）
+        self.last_compression_time = 0
+        self.official_tokens = 0
+        self.use_official_tokens = False
+
+    def sync(self):
+        """同步会话文件的变化（只追加时仅解析新增行），返回 None / 'append' / 'reload'"""
+        mode, lines = self.tailer.poll()
+        if mode == 'append':
+            self.all_lines.extend(lines)
+        elif mode == 'reload':
+            self.all_lines = lines
+        self.session.sync(mode, lines)
+        return mode
+
+    def rewrite(self, new_lines):
+        """原子改写会话文件（同步之后追加的行会被合并到新文件末尾）"""
+        base_size = self.tailer.offset if self.tailer.inode is not None else None
+        atomic_rewrite(self.jsonl_path, new_lines, base_size)
+        self.all_lines = list(new_lines)
+        self.tailer.reset()
+
+    def backup(self, label=""):
+        """备份会话文件到去重仓库，返回快照名（内容未变化时为 None）"""
+        if not self.jsonl_path.exists():
+            return None
+        name = self.backup_store.snapshot(self.jsonl_path, self.session_id, label)
+        self.backup_store.prune(self.config.backup_keep, self.config.backup_max_age_days, self.session_id)
+        return name
+
+    def effective_tokens(self):
+        """有效Token数（拟合值或已更新的官方值）"""
+        return pick_effective_tokens(self, self.session.estimated_tokens, self.registry, self.session_id)
+
+    def check_compression_conditions(self):
+        """检查是否满足自动压缩条件，返回 (是否满足, 原因)"""
+        try:
+            if self.jsonl_path.exists():
+                self.sync()
+            return evaluate_compression_conditions(self.effective_tokens(),
+                                                   self.session.dialog_message_count(), self.config)
+        except Exception as e:
+            return False, f"检查条件失败: {e}"
+
+    def snapshot_memory(self):
+        """记忆结构的快照（短期记忆列表为副本，可安全交给后台任务）"""
+        memory = self.session.memory_structure()
+        memory['short_terms'] = list(memory['short_terms'])
+        return memory
+
+    def apply_compression(self, new_long_text, new_mid_text, folded_until=None, mode=None):
+        """静默应用压缩结果，返回备份名；没有user消息无法压缩时返回 None"""
+        self.sync()
+        backup_name = self.backup("自动压缩")
+        memory = self.session.memory_structure()
+        mode_content = new_long_text if mode == '吐槽模式' else None
+        new_lines = build_compressed_lines(self.session, self.all_lines, new_long_text, new_mid_text,
+                                           memory['short_terms'][-5:], mode_content, folded_until)
+        if new_lines is None:
+            return None
+        self.rewrite(new_lines)
+        self.sync()
+        self.last_compression_time = time.time()
+        self.use_official_tokens = False
+        return backup_name
+
+    def release(self):
+        """释放已加载的会话内容（保留Token状态，下次同步时重新读取）"""
+        self.tailer.reset()
+        self.all_lines = []
+        self.session = ParsedSession()
+
+    def append_messages(self, messages, fsync=False):
+        """追加外部消息（O_APPEND，不改写已有内容），返回写入的字节数"""
+        if self.jsonl_path.exists():
+            self.sync()
+        new_lines = external_message_lines(messages, self.session.last_message_id)
+        written = append_lines(self.jsonl_path, new_lines, fsync=fsync)
+        self.sync()
+        return written
+
+
+# ========== 后台服务锁 ==========
+
+def _read_lock_file(path):
+    """锁文件内容（不检查心跳），无法读取时返回 None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+
+def claim_daemon_lock(info, path=DAEMON_LOCK_PATH):
+    """原子占用后台服务锁（O_CREAT|O_EXCL 创建），锁文件心跳超时（进程已退出）时接管
+
+    返回 None 表示占用成功；锁被正在运行的后台服务持有时返回它的信息。
+    同时启动的多个后台服务只有一个能创建成功；接管旧锁时先把它改名到本进程专用的文件名，
+    若改名拿到的其实是别的进程刚创建的新锁，则放回原处并放弃。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = json.dumps(dict(info, pid=os.getpid(), updated=time.time()), ensure_ascii=False)
+    for _ in range(3):
+        try:
+            fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            owner = read_daemon_lock(path)
+            if owner:
+                return owner
+            grabbed = path.with_name(f".{path.name}.{os.getpid()}.stale")
+            try:
+                os.replace(path, grabbed)
+            except FileNotFoundError:
+                continue  # 已被其它进程接管或删除，重新创建
+            owner = read_daemon_lock(grabbed)
+            if owner:
+                # 改名前锁已被其它进程重新占用：放回（原处已有新锁时 link 失败，保持对方的锁）
+                try:
+                    os.link(grabbed, path)
+                except OSError:
+                    pass
+                os.remove(grabbed)
+                return owner
+            os.remove(grabbed)
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        return None
+    return read_daemon_lock(path) or {'pid': None}
+
+
+def write_daemon_lock(info, path=DAEMON_LOCK_PATH):
+    """更新本进程持有的锁文件（心跳，临时文件 + 替换），锁已被其它进程接管时返回 False"""
+    current = _read_lock_file(path)
+    if current is None or current.get('pid') != os.getpid():
+        return False
+    info = dict(info, pid=os.getpid(), updated=time.time())
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def read_daemon_lock(path=DAEMON_LOCK_PATH):
+    """运行中的后台服务信息；没有锁文件或心跳超时（进程已退出）时返回 None
+
+    返回: {'pid', 'sessions', 'all_sessions', 'auto_compress', 'file_monitor', 'updated', 'stale_after'}
+    """
+    info = _read_lock_file(path)
+    if info is None or time.time() - info.get('updated', 0) > info.get('stale_after', 30):
+        return None
+    return info
+
+
+def remove_daemon_lock(path=DAEMON_LOCK_PATH):
+    """删除本进程持有的锁文件"""
+    info = _read_lock_file(path)
+    if info and info.get('pid') == os.getpid():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def daemon_compresses(session_id, info=None):
+    """后台服务是否正在自动压缩该会话（查看器此时不再自动压缩，避免两个进程同时改写）"""
+    info = read_daemon_lock() if info is None else info
+    if not info or not session_id or not info.get('auto_compress'):
+        return False
+    return bool(info.get('all_sessions')) or session_id in info.get('sessions', [])
+
+
+def daemon_imports(session_id, info=None):
+    """后台服务是否正在向该会话导入外部文件（查看器此时不再导入，避免重复追加）"""
+    info = read_daemon_lock() if info is None else info
+    if not info or not session_id or not info.get('file_monitor'):
+        return False
+    return session_id in info.get('sessions', [])
+
+
+class MultiSessionCompressor:
+    """多会话自动压缩 - 监视 sessions.json 中的所有 agent: 会话
+
+    - 每轮用统计缓存（文件只追加时只读新增字节）得到各会话的 token 和对话条数，检查压缩条件
+    - 满足条件的会话按 token 从多到少提交到压缩任务队列，最多 auto_compress_parallelism 个同时执行
+    - 所有请求经过 api_client 的全局请求预算（api_global_rate_limit），不会因为会话多而打满接口
+    - 每个会话同时最多一个任务；会话内容只在压缩时加载，完成后释放，只保留Token状态
+    - 会话状态（engines、registry、统计缓存）只在 owner 线程中读写（SessionEngine 不是线程安全的）：
+      tick / configure 由 owner 线程调用，压缩任务线程只请求 AI，加载和应用都通过 hand_back 交回 owner 线程
+    """
+
+    def __init__(self, client, backup_store, config, hand_back, log=print):
+        self.client = client
+        self.backup_store = backup_store
+        self.config = config
+        self.hand_back = hand_back  # hand_back(func, *args)：在 owner 线程中执行并返回结果
+        self.log = log
+        self.registry = SessionsRegistry(SESSIONS_JSON)
+        self.stats_cache = SessionStatsCache(STATS_CACHE_PATH)
+        self.jobs = CompressionJobQueue(max_workers=config.auto_compress_parallelism, max_pending=64)
+        self.engines = {}  # sessionId -> SessionEngine
+        self.exclude = set()  # 不参与多会话压缩的会话（后台服务单独管理的会话）
+
+    def configure(self, client, backup_store, config):
+        """配置重新加载后更新（并发数对之后启动的任务生效）"""
+        self.client = client
+        self.backup_store = backup_store
+        self.config = config
+        self.jobs.max_workers = max(1, config.auto_compress_parallelism)
+        for engine in self.engines.values():
+            engine.backup_store = backup_store
+            engine.config = config
+
+    def session_ids(self):
+        """sessions.json 中所有 agent: 会话的 sessionId（去重，保持顺序）"""
+        self.registry.refresh()
+        session_ids = []
+        for key, value in self.registry.data.items():
+            session_id = value.get('sessionId') if isinstance(value, dict) else None
+            if (key.startswith('agent:') and session_id and session_id not in session_ids
+                    and session_id not in self.exclude):
+                session_ids.append(session_id)
+        return session_ids
+
+    def engine_for(self, session_id):
+        engine = self.engines.get(session_id)
+        if engine is None:
+            engine = SessionEngine(session_id, SESSIONS_DIR / f"{session_id}.jsonl",
+                                   self.registry, self.backup_store, self.config)
+            self.engines[session_id] = engine
+        return engine
+
+    def evaluate(self):
+        """按缓存统计检查各会话的压缩条件
+
+        返回: [(session_id, 有效Token数, 是否满足, 原因)]（会话文件不存在的跳过）
+        """
+        session_ids = self.session_ids()
+        paths = [SESSIONS_DIR / f"{session_id}.jsonl" for session_id in session_ids]
+        results = []
+        try:
+            for session_id, stats in zip(session_ids, self.stats_cache.iter_many(paths)):
+                if stats is None:
+                    continue
+                engine = self.engine_for(session_id)
+                tokens = pick_effective_tokens(engine, stats['tokens'], self.registry, session_id)
+                roles = stats['roles']
+                message_count = roles.get('user', 0) + roles.get('assistant', 0)
+                can_compress, reason = evaluate_compression_conditions(tokens, message_count, self.config)
+                results.append((session_id, tokens, can_compress, reason))
+        finally:
+            self.stats_cache.save()
+        return results
+
+    def tick(self):
+        """一轮检查：为满足条件的会话提交压缩任务，返回提交的任务数"""
+        config = self.config
+        api_key = config.get_api_key()
+        if not api_key and requires_api_key(config.api_provider):
+            self.log("多会话自动压缩跳过: 未设置 API Key")
+            return 0
+
+        results = self.evaluate()
+        ready = sorted((r for r in results if r[2]), key=lambda r: r[1], reverse=True)
+        submitted = 0
+        for session_id, tokens, _, reason in ready:
+            job = self.jobs.get(session_id)
+            if job is not None and job.active:
+                continue
+            engine = self.engines[session_id]
+            try:
+                if is_ai_outputting(tail_records(engine.jsonl_path)):
+                    continue
+            except OSError:
+                continue
+            job, created = self.jobs.submit(
+                session_id, self.make_worker(engine, api_key),
+                timeout=config.compress_job_timeout, on_done=self.on_job_done,
+                name=f"自动压缩[{session_id}]")
+            if job is None:
+                self.log("压缩任务过多，本轮剩余会话下次再提交")
+                break
+            submitted += 1
+            self.log(f"自动压缩开始[{session_id}]: {reason}")
+        running = len(self.jobs.jobs())
+        self.log(f"检查 {len(results)} 个会话，{len(ready)} 个满足条件，"
+                 f"新提交 {submitted} 个，排队/执行中 {running} 个")
+        return submitted
+
+    def make_worker(self, engine, api_key):
+        """压缩任务：加载会话（owner 线程）-> 请求 AI（任务线程）-> 应用（owner 线程）"""
+        config = self.config
+        client = self.client
+        hand_back = self.hand_back
+        mode = config.compress_mode
+
+        def summarize_many(contents, labels=None):
+            return client.summarize_many(contents, config.api_provider, config.model, api_key)
+
+        def condense(texts):
+            return client.condense(texts, lambda content: summarize_many([content])[0])
+
+        def load():
+            # 取记忆快照后立即释放会话内容，请求 AI 期间不占内存
+            try:
+                engine.sync()
+                return engine.snapshot_memory()
+            finally:
+                engine.release()
+
+        def apply(job, result):
+            if job.cancelled:
+                return "已丢弃"
+            try:
+                backup_name = engine.apply_compression(*result, mode=mode)
+            finally:
+                engine.release()
+            return f"已应用，备份: {backup_name}"
+
+        def compress_worker(job):
+            memory = hand_back(load)
+            result = compress_memory(memory, mode, config, summarize_many, condense)
+            if result is None:
+                return "没有新增对话"
+            # 已取消或超时则丢弃结果
+            job.check()
+            return hand_back(apply, job, result)
+
+        return compress_worker
+
+    def on_job_done(self, job):
+        detail = f"，{job.result}" if job.state == 'done' and job.result else ""
+        self.log(f"{job.describe()}{detail}")
+
+    def cancel(self):
+        """取消所有排队和执行中的压缩任务"""
+        return self.jobs.cancel()
+
+
+class TokenDaemon:
+    """无界面后台服务 - 在 asyncio 事件循环上驱动会话同步、自动压缩和文件监控
+
+    - 配置来自 CONFIG_PATH，文件变化后自动重新加载（查看器里改的设置无需重启服务）
+    - 读写会话状态的步骤都放到同一个工作线程执行（彼此串行，不阻塞事件循环）
+    - AI 请求在压缩任务队列的线程中执行，应用结果时再交回工作线程（多会话压缩同样如此）
+    - SIGINT / SIGTERM 时取消压缩任务后退出
+    - 运行期间维护锁文件 DAEMON_LOCK_PATH（同时只允许一个后台服务）；查看器检查锁文件，
+      后台服务管理的会话不再由界面自动压缩或导入外部文件
+    - 多会话模式下，单独管理的会话（-s / daemon_session）由单会话流程压缩，不参与多会话扫描
+    """
+
+    def __init__(self, session_id=None, config_path=CONFIG_PATH, all_sessions=False):
+        self.config_path = Path(config_path)
+        self.requested_session_id = session_id
+        self.all_sessions = all_sessions  # 命令行 --all：自动压缩所有 agent 会话
+        self.config = AICompressionConfig()
+        self.config_signature = None
+        self.registry = SessionsRegistry(SESSIONS_JSON)
+        self.client = None
+        self.backup_store = None
+        self.engine = None
+        self.fleet = None  # 多会话自动压缩（auto_compress_all_sessions 或 --all 时使用）
+        self.file_reader = ExternalFileReader()
+        self.jobs = CompressionJobQueue(max_workers=2, max_pending=4)
+        self.worker = ThreadPoolExecutor(max_workers=1)  # 会话状态的读写都在这个线程里
+        self.loop = None
+        self.stop_event = None
+        self.last_auto_compress = 0.0
+        self.last_fleet_compress = 0.0
+
+    def log(self, text):
+        print(f"[后台服务] {text} [{datetime.now().strftime('%H:%M:%S')}]", flush=True)
+
+    def hand_back(self, func, *args):
+        """在工作线程中执行 func 并等待结果（压缩任务线程调用）
+
+        服务停止时仍在请求 AI 的任务回来后工作线程已关闭，此时按取消处理，不当作压缩失败。
+        """
+        try:
+            future = self.worker.submit(func, *args)
+        except RuntimeError:
+            raise JobCancelled("后台服务已停止")
+        return future.result()
+
+    # ---------- 以下方法在工作线程中执行 ----------
+
+    def reload_config(self):
+        """配置文件变化时重新加载，返回是否重新加载"""
+        try:
+            stat = self.config_path.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if self.client is not None and signature == self.config_signature:
+            return False
+        self.config_signature = signature
+        config = load_config(AICompressionConfig(), self.config_path)
+        apply_config(config)
+        if self.client is None or config.backup_compression != self.config.backup_compression:
+            self.backup_store = BackupStore(BACKUP_DIR, config.backup_compression)
+        if self.client is None:
+            self.client = CompressionClient(config)
+        self.client.configure(config)
+        self.config = config
+        if self.engine:
+            self.engine.config = config
+            self.engine.backup_store = self.backup_store
+        if self.fleet:
+            self.fleet.configure(self.client, self.backup_store, config)
+        if config.file_monitor_path and self.file_reader.tailer.path != Path(config.file_monitor_path):
+            self.start_file_monitor()
+        self.log("配置已加载" if signature else "未找到配置文件，使用默认配置")
+        return True
+
+    def select_session(self):
+        """确定管理的会话（命令行 -s > 配置 daemon_session > agent:main:main > 第一个 agent 会话）"""
+        self.registry.refresh()
+        session_id = self.requested_session_id or self.config.daemon_session
+        if not session_id:
+            entry = self.registry.data.get('agent:main:main')
+            if entry is None:
+                for key, value in self.registry.data.items():
+                    if key.startswith('agent:'):
+                        entry = value
+                        break
+            session_id = entry.get('sessionId') if entry else None
+        if not session_id or (self.engine and self.engine.session_id == session_id):
+            return
+        jsonl_path = SESSIONS_DIR / f"{session_id}.jsonl"
+        if self.engine:
+            self.jobs.cancel(self.engine.session_id)
+        self.engine = SessionEngine(session_id, jsonl_path, self.registry, self.backup_store, self.config)
+        self.log(f"管理会话: {session_id}")
+
+    def refresh(self):
+        """刷新：重新加载配置、检查会话列表、同步会话文件（无变化时只做 stat），更新锁文件心跳"""
+        self.reload_config()
+        self.select_session()
+        if self.engine and self.engine.jsonl_path.exists():
+            self.engine.sync()
+        self.update_lock()
+
+    def lock_info(self):
+        """锁文件内容：管理的会话和正在执行的任务（查看器据此避让）"""
+        config = self.config
+        return {
+            'sessions': [self.engine.session_id] if self.engine else [],
+            'all_sessions': self.compress_all_sessions(),
+            'auto_compress': config.auto_compress_enabled,
+            'file_monitor': config.file_monitor_enabled,
+            'stale_after': max(30, 3 * config.auto_refresh_interval),
+        }
+
+    def update_lock(self):
+        """更新锁文件心跳；锁已被其它后台服务接管（本进程长时间无响应）时停止"""
+        if not write_daemon_lock(self.lock_info()):
+            self.log("锁文件已被其它后台服务接管，停止")
+            self.stop()
+
+    def start_file_monitor(self):
+        """预读取监控文件现有内容作为基准（不导入，只移动读取偏移）"""
+        path = self.config.file_monitor_path
+        self.file_reader.reset(path or None)
+        if path and os.path.exists(path):
+            try:
+                self.file_reader.read_lines(path)
+                print(f"[文件监控] 预读取 {self.file_reader.line_count} 行作为基准")
+            except Exception as e:
+                print(f"[文件监控] 预读取失败: {e}")
+
+    def import_external_file(self):
+        """读取监控文件新增的行，合并后追加到会话"""
+        path = self.config.file_monitor_path
+        if not (self.config.file_monitor_enabled and path and self.engine) or not os.path.exists(path):
+            return
+        new_lines, start_index = self.file_reader.read_lines(path)
+        if not new_lines:
+            return
+        messages = merge_messages_by_time_window(new_lines, start_index)
+        if messages:
+            written = self.engine.append_messages(messages, fsync=self.config.file_monitor_fsync)
+            print(f"[文件监控] 导入 {len(messages)} 条消息 (原始{len(new_lines)}行，{written} 字节)")
+
+    def compress_all_sessions(self):
+        return self.all_sessions or self.config.auto_compress_all_sessions
+
+    def auto_compress(self):
+        """检查条件并提交自动压缩任务（同查看器的自动压缩，模式和 Key 取自配置）"""
+        engine = self.engine
+        config = self.config
+        if not (config.auto_compress_enabled and engine and engine.jsonl_path.exists()):
+            return
+        if time.time() - self.last_auto_compress < config.auto_compress_interval:
+            return
+        self.last_auto_compress = time.time()
+
+        api_key = config.get_api_key()
+        if not api_key and requires_api_key(config.api_provider):
+            self.log("自动压缩跳过: 未设置 API Key")
+            return
+        if is_ai_outputting(engine.session.records):
+            self.log("自动压缩跳过: AI正在输出")
+            return
+        can_compress, reason = engine.check_compression_conditions()
+        if not can_compress:
+            self.log(f"自动压缩跳过: {reason}")
+            return
+        job = self.jobs.get(engine.session_id)
+        if job is not None and job.active:
+            self.log(f"自动压缩跳过: {job.describe()}")
+            return
+
+        memory = engine.snapshot_memory()
+        mode = config.compress_mode
+        client = self.client
+
+        def summarize_many(contents, labels=None):
+            return client.summarize_many(contents, config.api_provider, config.model, api_key)
+
+        def condense(texts):
+            return client.condense(texts, lambda content: summarize_many([content])[0])
+
+        def compress_worker(job):
+            result = compress_memory(memory, mode, config, summarize_many, condense)
+            if result is None:
+                return "没有新增对话"
+            # 已取消或超时则丢弃结果
+            job.check()
+            # 回到工作线程应用（会话已切换则不能写入）
+            return self.hand_back(self.apply_result, job, result, mode)
+
+        self.jobs.submit(engine.session_id, compress_worker, timeout=config.compress_job_timeout,
+                         on_done=self.on_job_done, name="自动压缩")
+        self.log(f"自动压缩开始: {reason}")
+
+    def apply_result(self, job, result, mode):
+        engine = self.engine
+        if job.cancelled or engine is None or job.key != engine.session_id:
+            print(f"[压缩任务] 会话已切换或任务已取消，丢弃压缩结果: {job.key}")
+            return "已丢弃"
+        backup_name = engine.apply_compression(*result, mode=mode)
+        return f"已应用，备份: {backup_name}"
+
+    def on_job_done(self, job):
+        detail = f"，{job.result}" if job.state == 'done' and job.result else ""
+        self.log(f"{job.describe()}{detail}")
+
+    def fleet_compress(self):
+        """多会话自动压缩：每个间隔检查一轮所有 agent 会话"""
+        config = self.config
+        if not (config.auto_compress_enabled and self.compress_all_sessions()):
+            return
+        if time.time() - self.last_fleet_compress < config.auto_compress_interval:
+            return
+        self.last_fleet_compress = time.time()
+        if self.fleet is None:
+            self.fleet = MultiSessionCompressor(self.client, self.backup_store, config, self.hand_back, self.log)
+        engine = self.engine
+        self.fleet.exclude = {engine.session_id} if engine else set()
+        self.fleet.tick()
+
+    # ---------- 事件循环 ----------
+
+    async def call(self, func):
+        """在工作线程中执行 func（出错只打印，不中断循环）"""
+        try:
+            await self.loop.run_in_executor(self.worker, func)
+        except Exception as e:
+            self.log(f"{func.__name__} 出错: {e}")
+
+    async def every(self, func, interval):
+        """按 interval() 秒的间隔反复执行（间隔随配置变化）"""
+        while True:
+            await self.call(func)
+            await asyncio.sleep(max(0.05, interval()))
+
+    def stop(self):
+        """请求停止（可在信号处理中调用）"""
+        if self.stop_event is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def run(self):
+        owner = claim_daemon_lock(self.lock_info())
+        if owner is not None:
+            self.log(f"已有后台服务在运行（pid {owner.get('pid')}），退出")
+            return
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows 不支持，Ctrl+C 由 KeyboardInterrupt 处理
+
+        await self.call(self.refresh)
+        self.log(f"已启动，配置: {self.config_path}")
+        tasks = [
+            asyncio.ensure_future(self.every(self.refresh, lambda: self.config.auto_refresh_interval)),
+            # 自动压缩：每秒检查一次是否到达间隔（间隔修改后立即生效）
+            asyncio.ensure_future(self.every(self.auto_compress, lambda: 1.0)),
+            # 多会话：统计扫描只读新增字节，和会话状态一起在工作线程执行
+            asyncio.ensure_future(self.every(self.fleet_compress, lambda: 1.0)),
+            asyncio.ensure_future(self.every(self.import_external_file,
+                                             lambda: 1.0 / max(0.01, self.config.file_monitor_interval))),
+        ]
+        try:
+            await self.stop_event.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            count = self.jobs.cancel() + (self.fleet.cancel() if self.fleet else 0)
+            if count:
+                print(f"[压缩任务] 已取消 {count} 个任务")
+            self.worker.shutdown(wait=True)
+            remove_daemon_lock()
+            self.log("已停止")
+
+
+def run_daemon(session_id=None, config_path=CONFIG_PATH, all_sessions=False):
+    """启动后台服务并阻塞到收到停止信号"""
+    daemon = TokenDaemon(session_id, config_path, all_sessions)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        pass
@@ -10,23 +10,30 @@ import os
 import sys
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
-from pathlib import Path
+import tkinter.font as tkfont
 from datetime import datetime
 import time
-import requests
-import base64
 import threading
 import queue
 
-# 配置路径（可修改）
-OPENCLAW_DIR = Path.home() / ".openclaw"
-SESSIONS_DIR = OPENCLAW_DIR / "agents" / "main" / "sessions"
-SESSIONS_JSON = SESSIONS_DIR / "sessions.json"
-BACKUP_DIR = SESSIONS_DIR / "backups"
-
-# 配置文件路径（可自定义）
-CONFIG_FILENAME = "token_viewer_config.json"  # 修改这里可更改配置文件名
-CONFIG_PATH = OPENCLAW_DIR / CONFIG_FILENAME
+from OpenClawTokenCore import (
+    FileTailer, ParsedSession, SessionsRegistry, append_lines, atomic_rewrite,
+    BackupStore,
+    API_TEMPLATES, api_client, requires_api_key,
+    CompressionJobQueue, JobCancelled,
+    SHORT_TERM_PREFIX, SHORT_TERM_COUNT,
+)
+# 路径、配置和与界面无关的会话流程在引擎模块中（与无界面后台服务共用）
+from OpenClawTokenEngine import (
+    SESSIONS_DIR, SESSIONS_JSON, BACKUP_DIR, AICompressionConfig,
+    load_config, save_config, apply_config, CompressionClient,
+    extract_message_text, create_memory_message, is_ai_outputting, pick_effective_tokens,
+    evaluate_compression_conditions, update_session_tokens,
+    build_incremental_plan, compress_memory, build_compressed_lines,
+    ExternalFileReader, merge_messages_by_time_window, extract_timestamp, remove_timestamp,
+    wrap_external_message, external_message_lines,
+    daemon_compresses, daemon_imports,
+)
 
 # 角色颜色映射
 ROLE_COLORS = {
@@ -37,166 +44,239 @@ ROLE_COLORS = {
     'system': '#F44336',
 }
 
-# 记忆 ID 常量
-COMPACT_ID = "baizhi01"     # compact标记（前文截止符）
-CHARACTER_ID = "baizhi00"   # 人设/初始化记忆（不变）
-LONG_TERM_ID = "baizhi52"   # 长期记忆
-MID_TERM_ID = "baizhi20"    # 中期记忆
-MODE_MESSAGE_ID = "baizhi21"  # 模式消息（长期/中期/短期/吐槽）
-SHORT_TERM_PREFIX = "白芷"   # 短期记忆前缀
-SHORT_TERM_COUNT = 19       # 白芷01 到 白芷19
-
-# API 配置
-API_TEMPLATES = {
-    'moonshot': {
-        'url': 'https://api.moonshot.cn/v1/chat/completions',
-        'models': ['kimi-k2.5', 'kimi-k2']
-    },
-    'kimicode': {
-        # Kimi Code 的正确 API 地址
-        # 参考: game_assistant/send/llm_clients/ask_kimi.py
-        'url': 'https://api.kimi.com/coding/v1/chat/completions',
-        'models': ['kimi-for-coding', 'kimi-k2.5']  # 支持两种模型
-    }
-}
-
-def encode_key(key):
-    """简单编码 API key（非加密，只是防止明文）"""
-    return base64.b64encode(key.encode()).decode()
-
-def decode_key(encoded_key):
-    """解码 API key"""
-    try:
-        return base64.b64decode(encoded_key.encode()).decode()
-    except:
-        return ""
-
-# 默认配置常量 - 修改这里即可改变所有默认值
-DEFAULT_CONFIG = {
-    # API设置
-    'api_provider': 'moonshot',
-    'model': 'kimi-k2.5',
-    'api_key_encoded': '',
+class VirtualListbox:
+    """虚拟化列表框 - 只渲染可见行，支持增量更新
     
-    # 压缩设置
-    'compress_mode': '长期模式',  # 默认模式：长期/中期/短期/吐槽
-    'auto_compress_enabled': False,  # 默认关闭自动压缩
-    'auto_compress_interval': 300,  # 自动压缩间隔（秒）
-    'silent_mode': False,  # 静默模式（关闭弹窗）
-    
-    # 文件监控设置
-    'file_monitor_enabled': False,
-    'file_monitor_path': '',  # 默认监控文件路径
-    'file_monitor_interval': 1.0,  # 监控频率（Hz）
-    
-    # 阈值设置
-    'long_term_threshold': 5000,   # 长期记忆触发阈值（默认5000）
-    'mid_term_threshold': 2000,    # 中期记忆触发阈值（默认2000）
-    'short_term_keep': 5,          # 短期记忆保留条数
-    'min_message_count': 10,       # 自动压缩最小对话条数
-    'min_token_count': 20000,      # 自动压缩最小token数
-    
-    # UI设置
-    'auto_refresh_enabled': True,  # 默认开启自动刷新
-    'auto_refresh_interval': 1,    # 自动刷新间隔（秒）
-}
-
-class AICompressionConfig:
-    """AI 压缩配置 - 从DEFAULT_CONFIG加载默认值"""
-    def __init__(self):
-        # 从默认配置加载
-        self.enabled = False
-        self.api_provider = DEFAULT_CONFIG['api_provider']
-        self.api_url = API_TEMPLATES[DEFAULT_CONFIG['api_provider']]['url']
-        self.api_key_encoded = DEFAULT_CONFIG['api_key_encoded']
-        self.model = DEFAULT_CONFIG['model']
-        self.compress_mode = DEFAULT_CONFIG['compress_mode']
-        self.auto_compress_enabled = DEFAULT_CONFIG['auto_compress_enabled']
-        self.auto_compress_interval = DEFAULT_CONFIG['auto_compress_interval']
-        self.silent_mode = DEFAULT_CONFIG['silent_mode']
-        # 文件监控配置
-        self.file_monitor_enabled = DEFAULT_CONFIG['file_monitor_enabled']
-        self.file_monitor_path = DEFAULT_CONFIG['file_monitor_path']
-        self.file_monitor_interval = DEFAULT_CONFIG['file_monitor_interval']
-        # 阈值配置
-        self.long_term_threshold = DEFAULT_CONFIG['long_term_threshold']  # 5000
-        self.mid_term_threshold = DEFAULT_CONFIG['mid_term_threshold']    # 2000
-        self.short_term_keep = DEFAULT_CONFIG['short_term_keep']
-        self.min_message_count = DEFAULT_CONFIG['min_message_count']
-        self.min_token_count = DEFAULT_CONFIG['min_token_count']
-        # UI设置
-        self.auto_refresh_enabled = DEFAULT_CONFIG['auto_refresh_enabled']
-        self.auto_refresh_interval = DEFAULT_CONFIG['auto_refresh_interval']
-        # 压缩提示词
-        self.compression_prompt = """请将以下对话历史压缩为关键信息摘要。要求：
-1. 低失真，保留重要决策、代码变更和关键上下文
-2. 纯文本输出，不要Markdown格式
-3. 少用符号，避免特殊字符
-4. 不要分段，用逗号或分号连接
-5. 字数越多越好，尽量详细，控制在8000字以内
-6. 保留完整的技术细节和决策依据
-
-内容："""
-        # 吐槽模式提示词
-        self.tsukkomi_prompt = """请对以下对话历史进行吐槽，指出其中的问题、矛盾或有趣的地方。用轻松幽默的语气，直接输出吐槽内容，不要加标题或前缀：
+    rows: [(key, text, color), ...]，按显示顺序保存全部行，
+    Listbox 中只放当前可见窗口内的几十行，滚动时替换窗口内容。
+    选中状态按 key 记录，滚动、追加和刷新后保持。
+    鼠标点击（Shift/Ctrl）和方向键/翻页键按 rows 中的位置处理（而不是 Listbox 中的位置），
+    可以选中和移动到可见窗口之外的行，需要时自动滚动。
+    """
+    def __init__(self, parent, on_select=None, **listbox_kwargs):
+        self.frame = ttk.Frame(parent)
+        self.listbox = tk.Listbox(self.frame, **listbox_kwargs)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        self.rows = []
+        self.first = 0              # 可见窗口第一行在 rows 中的位置
+        self.visible = listbox_kwargs.get('height', 10)
+        self.rendered = []          # 当前 Listbox 中的行
+        self.selected_keys = set()
+        self.extended = listbox_kwargs.get('selectmode') in (tk.EXTENDED, tk.MULTIPLE)
+        self.active_key = None      # 最近一次点击/移动到的行
+        self.anchor_key = None      # Shift 选择范围的起点
+        self.on_select = on_select
+        self.line_height = None
+        
+        self.listbox.bind("<<ListboxSelect>>", self._on_listbox_select)
+        self.listbox.bind("<Button-1>", lambda e: self._on_click(e))
+        self.listbox.bind("<Shift-Button-1>", lambda e: self._on_click(e, extend=True))
+        self.listbox.bind("<Control-Button-1>", lambda e: self._on_click(e, toggle=True))
+        self.listbox.bind("<B1-Motion>", self._on_drag)
+        for key, step in (("Up", -1), ("Down", 1), ("Prior", None), ("Next", None)):
+            sign = 1 if key in ("Down", "Next") else -1
+            self.listbox.bind(f"<{key}>", lambda e, s=step, d=sign: self._on_key(e, s, d))
+            self.listbox.bind(f"<Shift-{key}>", lambda e, s=step, d=sign: self._on_key(e, s, d, extend=True))
+        self.listbox.bind("<Configure>", self._on_configure)
+        self.listbox.bind("<MouseWheel>", self._on_wheel)
+        self.listbox.bind("<Button-4>", self._on_wheel)
+        self.listbox.bind("<Button-5>", self._on_wheel)
+        
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+        
+    def set_rows(self, rows):
+        """全量替换（会话被改写、筛选条件变化时）"""
+        self.rows = list(rows)
+        keys = {row[0] for row in self.rows}
+        self.selected_keys &= keys
+        self.scroll_to(self.first, force=True)
+        
+    def prepend(self, rows):
+        """在顶部插入新行（最新消息在最上方），滚动位置保持不动"""
+        if not rows:
+            return
+        self.rows[0:0] = rows
+        if self.first > 0:
+            self.first += len(rows)
+        self.render()
+        
+    def truncate(self, count):
+        """只保留前 count 行"""
+        if len(self.rows) > count:
+            del self.rows[count:]
+            self.scroll_to(self.first, force=True)
+            
+    def update_row(self, index, row):
+        """更新单行内容"""
+        self.rows[index] = row
+        if self.first <= index < self.first + self.visible:
+            self.render()
+            
+    def remove(self, indices):
+        """删除若干行"""
+        for index in sorted(indices, reverse=True):
+            key = self.rows[index][0]
+            del self.rows[index]
+            self.selected_keys.discard(key)
+        self.scroll_to(self.first, force=True)
+        
+    def selected_indices(self):
+        """所有选中行在 rows 中的位置（包括滚出可见区域的）"""
+        if not self.selected_keys:
+            return []
+        return [i for i, row in enumerate(self.rows) if row[0] in self.selected_keys]
+        
+    def active_index(self):
+        """最近点击/移动到的选中行在 rows 中的位置（没有时为第一个选中行，都没有时为 None）"""
+        if self.active_key in self.selected_keys:
+            index = self.index_of(self.active_key)
+            if index is not None:
+                return index
+        selection = self.selected_indices()
+        return selection[0] if selection else None
+        
+    def index_of(self, key):
+        for i, row in enumerate(self.rows):
+            if row[0] == key:
+                return i
+        return None
+        
+    def see(self, index):
+        """滚动到 rows[index] 可见"""
+        if index < self.first:
+            self.scroll_to(index)
+        elif index >= self.first + self.visible:
+            self.scroll_to(index - self.visible + 1)
+        
+    def scroll_to(self, first, force=False):
+        first = max(0, min(first, len(self.rows) - self.visible))
+        if first != self.first or force:
+            self.first = first
+            self.render()
+        
+    def render(self):
+        """重绘可见窗口（内容未变时只更新滚动条）"""
+        window = self.rows[self.first:self.first + self.visible]
+        if window != self.rendered:
+            self.listbox.delete(0, tk.END)
+            for i, (key, text, color) in enumerate(window):
+                self.listbox.insert(tk.END, text)
+                self.listbox.itemconfig(i, {'fg': color})
+            self.rendered = window
+        self.render_selection()
+        
+    def render_selection(self):
+        """按 selected_keys 设置可见窗口内的选中状态"""
+        self.listbox.selection_clear(0, tk.END)
+        for i, row in enumerate(self.rendered):
+            if row[0] in self.selected_keys:
+                self.listbox.selection_set(i)
+        
+        total = len(self.rows)
+        if total <= self.visible:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.first / total, (self.first + self.visible) / total)
+            
+    def yview(self, *args):
+        """滚动条回调"""
+        if not args:
+            return
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                amount *= self.visible
+            self.scroll_to(self.first + amount)
+            
+    def _on_wheel(self, event):
+        if event.num == 4:
+            step = -3
+        elif event.num == 5:
+            step = 3
+        else:
+            step = -3 if event.delta > 0 else 3
+        self.scroll_to(self.first + step)
+        return "break"
+        
+    def _on_configure(self, event):
+        if self.line_height is None:
+            font = tkfont.Font(font=self.listbox.cget('font'))
+            self.line_height = font.metrics('linespace') + 1
+        visible = max(1, event.height // self.line_height)
+        if visible != self.visible:
+            self.visible = visible
+            self.scroll_to(self.first, force=True)
+            
+    def _on_listbox_select(self, event):
+        # 其它默认绑定（如全选）改变选中状态时：可见区域内以 Listbox 为准，可见区域外的保持不变
+        self.selected_keys -= {row[0] for row in self.rendered}
+        for i in self.listbox.curselection():
+            if i < len(self.rendered):
+                self.selected_keys.add(self.rendered[i][0])
+        if self.on_select:
+            self.on_select(event)
+            
+    def _select(self, index, event, extend=False, toggle=False):
+        """选中 rows[index]：默认只选这一行；extend 选中锚点到该行的范围；toggle 切换该行"""
+        key = self.rows[index][0]
+        anchor = self.index_of(self.anchor_key) if self.anchor_key is not None else None
+        if self.extended and extend and anchor is not None:
+            low, high = sorted((anchor, index))
+            self.selected_keys = {row[0] for row in self.rows[low:high + 1]}
+        elif self.extended and toggle:
+            self.selected_keys ^= {key}
+            self.anchor_key = key
+        else:
+            self.selected_keys = {key}
+            self.anchor_key = key
+        self.active_key = key
+        self.see(index)
+        self.render_selection()
+        if self.on_select:
+            self.on_select(event)
+        
+    def _row_at(self, y):
+        """鼠标位置对应的 rows 位置（没有行时为 None）"""
+        if not self.rendered:
+            return None
+        return self.first + min(self.listbox.nearest(y), len(self.rendered) - 1)
+        
+    def _on_click(self, event, extend=False, toggle=False):
+        self.listbox.focus_set()
+        index = self._row_at(event.y)
+        if index is not None:
+            self._select(index, event, extend, toggle)
+        return "break"
+        
+    def _on_drag(self, event):
+        # 拖动选择：超出上下边缘时滚动一行
+        if event.y < 0:
+            self.scroll_to(self.first - 1)
+        elif event.y > self.listbox.winfo_height():
+            self.scroll_to(self.first + 1)
+        index = self._row_at(event.y)
+        if index is not None and self.rows[index][0] != self.active_key:
+            self._select(index, event, extend=True)
+        return "break"
+        
+    def _on_key(self, event, step, direction, extend=False):
+        # step 为 None 时翻一页
+        if not self.rows:
+            return "break"
+        current = self.index_of(self.active_key) if self.active_key is not None else None
+        if current is None:
+            index = self.first
+        else:
+            index = current + (step if step is not None else direction * max(1, self.visible - 1))
+        self._select(max(0, min(index, len(self.rows) - 1)), event, extend=extend)
+        return "break"
 
-内容："""
-        
-    def to_dict(self):
-        return {
-            'enabled': self.enabled,
-            'api_provider': self.api_provider,
-            'api_url': self.api_url,
-            'api_key_encoded': self.api_key_encoded,
-            'model': self.model,
-            'compress_mode': self.compress_mode,
-            'auto_compress_enabled': self.auto_compress_enabled,
-            'auto_compress_interval': self.auto_compress_interval,
-            'silent_mode': self.silent_mode,
-            'file_monitor_enabled': self.file_monitor_enabled,
-            'file_monitor_path': self.file_monitor_path,
-            'file_monitor_interval': self.file_monitor_interval,
-            'long_term_threshold': self.long_term_threshold,
-            'mid_term_threshold': self.mid_term_threshold,
-            'short_term_keep': self.short_term_keep,
-            'min_message_count': self.min_message_count,
-            'min_token_count': self.min_token_count,
-            'compression_prompt': self.compression_prompt,
-            'tsukkomi_prompt': self.tsukkomi_prompt,
-            'auto_refresh_enabled': self.auto_refresh_enabled,
-            'auto_refresh_interval': self.auto_refresh_interval
-        }
-        
-    def from_dict(self, d):
-        self.enabled = d.get('enabled', False)
-        self.api_provider = d.get('api_provider', 'moonshot')
-        self.api_url = d.get('api_url', API_TEMPLATES['moonshot']['url'])
-        self.api_key_encoded = d.get('api_key_encoded', "")
-        self.model = d.get('model', 'kimi-k2.5')
-        self.compress_mode = d.get('compress_mode', '长期模式')
-        self.auto_compress_enabled = d.get('auto_compress_enabled', False)
-        self.auto_compress_interval = d.get('auto_compress_interval', 300)
-        self.silent_mode = d.get('silent_mode', False)
-        self.file_monitor_enabled = d.get('file_monitor_enabled', False)
-        self.file_monitor_path = d.get('file_monitor_path', "")
-        self.file_monitor_interval = d.get('file_monitor_interval', 1.0)
-        self.long_term_threshold = d.get('long_term_threshold', DEFAULT_CONFIG['long_term_threshold'])
-        self.mid_term_threshold = d.get('mid_term_threshold', DEFAULT_CONFIG['mid_term_threshold'])
-        self.short_term_keep = d.get('short_term_keep', DEFAULT_CONFIG['short_term_keep'])
-        self.min_message_count = d.get('min_message_count', DEFAULT_CONFIG['min_message_count'])
-        self.min_token_count = d.get('min_token_count', DEFAULT_CONFIG['min_token_count'])
-        self.compression_prompt = d.get('compression_prompt', self.compression_prompt)
-        self.auto_refresh_enabled = d.get('auto_refresh_enabled', DEFAULT_CONFIG['auto_refresh_enabled'])
-        self.auto_refresh_interval = d.get('auto_refresh_interval', DEFAULT_CONFIG['auto_refresh_interval'])
-        self.tsukkomi_prompt = d.get('tsukkomi_prompt', self.tsukkomi_prompt)
-        
-    def get_api_key(self):
-        """获取解码后的 API key"""
-        return decode_key(self.api_key_encoded)
-        
-    def set_api_key(self, key):
-        """设置并编码 API key"""
-        self.api_key_encoded = encode_key(key)
 
 class TokenViewerApp:
     def __init__(self, root):
@@ -210,10 +290,16 @@ class TokenViewerApp:
         self.current_session_id = None
         self.current_jsonl_path = None
         self.all_lines = []
+        self.session_tailer = FileTailer()  # 会话文件增量读取（按字节偏移）
+        self.session = ParsedSession()      # 会话解析模型（所有读取方共享）
+        self.sessions_registry = SessionsRegistry(SESSIONS_JSON)  # sessions.json 缓存
         
         # 先初始化配置
         self.compression_config = AICompressionConfig()
         self.load_compression_config()
+        apply_config(self.compression_config)  # 分词后端、重试/限流、自建服务商
+        self.backup_store = BackupStore(BACKUP_DIR, self.compression_config.backup_compression)
+        self.compression_client = CompressionClient(self.compression_config)  # 摘要缓存 + 多服务商路由
         
         # 自动刷新设置从配置加载
         self.auto_refresh = self.compression_config.auto_refresh_enabled
@@ -224,13 +310,31 @@ class TokenViewerApp:
         
         # 文件监控相关
         self.file_monitor_timer = None
-        self.file_monitor_last_lines = []  # 上次读取的行列表（按顺序存储，用于增量导入）
+        self.file_monitor_reader = ExternalFileReader()  # 按字节偏移读取监控文件（只读新增内容）
+        
+        # 编辑区加载时的文件字节数（保存时合并之后追加的内容）
+        self.edit_base_size = None
         
         # UI自动刷新定时器
         self.ui_refresh_timer = None
         self.ui_refresh_interval = 1000  # 默认1秒刷新一次
         self.is_auto_refresh = self.compression_config.auto_refresh_enabled  # 从配置加载
         
+        # 压缩任务队列（每个会话同时最多一个压缩任务）
+        self.compression_jobs = CompressionJobQueue(max_workers=2, max_pending=4)
+        # 手动增量压缩的高水位标记 (会话ID, folded_until)，应用结果时写入记忆
+        self.manual_folded_until = None
+        self.auto_compress_timer = None
+        
+        # 流式输出
+        self.stream_display = None  # 当前流式显示的状态
+        self.stream_refresh_interval = 100  # 结果区重绘间隔（毫秒）
+        
+        # 刷新调度（合并多次触发，只在文件变化时刷新）
+        self.refresh_job = None
+        self.pending_refresh = {'sessions': False, 'session': False}
+        self.seen_sessions_version = None
+        
         # 自动压缩状态提示（用于状态栏显示）
         self.auto_compress_status = ""
         
@@ -248,18 +352,10 @@ class TokenViewerApp:
         
     def load_compression_config(self):
         """加载压缩配置"""
-        config_path = CONFIG_PATH
-        if config_path.exists():
-            try:
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.compression_config.from_dict(data)
-            except:
-                pass
+        load_config(self.compression_config)
                 
     def save_compression_config(self):
         """保存所有配置到文件"""
-        config_path = CONFIG_PATH
         try:
             # 保存API设置
             self.compression_config.api_provider = self.api_provider_var.get()
@@ -276,6 +372,7 @@ class TokenViewerApp:
             except:
                 pass
             self.compression_config.silent_mode = self.silent_mode_var.get()
+            self.compression_config.stream_output = self.stream_output_var.get()
             
             # 保存文件监控配置
             self.compression_config.file_monitor_path = self.file_monitor_path_var.get()
@@ -290,8 +387,7 @@ class TokenViewerApp:
             if api_key:
                 self.compression_config.set_api_key(api_key)
             
-            with open(config_path, 'w', encoding='utf-8') as f:
-                json.dump(self.compression_config.to_dict(), f, ensure_ascii=False, indent=2)
+            save_config(self.compression_config)
             self.status_var.set("配置已保存")
         except Exception as e:
             print(f"保存配置失败: {e}")
@@ -337,6 +433,11 @@ class TokenViewerApp:
         ttk.Checkbutton(control_frame, text="静默", variable=self.silent_mode_var,
                        command=self.toggle_silent_mode).pack(side=tk.LEFT, padx=2)
         
+        # 流式输出（边生成边显示）
+        self.stream_output_var = tk.BooleanVar(value=self.compression_config.stream_output)
+        ttk.Checkbutton(control_frame, text="流式", variable=self.stream_output_var,
+                       command=self.toggle_stream_output).pack(side=tk.LEFT, padx=2)
+        
         ttk.Button(control_frame, text="通讯测试", width=8, command=self.test_api).pack(side=tk.LEFT, padx=2)
         ttk.Button(control_frame, text="保存配置", width=8, command=self.save_compression_config).pack(side=tk.LEFT, padx=2)
         
@@ -358,7 +459,7 @@ class TokenViewerApp:
         ttk.Label(self.ai_frame, text="API:").pack(side=tk.LEFT, padx=3)
         self.api_provider_var = tk.StringVar(value=self.compression_config.api_provider)
         self.api_provider_combo = ttk.Combobox(self.ai_frame, textvariable=self.api_provider_var,
-                                               values=['moonshot', 'kimicode'], width=10, state="readonly")
+                                               values=list(API_TEMPLATES), width=10, state="readonly")
         self.api_provider_combo.pack(side=tk.LEFT, padx=3)
         self.api_provider_combo.bind("<<ComboboxSelected>>", self.on_api_provider_changed)
         
@@ -375,7 +476,7 @@ class TokenViewerApp:
         ttk.Label(self.ai_frame, text="模式:").pack(side=tk.LEFT, padx=3)
         self.compress_mode_var = tk.StringVar(value='正常模式')
         self.mode_combo = ttk.Combobox(self.ai_frame, textvariable=self.compress_mode_var,
-                                       values=['正常模式', '吐槽模式'], 
+                                       values=['正常模式', '增量模式', '吐槽模式'], 
                                        width=10, state="readonly")
         self.mode_combo.pack(side=tk.LEFT, padx=3)
         
@@ -490,9 +591,12 @@ class TokenViewerApp:
         ttk.Button(history_control, text="删除选中", width=10, 
                   command=self.delete_selected_history).pack(side=tk.RIGHT, padx=5)
         
-        self.history_listbox = tk.Listbox(left_frame, height=15, font=("Consolas", 9), selectmode=tk.EXTENDED)
-        self.history_listbox.pack(fill=tk.BOTH, expand=True, pady=2)
-        self.history_listbox.bind("<<ListboxSelect>>", self.on_history_selected)
+        # 虚拟化列表：只渲染可见行，刷新时增量更新
+        self.history_list = VirtualListbox(left_frame, on_select=self.on_history_selected,
+                                           height=15, font=("Consolas", 9), selectmode=tk.EXTENDED)
+        self.history_list.pack(fill=tk.BOTH, expand=True, pady=2)
+        self.history_listbox = self.history_list.listbox
+        self.history_view = None  # 上次加载历史时的状态（用于增量更新）
         
         # 右侧：预览和内容
         right_frame = ttk.Frame(content_paned)
@@ -530,6 +634,7 @@ class TokenViewerApp:
         ttk.Button(edit_btn_frame, text="加载", command=self.load_file_for_edit).pack(side=tk.LEFT, padx=2)
         ttk.Button(edit_btn_frame, text="保存", command=self.save_file_edit).pack(side=tk.LEFT, padx=2)
         ttk.Button(edit_btn_frame, text="备份", command=self.backup_file).pack(side=tk.LEFT, padx=2)
+        ttk.Button(edit_btn_frame, text="恢复", command=self.show_restore_backup).pack(side=tk.LEFT, padx=2)
         ttk.Button(edit_btn_frame, text="删最后N", command=self.delete_last_n_lines).pack(side=tk.LEFT, padx=2)
         ttk.Button(edit_btn_frame, text="删前N", command=self.delete_first_n_lines).pack(side=tk.LEFT, padx=2)
         ttk.Button(edit_btn_frame, text="截断", command=self.truncate_file).pack(side=tk.LEFT, padx=2)
@@ -609,7 +714,11 @@ class TokenViewerApp:
                 messagebox.showerror("错误", "请输入有效的数字")
         
         ttk.Button(dialog, text="保存", command=save).pack(pady=10)
-        
+    
+    def has_api_key(self):
+        """当前服务商是否可以调用（已填 Key，或本地接口等不需要 Key 的服务商）"""
+        return bool(self.api_key_entry.get()) or not requires_api_key(self.api_provider_var.get())
+    
     def on_api_provider_changed(self, event=None):
         """API 提供商改变时更新 URL 和模型列表"""
         provider = self.api_provider_var.get()
@@ -642,6 +751,7 @@ class TokenViewerApp:
         self.auto_compress_var.set(self.compression_config.auto_compress_enabled)
         self.auto_compress_interval_spin.set(str(self.compression_config.auto_compress_interval))
         self.silent_mode_var.set(self.compression_config.silent_mode)
+        self.stream_output_var.set(self.compression_config.stream_output)
         
         # 恢复文件监控配置
         self.file_monitor_path_var.set(self.compression_config.file_monitor_path)
@@ -662,39 +772,89 @@ class TokenViewerApp:
             self.load_history()
             self.status_var.set("已自动加载当前会话，自动刷新已开启")
         
-        # 启动UI自动刷新循环（1秒一次）
+        # 启动统一刷新调度循环（1秒检查一次，自动刷新开启时同时检查会话列表）
         self.start_ui_refresh_loop()
         
-        # 默认开启自动刷新循环
-        if self.is_auto_refresh:
-            self.auto_refresh_loop()
-        
     def start_ui_refresh_loop(self):
         """启动UI自动刷新循环"""
         self.ui_refresh_loop()
     
     def ui_refresh_loop(self):
-        """UI自动刷新循环 - 每秒检查文件变化"""
-        if not self.current_session_id or not self.current_jsonl_path:
-            self.ui_refresh_timer = self.root.after(self.ui_refresh_interval, self.ui_refresh_loop)
-            return
+        """UI自动刷新循环 - 每秒检查文件变化，只在真正变化时刷新
         
+        - 当前会话 jsonl：始终检查（无变化时只做一次 stat）
+        - sessions.json：自动刷新开启时检查（mtime/大小变化才重新解析）
+        """
         try:
-            # 检查文件是否有变化（通过比较行数）
-            if self.current_jsonl_path.exists():
-                with open(self.current_jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    current_lines = f.readlines()
-                
-                # 如果行数变化，自动刷新
-                if len(current_lines) != len(self.all_lines):
-                    self.refresh_current()
-                    self.load_history()
+            # 检查文件是否有变化（只读取新增字节）
+            if self.current_session_id and self.current_jsonl_path and self.sync_session_lines():
+                self.schedule_refresh(session=True)
+            
+            # 检查会话列表是否有变化（检测新开对话、官方Token更新）
+            if self.is_auto_refresh:
+                self.sessions_registry.refresh()
+                if self.sessions_registry.version != self.seen_sessions_version:
+                    self.schedule_refresh(sessions=True, session=True)
         except:
             pass
         
         # 设置下次刷新
         self.ui_refresh_timer = self.root.after(self.ui_refresh_interval, self.ui_refresh_loop)
         
+    def schedule_refresh(self, sessions=False, session=False):
+        """请求刷新 - 同一轮事件循环内的多次请求合并为一次执行
+        
+        Args:
+            sessions: 重新加载会话列表（保持当前选中的会话）
+            session: 刷新当前会话统计和历史记录
+        """
+        self.pending_refresh['sessions'] |= sessions
+        self.pending_refresh['session'] |= session
+        if self.refresh_job is None:
+            self.refresh_job = self.root.after_idle(self._run_scheduled_refresh)
+    
+    def _run_scheduled_refresh(self):
+        """执行合并后的刷新请求"""
+        self.refresh_job = None
+        pending = self.pending_refresh
+        self.pending_refresh = {'sessions': False, 'session': False}
+        
+        switched = False
+        if pending['sessions']:
+            self.seen_sessions_version = self.sessions_registry.version
+            switched = self.load_sessions()
+        # 切换会话时 on_session_selected 已经刷新过
+        if pending['session'] and not switched:
+            self.refresh_current()
+            self.load_history()
+        
+    def sync_session_lines(self):
+        """将会话文件的变化同步到 self.all_lines
+        
+        只追加时仅解析新增行；被截断或替换时全量重新读取。
+        返回: None（无变化）/ 'append' / 'reload'
+        """
+        mode, lines = self.session_tailer.poll()
+        if mode == 'append':
+            self.all_lines.extend(lines)
+        elif mode == 'reload':
+            self.all_lines = lines
+        self.session.sync(mode, lines)
+        return mode
+    
+    def rewrite_session_file(self, new_lines):
+        """原子改写当前会话文件（临时文件 + fsync + 替换）
+        
+        new_lines 由 self.all_lines 生成；同步之后 OpenClaw 新追加的行
+        会被合并到新文件末尾，不会丢失。
+        """
+        base_size = None
+        if self.session_tailer.inode is not None:
+            base_size = self.session_tailer.offset
+        atomic_rewrite(self.current_jsonl_path, new_lines, base_size)
+        self.all_lines = list(new_lines)
+        self.session_tailer.reset()  # 文件已被改写，下次全量同步（含合并进来的新行）
+    
     def stop_ui_refresh_loop(self):
         """停止UI自动刷新循环"""
         if self.ui_refresh_timer:
@@ -717,7 +877,7 @@ class TokenViewerApp:
     def test_api(self):
         """测试 API 连接"""
         api_key = self.api_key_entry.get()
-        if not api_key:
+        if not self.has_api_key():
             messagebox.showerror("错误", "请先输入 API Key")
             return
             
@@ -729,16 +889,6 @@ class TokenViewerApp:
             url = API_TEMPLATES[provider]['url']
             model = self.model_combo.get()
             
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            # Kimi Code 需要特殊 headers
-            if provider == 'kimicode':
-                headers["User-Agent"] = "claude-code/0.1.0"
-                headers["X-Client-Name"] = "claude-code"
-            
             data = {
                 "model": model,
                 "messages": [{"role": "user", "content": "Hello"}],
@@ -751,16 +901,16 @@ class TokenViewerApp:
             self.ai_result_text.insert(tk.END, f"Model: {model}\n")
             self.ai_result_text.insert(tk.END, "-" * 40 + "\n")
             
-            response = requests.post(
-                url,
-                headers=headers,
-                json=data,
-                timeout=10
-            )
+            response = api_client.post(provider, api_key, data, timeout=10)
             
             self.ai_result_text.insert(tk.END, f"Status: {response.status_code}\n")
             self.ai_result_text.insert(tk.END, f"Response: {response.text[:500]}\n")
             
+            if self.compression_config.api_backends:
+                self.ai_result_text.insert(tk.END, "-" * 40 + "\n服务商路由统计:\n")
+                for line in self.compression_client.provider_registry.describe():
+                    self.ai_result_text.insert(tk.END, f"  {line}\n")
+            
             if response.status_code == 200:
                 messagebox.showinfo("成功", "API 连接测试成功！")
                 self.status_var.set("API 测试成功")
@@ -783,90 +933,21 @@ class TokenViewerApp:
         return f"{SHORT_TERM_PREFIX}{id_num:02d}"
         
     def parse_memory_structure(self):
-        """解析当前文件的记忆结构 - 只解析message类型"""
-        character = None    # 人设/初始化记忆 (baizhi00)
-        long_term = None    # 长期记忆 (baizhi52)
-        mid_term = None     # 中期记忆 (baizhi20)
-        short_terms = []    # 短期记忆 (白芷01-19 + 其他)
-        other_messages = [] # 其他message类型（非标准ID的）
-        
-        for i, line in enumerate(self.all_lines):
-            try:
-                data = json.loads(line.strip())
-                msg_type = data.get('type', '')
-                msg_id = data.get('id', '')
-                
-                # 只解析message类型，忽略session/model_change等非message类型
-                if msg_type == 'message':
-                    if msg_id == CHARACTER_ID:
-                        character = {'index': i, 'data': data, 'line': line}
-                    elif msg_id == LONG_TERM_ID:
-                        long_term = {'index': i, 'data': data, 'line': line}
-                    elif msg_id == MID_TERM_ID:
-                        mid_term = {'index': i, 'data': data, 'line': line}
-                    elif msg_id.startswith(SHORT_TERM_PREFIX):
-                        short_terms.append({'index': i, 'data': data, 'line': line})
-                    else:
-                        # 其他message类型，视为短期记忆
-                        other_messages.append({'index': i, 'data': data, 'line': line})
-                        
-            except:
-                pass
-        
-        # 将其他message也加入短期记忆
-        short_terms.extend(other_messages)
-        short_terms.sort(key=lambda x: x['index'])
-                
-        return {
-            'character': character,
-            'long_term': long_term,
-            'mid_term': mid_term,
-            'short_terms': short_terms
-        }
+        """解析当前文件的记忆结构 - 只解析message类型（读取共享的解析模型）"""
+        return self.session.memory_structure()
         
     def extract_message_text(self, msg_data):
         """从消息数据中提取文本"""
-        msg = msg_data.get('message', {})
-        content = msg.get('content', [])
-        if content and isinstance(content, list):
-            for item in content:
-                if isinstance(item, dict) and item.get('type') == 'text':
-                    return item.get('text', '')
-        return ''
+        return extract_message_text(msg_data)
     
+
     def calculate_estimated_tokens(self):
         """计算拟合Token数（基于文本内容）
         
-        计算规则：
-        - assistant角色（初始化+记忆）：字符数 ≈ token数
-        - extern消息（外部高频数据）：固定50 token/条（小数据高频）
+        所有角色的文本都经 TokenCounter 分词计数（含每条消息的格式开销），
+        每行的贡献在解析时缓存，这里直接读取解析模型维护的累计和。
         """
-        total_tokens = 0
-        extern_count = 0
-        
-        for line in self.all_lines:
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') == 'message':
-                    msg = data.get('message', {})
-                    role = msg.get('role', '')
-                    msg_id = data.get('id', '')
-                    content = msg.get('content', [])
-                    
-                    # extern消息：固定50 token（小数据高频更新）
-                    if role == 'toolResult' and msg_id.startswith('extern'):
-                        extern_count += 1
-                        total_tokens += 50  # 固定50 token/条
-                    # assistant角色：字符数 ≈ token数
-                    elif role == 'assistant' and isinstance(content, list):
-                        for item in content:
-                            if isinstance(item, dict) and item.get('type') == 'text':
-                                text = item.get('text', '')
-                                total_tokens += len(text)
-            except:
-                pass
-        
-        return total_tokens
+        return self.session.estimated_tokens
     
     def get_effective_tokens(self):
         """获取有效的Token数
@@ -875,145 +956,95 @@ class TokenViewerApp:
         - 压缩后30秒内：使用拟合Token
         - 30秒后：如果官方Token更新了，使用官方Token
         """
-        current_time = time.time()
-        time_since_compression = current_time - self.last_compression_time
-        
-        # 计算拟合Token
         self.estimated_tokens = self.calculate_estimated_tokens()
-        
-        # 压缩后30秒内，使用拟合Token
-        if time_since_compression < 30:
-            self.use_official_tokens = False
-            return self.estimated_tokens
-        
-        # 30秒后，尝试使用官方Token
-        try:
-            if SESSIONS_JSON.exists():
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                for key, value in data.items():
-                    if key.startswith("agent:") and value.get('sessionId') == self.current_session_id:
-                        official = value.get('totalTokens', 0)
-                        # 如果官方Token变化了，说明已更新
-                        if official != self.official_tokens and official > 0:
-                            self.official_tokens = official
-                            self.use_official_tokens = True
-                        break
-        except:
-            pass
-        
-        # 如果官方数据可用且已更新，使用官方；否则使用拟合
-        if self.use_official_tokens and self.official_tokens > 0:
-            return self.official_tokens
-        return self.estimated_tokens
+        return pick_effective_tokens(self, self.estimated_tokens,
+                                     self.sessions_registry, self.current_session_id)
     
+
     def is_ai_outputting(self):
         """检查AI是否正在输出（近10秒内有assistant消息且id非extern）
         
         用于避免在AI输出期间触发自动压缩
         """
-        current_time = time.time()
-        
-        # 检查最近的消息
-        for line in reversed(self.all_lines[-10:]):  # 只检查最近10条
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') == 'message':
-                    msg = data.get('message', {})
-                    role = msg.get('role', '')
-                    msg_id = data.get('id', '')
-                    timestamp = data.get('timestamp', '')
-                    
-                    # 如果是assistant角色且id非extern
-                    if role == 'assistant' and not msg_id.startswith('extern'):
-                        # 解析时间戳
-                        try:
-                            msg_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                            msg_timestamp = msg_time.timestamp()
-                            # 如果在近10秒内
-                            if current_time - msg_timestamp < 10:
-                                return True
-                        except:
-                            pass
-            except:
-                pass
-        
-        return False
+        return is_ai_outputting(self.session.records)
         
+
     def create_memory_message(self, msg_id, text, role='assistant'):
         """创建记忆消息（默认role=assistant，让AI助手能读取）"""
-        return {
-            "type": "message",
-            "id": msg_id,
-            "timestamp": datetime.now().isoformat() + "Z",
-            "message": {
-                "role": role,
-                "content": [{"type": "text", "text": text}]
-            }
-        }
+        return create_memory_message(msg_id, text, role)
         
-    def call_ai_compression(self, content_to_compress):
-        """调用 AI 进行压缩"""
-        api_key = self.api_key_entry.get()
-        if not api_key:
-            raise Exception("未设置 API Key")
-            
-        provider = self.api_provider_var.get()
-        url = API_TEMPLATES[provider]['url']
-        model = self.model_combo.get()
-            
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+
+    def call_ai_compression(self, content_to_compress, label=None):
+        """调用 AI 进行压缩（复用服务商的连接池）
         
-        # Kimi Code 需要特殊 headers
-        if provider == 'kimicode':
-            headers["User-Agent"] = "claude-code/0.1.0"
-            headers["X-Client-Name"] = "claude-code"
+        label: 流式输出时结果区显示的标题（为 None 时不显示过程）
+        """
+        labels = [label] if label else None
+        return self.call_ai_compression_many([content_to_compress], labels)[0]
+    
+    def call_ai_compression_many(self, contents, labels=None):
+        """并发调用 AI 压缩多段内容，按顺序返回结果（总耗时约为一次往返）
         
-        prompt = f"""{self.compression_config.compression_prompt}
-
-{content_to_compress}"""
-
-        # kimi-k2.5 模型只支持 temperature=1
-        temp = 1.0 if 'k2.5' in model else 0.3
-
-        data = {
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 2000,
-            "temperature": temp
-        }
+        开启流式输出且提供 labels 时，各段内容边生成边显示在结果区；
+        缓存、多服务商路由和断流处理见 CompressionClient.summarize_many。
+        """
+        if not self.has_api_key():
+            raise Exception("未设置 API Key")
         
-        try:
-            response = requests.post(url, headers=headers, json=data, timeout=60)
+        on_delta = None
+        if labels and self.compression_config.stream_output:
+            on_delta = self.begin_stream_display(labels)
+        return self.compression_client.summarize_many(
+            contents, self.api_provider_var.get(), self.model_combo.get(),
+            self.api_key_entry.get(), on_delta)
+    
 
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    # 检查 API 返回的错误
-                    if 'error' in result:
-                        raise Exception(f"API 返回错误: {result['error']}")
-                    if 'choices' not in result or not result['choices']:
-                        raise Exception(f"API 返回格式异常: {result}")
-                    message = result['choices'][0].get('message', {})
-                    if not message:
-                        raise Exception(f"API 返回的 message 为空: {result['choices'][0]}")
-                    # Kimi Code 可能返回 reasoning_content
-                    content = message.get('content', '')
-                    if not content:
-                        content = message.get('reasoning_content', '')
-                    return content.strip() if content else "(无回复)"
-                except (KeyError, IndexError, json.JSONDecodeError) as e:
-                    raise Exception(f"解析 API 响应失败: {e}, 响应: {response.text[:500]}")
-            else:
-                raise Exception(f"API 错误: {response.status_code} - {response.text[:500]}")
-        except requests.exceptions.Timeout:
-            raise Exception("API 请求超时")
-        except requests.exceptions.ConnectionError:
-            raise Exception("无法连接到 API，请检查网络")
+    def begin_stream_display(self, labels):
+        """开始在结果区流式显示多段内容
+        
+        返回 on_delta(index, text) 回调，可在后台线程调用；
+        界面最多每 stream_refresh_interval 毫秒重绘一次，避免逐字刷新拖慢主线程。
+        各段之间用分隔线隔开，格式与"应用压缩"的解析一致。
+        """
+        state = {'parts': [[] for _ in labels], 'pending': False}
+        lock = threading.Lock()
+        self.stream_display = state
+        
+        def render():
+            with lock:
+                state['pending'] = False
+                sections = [f"{label}\n{''.join(parts)}" for label, parts in zip(labels, state['parts'])]
+            # 已开始新的流式显示时不再覆盖
+            if self.stream_display is not state:
+                return
+            self.ai_result_text.delete(1.0, tk.END)
+            self.ai_result_text.insert(tk.END, ("\n" + "=" * 40 + "\n").join(sections))
+            self.ai_result_text.see(tk.END)
+        
+        def on_delta(index, text):
+            with lock:
+                state['parts'][index].append(text)
+                if state['pending']:
+                    return
+                state['pending'] = True
+            self.root.after(self.stream_refresh_interval, render)
+        
+        self.root.after(0, render)
+        return on_delta
             
+    def build_incremental_compression(self, memory):
+        """增量压缩：找出上次压缩之后的新对话，构建长期/中期记忆的请求内容
+        
+        返回: {'long', 'mid', 'folded_until', 'count'}，没有新增对话时返回 None
+        """
+        return build_incremental_plan(memory, self.condense_history)
+    
+
+    def condense_history(self, texts):
+        """把对话历史压到一次请求的预算内（超出 summary_chunk_tokens 时分块并发摘要后合并）"""
+        return self.compression_client.condense(texts, self.call_ai_compression)
+    
+
     def manual_compress_with_auto(self):
         """立即压缩（带自动压缩选项）"""
         # 如果勾选了自动压缩，启动自动压缩循环
@@ -1049,20 +1080,19 @@ class TokenViewerApp:
             messagebox.showwarning("警告", "请先选择会话")
             return
             
-        api_key = self.api_key_entry.get()
-        if not api_key:
+        if not self.has_api_key():
             messagebox.showerror("错误", "请先输入 API Key")
             return
         
         # 获取当前模式
         mode = self.compress_mode_var.get()
         
-        # 在后台线程执行压缩
-        def compress_worker():
+        # 在主线程取记忆结构快照（后台任务不再读取会被刷新修改的数据）
+        memory = self.snapshot_memory_structure()
+        
+        # 在压缩任务队列中执行
+        def compress_worker(job):
             try:
-                # 解析当前记忆结构
-                memory = self.parse_memory_structure()
-                
                 # 提取人设记忆（baizhi00）- 不压缩，直接保留
                 character_content = ""
                 if memory['character']:
@@ -1077,12 +1107,12 @@ class TokenViewerApp:
                 if memory['mid_term']:
                     mid_content = self.extract_message_text(memory['mid_term']['data'])
                 
-                # 收集短期记忆内容（实际的对话历史）
+                # 收集短期记忆内容（实际的对话历史，完整保留，过长时分层摘要）
                 short_contents = []
                 for short in memory['short_terms']:
                     text = self.extract_message_text(short['data'])
                     if text and len(text) > 10:  # 过滤太短的
-                        short_contents.append(text[:1000])  # 每条最多 1000 字
+                        short_contents.append(text)
                 
                 # 构建要压缩的实际内容
                 if not short_contents:
@@ -1101,12 +1131,13 @@ class TokenViewerApp:
                         all_history.append(f"【之前的长期记忆】{long_content[:3000]}")
                     if mid_content:
                         all_history.append(f"【之前的中期记忆】{mid_content[:3000]}")
-                    all_history.append("【最近对话历史】")
-                    all_history.extend(short_contents[-20:])
+                    all_history.append("【对话历史】")
+                    all_history.append(self.condense_history(short_contents))
                     
                     history_text = "\n\n".join(all_history)
                     combined_prompt = f"{self.compression_config.compression_prompt}\n\n{history_text}"
-                    new_long_text = self.call_ai_compression(combined_prompt)
+                    new_long_text = self.call_ai_compression(combined_prompt, "【新的记忆】")
+                    job.check()
                     
                     # 在主线程更新 UI
                     def update_ui_normal():
@@ -1114,9 +1145,30 @@ class TokenViewerApp:
                         self.ai_result_text.delete(1.0, tk.END)
                         self.ai_result_text.insert(tk.END, result_text)
                         self.auto_compress_status = f"正常模式压缩完成 [{datetime.now().strftime('%H:%M:%S')}]"
+                        self.manual_folded_until = None
                     
                     self.root.after(0, update_ui_normal)
                     
+                elif mode == '增量模式':
+                    # 增量模式：只把上次压缩之后的新对话合并进已有记忆
+                    plan = self.build_incremental_compression(memory)
+                    if not plan:
+                        self.root.after(0, lambda: self.status_var.set("增量模式：没有新增对话需要合并"))
+                        return
+                    self.root.after(0, lambda: self.status_var.set(f"增量模式：合并 {plan['count']} 条新对话..."))
+                    new_long_text, new_mid_text = self.call_ai_compression_many(
+                        [plan['long'], plan['mid']], ["【新的长期记忆】", "【新的中期记忆】"])
+                    job.check()
+                    
+                    def update_ui_incremental():
+                        result_text = f"【新的长期记忆】\n{new_long_text}\n{'=' * 40}\n【新的中期记忆】\n{new_mid_text}"
+                        self.ai_result_text.delete(1.0, tk.END)
+                        self.ai_result_text.insert(tk.END, result_text)
+                        self.auto_compress_status = f"增量模式压缩完成 [{datetime.now().strftime('%H:%M:%S')}]"
+                        self.manual_folded_until = (job.key, plan['folded_until'])
+                    
+                    self.root.after(0, update_ui_incremental)
+                    
                 elif mode == '吐槽模式':
                     self.root.after(0, lambda: self.status_var.set("吐槽模式：正在吐槽先前内容..."))
                     # 吐槽模式：对先前内容进行吐槽
@@ -1128,20 +1180,24 @@ class TokenViewerApp:
                     if mid_content:
                         all_history.append(f"【之前的中期记忆】{mid_content[:1000]}")
                     all_history.append("【最近对话历史】")
-                    all_history.extend(short_contents[-5:])
+                    all_history.extend(text[:1000] for text in short_contents[-5:])
                     
                     history_text = "\n\n".join(all_history)
                     tsukkomi_prompt = f"{self.compression_config.tsukkomi_prompt}\n\n{history_text}"
-                    tsukkomi_text = self.call_ai_compression(tsukkomi_prompt)
+                    tsukkomi_text = self.call_ai_compression(tsukkomi_prompt, "【吐槽内容】")
+                    job.check()
                     
                     def update_ui_tsukkomi():
                         result_text = f"【吐槽内容】\n{tsukkomi_text}"
                         self.ai_result_text.delete(1.0, tk.END)
                         self.ai_result_text.insert(tk.END, result_text)
                         self.auto_compress_status = f"吐槽模式完成 [{datetime.now().strftime('%H:%M:%S')}]"
+                        self.manual_folded_until = None
                     
                     self.root.after(0, update_ui_tsukkomi)
                 
+            except JobCancelled:
+                raise
             except Exception as e:
                 import traceback
                 error_detail = traceback.format_exc()
@@ -1154,31 +1210,46 @@ class TokenViewerApp:
                 
                 self.root.after(0, show_error)
         
-        # 启动后台线程
-        thread = threading.Thread(target=compress_worker, daemon=True)
-        thread.start()
+        # 提交任务（同一会话同时只有一个压缩任务）
+        job, created = self.compression_jobs.submit(
+            self.current_session_id, compress_worker,
+            timeout=self.compression_config.compress_job_timeout,
+            on_done=self.on_compression_job_done, name="手动压缩")
+        self.report_job_submission(job, created)
+    
+    def snapshot_memory_structure(self):
+        """记忆结构的快照（短期记忆列表为副本，可安全交给后台任务）"""
+        memory = self.parse_memory_structure()
+        memory['short_terms'] = list(memory['short_terms'])
+        return memory
+    
+    def report_job_submission(self, job, created):
+        """在状态栏显示任务提交结果"""
+        if job is None:
+            self.status_var.set("压缩任务过多，本次触发已忽略")
+        elif not created:
+            self.status_var.set(f"{job.describe()}，本次触发已合并")
+        else:
+            self.status_var.set(f"{job.describe()}...")
+    
+    def on_compression_job_done(self, job):
+        """压缩任务结束（在任务线程中调用，转到主线程更新状态）"""
+        def update():
+            time_str = datetime.now().strftime('%H:%M:%S')
+            if job.state != 'done':
+                self.auto_compress_status = f"{job.describe()} [{time_str}]"
+                self.status_var.set(self.auto_compress_status)
+        self.root.after(0, update)
+    
+    def cancel_compression_jobs(self):
+        """取消排队和执行中的压缩任务"""
+        count = self.compression_jobs.cancel()
+        if count:
+            print(f"[压缩任务] 已取消 {count} 个任务")
             
     def find_compact_marker_index(self):
-        """查找 compact 标记的位置（通过 summary 字段标识）"""
-        for i, line in enumerate(self.all_lines):
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') == 'message':
-                    # 检查是否有 summary 字段且值为 "AI总结占位"
-                    if data.get('summary') == "AI总结占位":
-                        return i
-                    # 或者检查消息内容是否包含占位标识（兼容旧版本）
-                    msg = data.get('message', {})
-                    content = msg.get('content', [])
-                    if content and isinstance(content, list):
-                        for item in content:
-                            if isinstance(item, dict) and item.get('type') == 'text':
-                                text = item.get('text', '')
-                                if 'summary: AI总结占位' in text or '===COMPACT===' in text:
-                                    return i
-            except:
-                pass
-        return -1
+        """查找 compact 标记的位置（通过 summary 字段标识，读取索引）"""
+        return self.session.compact_index
 
     def apply_compression(self):
         """应用 AI 压缩结果 - 首次：替换第一个user为compact标记；后续：从compact标记开始替换"""
@@ -1224,82 +1295,7 @@ class TokenViewerApp:
                 new_mid_text = self.extract_message_text(memory['mid_term']['data'])
 
             # 备份
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
-
-            # 查找是否已存在 compact 标记
-            compact_index = self.find_compact_marker_index()
-            
-            # 构建新的文件内容
-            new_lines = []
-            insert_index = -1  # 标记插入位置
-
-            if compact_index == -1:
-                # 首次压缩：找到第一个user，将其位置替换为compact标记
-                first_user_index = -1
-                for i, line in enumerate(self.all_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            msg = data.get('message', {})
-                            role = msg.get('role', '')
-                            if role == 'user':
-                                first_user_index = i
-                                break
-                    except:
-                        pass
-                
-                if first_user_index == -1:
-                    messagebox.showwarning("警告", "没有找到user消息，无法应用压缩")
-                    return
-                
-                # 保留第一个user之前的所有行
-                new_lines.extend(self.all_lines[:first_user_index])
-                insert_index = first_user_index
-                
-                # 找到最后一个保留的message的id作为compact的parentId
-                last_retained_msg_id = None
-                for line in reversed(new_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            last_retained_msg_id = data.get('id')
-                            break
-                    except:
-                        pass
-            else:
-                # 后续压缩：保留compact标记之前的所有行（包括compact标记本身的位置）
-                new_lines.extend(self.all_lines[:compact_index])
-                insert_index = compact_index
-                
-                # 找到最后一个保留的message的id作为compact的parentId
-                last_retained_msg_id = None
-                for line in reversed(new_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            last_retained_msg_id = data.get('id')
-                            break
-                    except:
-                        pass
-
-            # 创建 compact 标记消息（包含 summary 字段作为标识符）
-            compact_msg = self.create_memory_message(CHARACTER_ID, "===COMPACT===\nsummary: AI总结占位")
-            compact_msg['summary'] = "AI总结占位"  # 添加标识字段
-            compact_msg['parentId'] = last_retained_msg_id
-            new_lines.append(json.dumps(compact_msg, ensure_ascii=False) + "\n")
-
-            # 添加 baizhi52 长期记忆
-            long_msg = self.create_memory_message(LONG_TERM_ID, new_long_text)
-            long_msg['parentId'] = CHARACTER_ID
-            new_lines.append(json.dumps(long_msg, ensure_ascii=False) + "\n")
-
-            # 添加 baizhi20 中期记忆
-            mid_msg = self.create_memory_message(MID_TERM_ID, new_mid_text)
-            mid_msg['parentId'] = LONG_TERM_ID
-            new_lines.append(json.dumps(mid_msg, ensure_ascii=False) + "\n")
+            backup_name = self.backup_session("应用压缩")
 
             # 保留最近5条原始对话消息（排除之前压缩生成的消息）
             # 只保留 role 为 user 或 assistant 的原始消息
@@ -1313,41 +1309,33 @@ class TokenViewerApp:
                 if role in ['user', 'assistant'] and not msg_id.startswith('extern') and not msg_id.startswith('baizhi'):
                     original_messages.append(short)
             
-            recent_shorts = original_messages[-5:]
-            last_short_id = None
-            for i, short in enumerate(recent_shorts):
-                short_data = short['data'].copy()
-                if i == 0:
-                    # 第一条短期记忆的parentId指向中期记忆
-                    short_data['parentId'] = MID_TERM_ID
-                new_lines.append(json.dumps(short_data, ensure_ascii=False) + "\n")
-                last_short_id = short_data.get('id')
-
-            # 只有吐槽模式才添加第6条（baizhi21）
-            mode = self.compress_mode_var.get()
-            if mode == '吐槽模式':
-                # 吐槽模式：第6句放吐槽内容
-                mode_content = ""
+            # 只有吐槽模式才添加第6条（baizhi21）：第6句放吐槽内容
+            mode_content = None
+            if self.compress_mode_var.get() == '吐槽模式':
                 if "=" * 20 in result_text:
                     parts = result_text.split("=" * 20)
                     if len(parts) > 2:
                         mode_content = parts[-1].strip()
                 if not mode_content:
                     mode_content = result_text
-                
-                if mode_content:
-                    mode_msg = self.create_memory_message(MODE_MESSAGE_ID, mode_content)
-                    if last_short_id:
-                        mode_msg['parentId'] = last_short_id
-                    else:
-                        mode_msg['parentId'] = MID_TERM_ID
-                    new_lines.append(json.dumps(mode_msg, ensure_ascii=False) + "\n")
-
-            # 保存 jsonl 文件
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
+            
+            # 增量模式：带上本会话手动压缩得到的高水位标记（与静默应用相同），下次只合并之后的新对话
+            folded_until = None
+            if (self.compress_mode_var.get() == '增量模式' and self.manual_folded_until
+                    and self.manual_folded_until[0] == self.current_session_id):
+                folded_until = self.manual_folded_until[1]
+            
+            # 构建新的文件内容（首次：第一个user替换为compact标记；后续：从compact标记开始替换）
+            compact_index = self.find_compact_marker_index()
+            new_lines = build_compressed_lines(self.session, self.all_lines, new_long_text, new_mid_text,
+                                               original_messages[-5:], mode_content, folded_until)
+            if new_lines is None:
+                messagebox.showwarning("警告", "没有找到user消息，无法应用压缩")
+                return
 
-            self.all_lines = new_lines
+            # 保存 jsonl 文件（原子改写）
+            self.rewrite_session_file(new_lines)
+            self.manual_folded_until = None
             
             # 更新 sessions.json 中的 token 统计
             self.update_sessions_json_after_compression()
@@ -1356,7 +1344,7 @@ class TokenViewerApp:
             self.last_compression_time = time.time()
             self.use_official_tokens = False  # 压缩后30秒内使用拟合Token
             
-            self.status_var.set(f"压缩已应用，备份: {backup_path.name}")
+            self.status_var.set(f"压缩已应用，备份: {backup_name}")
             
             # 根据静默模式决定是否显示弹窗
             if not self.compression_config.silent_mode:
@@ -1375,38 +1363,14 @@ class TokenViewerApp:
     def update_sessions_json_after_compression(self):
         """压缩后更新 sessions.json 中的 token 统计"""
         try:
-            if not SESSIONS_JSON.exists():
-                return
-            
-            # 计算新的行数和估计的 token 数
-            new_line_count = len(self.all_lines)
-            
-            # 估算 token 数（简化估算：每行大约 100-200 tokens）
-            estimated_tokens = new_line_count * 150
-            
-            # 读取并更新 sessions.json
-            with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            updated = False
-            for key, value in data.items():
-                if key.startswith("agent:") and value.get('sessionId') == self.current_session_id:
-                    # 更新 token 数（取估计值和原值的较小者，避免过度估算）
-                    old_tokens = value.get('totalTokens', 0)
-                    new_tokens = min(estimated_tokens, old_tokens) if old_tokens > 0 else estimated_tokens
-                    value['totalTokens'] = new_tokens
-                    value['inputTokens'] = int(new_tokens * 0.7)  # 估算输入占 70%
-                    value['outputTokens'] = int(new_tokens * 0.3)  # 估算输出占 30%
-                    updated = True
-                    break
-            
-            if updated:
-                with open(SESSIONS_JSON, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                
+            # 同步改写后的文件，按分词计数得到新的 token 数
+            self.sync_session_lines()
+            update_session_tokens(self.sessions_registry, self.current_session_id,
+                                  self.session.estimated_tokens)
         except Exception as e:
             print(f"更新 sessions.json 失败: {e}")
             
+
     def copy_ai_result(self):
         """复制 AI 结果"""
         text = self.ai_result_text.get(1.0, tk.END)
@@ -1419,28 +1383,38 @@ class TokenViewerApp:
         self.ai_result_text.delete(1.0, tk.END)
         
     def load_sessions(self):
-        """加载会话列表"""
+        """加载会话列表（保持当前选中的会话）
+        
+        返回: 是否切换了会话
+        """
         try:
             sessions = []
-            if SESSIONS_JSON.exists():
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key, value in data.items():
-                        if key.startswith("agent:"):
-                            session_id = value.get('sessionId', 'unknown')
-                            model = value.get('model', 'unknown')
-                            total = value.get('totalTokens', 0)
-                            sessions.append(f"{session_id} | {model} | {total} tokens")
+            session_ids = []
+            for key, value in self.sessions_registry.agent_sessions():
+                session_id = value.get('sessionId', 'unknown')
+                model = value.get('model', 'unknown')
+                total = value.get('totalTokens', 0)
+                sessions.append(f"{session_id} | {model} | {total} tokens")
+                session_ids.append(session_id)
                             
             if sessions:
-                self.session_combo['values'] = sessions
+                if tuple(self.session_combo['values']) != tuple(sessions):
+                    self.session_combo['values'] = sessions
+                if self.current_session_id in session_ids:
+                    # 当前会话仍存在：只更新显示文本，不触发重新加载
+                    index = session_ids.index(self.current_session_id)
+                    if self.session_combo.get() != sessions[index]:
+                        self.session_combo.current(index)
+                    return False
                 self.session_combo.current(0)
                 self.on_session_selected(None)
+                return True
             else:
                 self.session_combo['values'] = ["无可用会话"]
                 
         except Exception as e:
             messagebox.showerror("错误", f"加载会话失败: {e}")
+        return False
             
     def on_session_selected(self, event):
         """选择会话时"""
@@ -1449,14 +1423,19 @@ class TokenViewerApp:
             return
             
         session_id = selection.split(" | ")[0]
+        if session_id != self.current_session_id:
+            # 切换会话：上一个会话的压缩结果不能再应用
+            self.cancel_compression_jobs()
         self.current_session_id = session_id
         self.current_jsonl_path = SESSIONS_DIR / f"{session_id}.jsonl"
+        self.session_tailer.reset(self.current_jsonl_path)
+        self.session.load([])
         self.all_lines = []
         self.all_messages = []
         
         # 切换会话时，清空文件监控缓存（确保新对话能重新读取）
         print(f"[文件监控] 切换会话到: {session_id}，清空缓存")
-        self.file_monitor_last_lines = []
+        self.reset_file_monitor_reader()
         
         # 如果文件监控在自动模式，退回手动模式
         if self.file_monitor_auto_mode:
@@ -1475,8 +1454,7 @@ class TokenViewerApp:
         try:
             # 优先从jsonl文件直接读取（实时）
             if self.current_jsonl_path and self.current_jsonl_path.exists():
-                with open(self.current_jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    self.all_lines = f.readlines()
+                self.sync_session_lines()
                 
                 line_count = len(self.all_lines)
                 self.stats_labels["line_count"].config(text=f"{line_count}")
@@ -1507,24 +1485,20 @@ class TokenViewerApp:
             
             # 尝试从sessions.json获取更准确的token数（如果有的话）
             try:
-                if SESSIONS_JSON.exists():
-                    with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    for key, value in data.items():
-                        if value.get('sessionId') == self.current_session_id:
-                            # 如果sessions.json的token数更大，使用它
-                            json_tokens = value.get('totalTokens', 0)
-                            current_display = int(self.stats_labels["total_tokens"].cget("text").replace(',', ''))
-                            if json_tokens > current_display:
-                                self.stats_labels["total_tokens"].config(text=f"{json_tokens:,}")
-                                input_tokens = value.get('inputTokens', int(json_tokens * 0.7))
-                                output_tokens = value.get('outputTokens', int(json_tokens * 0.3))
-                                self.stats_labels["input_tokens"].config(text=f"{input_tokens:,}")
-                                self.stats_labels["output_tokens"].config(text=f"{output_tokens:,}")
-                                context_tokens = value.get('contextTokens', 262144)
-                                usage = (json_tokens / context_tokens) * 100
-                                self.stats_labels["usage_percent"].config(text=f"{usage:.1f}%")
-                            break
+                value = self.sessions_registry.get(self.current_session_id)
+                if value:
+                    # 如果sessions.json的token数更大，使用它
+                    json_tokens = value.get('totalTokens', 0)
+                    current_display = int(self.stats_labels["total_tokens"].cget("text").replace(',', ''))
+                    if json_tokens > current_display:
+                        self.stats_labels["total_tokens"].config(text=f"{json_tokens:,}")
+                        input_tokens = value.get('inputTokens', int(json_tokens * 0.7))
+                        output_tokens = value.get('outputTokens', int(json_tokens * 0.3))
+                        self.stats_labels["input_tokens"].config(text=f"{input_tokens:,}")
+                        self.stats_labels["output_tokens"].config(text=f"{output_tokens:,}")
+                        context_tokens = value.get('contextTokens', 262144)
+                        usage = (json_tokens / context_tokens) * 100
+                        self.stats_labels["usage_percent"].config(text=f"{usage:.1f}%")
             except:
                 pass
             
@@ -1532,96 +1506,48 @@ class TokenViewerApp:
             self.status_var.set(f"刷新失败: {e}")
             
     def load_history(self):
-        """加载历史记录"""
+        """加载历史记录（会话只追加时增量更新，列表只渲染可见行）"""
         if not self.current_jsonl_path or not self.current_jsonl_path.exists():
             return
             
         try:
-            self.history_listbox.delete(0, tk.END)
-            self.history = []
-            self.all_messages = []
-            
             count_str = self.history_count_var.get()
             max_count = 999999 if count_str == "全部" else int(count_str)
-            
-            # 解析所有消息
-            for i, line in enumerate(self.all_lines):
-                try:
-                    data = json.loads(line.strip())
-                    if data.get('type') == 'message':
-                        msg = data.get('message', {})
-                        role = msg.get('role', 'unknown')
-                        timestamp = data.get('timestamp', '')
-                        msg_id = data.get('id', '')
-                        
-                        # 标记记忆类型
-                        memory_type = "普通"
-                        if msg_id == CHARACTER_ID:
-                            memory_type = "【人设】"
-                        elif msg_id == LONG_TERM_ID:
-                            memory_type = "【长期】"
-                        elif msg_id == MID_TERM_ID:
-                            memory_type = "【中期】"
-                        elif msg_id.startswith(SHORT_TERM_PREFIX):
-                            memory_type = "【短期】"
-                        
-                        content = msg.get('content', [])
-                        text = ""
-                        attachments = []
-                        
-                        if content and isinstance(content, list):
-                            for item in content:
-                                if isinstance(item, dict):
-                                    if item.get('type') == 'text':
-                                        text = item.get('text', '')
-                                    elif item.get('type') == 'image':
-                                        attachments.append('[图片]')
-                                    elif item.get('type') == 'file':
-                                        attachments.append(f"[文件]")
-                        
-                        msg_obj = {
-                            'line_num': i + 1,
-                            'role': role,
-                            'memory_type': memory_type,
-                            'timestamp': timestamp,
-                            'text': text,
-                            'attachments': attachments,
-                            'data': data,
-                            'line': line
-                        }
-                        self.all_messages.append(msg_obj)
-                except:
-                    pass
-            
-            # 筛选
             filter_type = self.filter_var.get()
-            filtered = [m for m in self.all_messages if filter_type == "all" or m['role'] == filter_type]
-            
-            # 显示
-            display_messages = list(reversed(filtered[-max_count:]))
             
-            for msg in display_messages:
-                self.history.append(msg)
-                
-                time_str = msg['timestamp'][11:19] if msg['timestamp'] else '??'
-                preview = msg['text'][:25].replace('\n', ' ') if msg['text'] else '(无文本)'
-                attach_str = f"[{len(msg['attachments'])}]" if msg['attachments'] else ""
-                display = f"{msg['memory_type']}[{msg['role'][:3]}] {time_str} {attach_str} {preview}"
-                
-                # 根据记忆类型设置颜色
-                if msg['memory_type'] == "【人设】":
-                    color = '#FF5722'  # 深橙色（人设最重要）
-                elif msg['memory_type'] == "【长期】":
-                    color = '#E91E63'  # 粉色
-                elif msg['memory_type'] == "【中期】":
-                    color = '#9C27B0'  # 紫色
-                elif msg['memory_type'] == "【短期】":
-                    color = '#FF9800'  # 橙色
-                else:
-                    color = ROLE_COLORS.get(msg['role'], 'black')
-                
-                self.history_listbox.insert(tk.END, display)
-                self.history_listbox.itemconfig(tk.END, {'fg': color})
+            # 消息已由共享解析模型解码，这里直接使用
+            self.all_messages = self.session.messages
+            messages = self.all_messages
+            
+            # 会话只追加且显示条件未变：只处理新增消息
+            view = self.history_view
+            incremental = (view is not None
+                           and view['state'] == (filter_type, max_count)
+                           and view['source'] is messages
+                           and view['count'] <= len(messages)
+                           and (view['count'] == 0 or messages[view['count'] - 1] is view['last']))
+            
+            if incremental:
+                new_messages = [m for m in messages[view['count']:]
+                                if filter_type == "all" or m['role'] == filter_type]
+                new_messages.reverse()
+                self.history[0:0] = new_messages
+                del self.history[max_count:]
+                self.history_list.prepend([self.format_history_row(m) for m in new_messages])
+                self.history_list.truncate(max_count)
+            else:
+                # 筛选
+                filtered = [m for m in messages if filter_type == "all" or m['role'] == filter_type]
+                # 显示（最新的在最上方）
+                self.history = list(reversed(filtered[-max_count:]))
+                self.history_list.set_rows([self.format_history_row(m) for m in self.history])
+            
+            self.history_view = {
+                'state': (filter_type, max_count),
+                'source': messages,
+                'count': len(messages),
+                'last': messages[-1] if messages else None,
+            }
                 
             # 合并显示加载数量、时间和自动压缩状态
             time_str = datetime.now().strftime('%H:%M:%S')
@@ -1633,13 +1559,34 @@ class TokenViewerApp:
         except Exception as e:
             self.status_var.set(f"加载历史失败: {e}")
             
+    def format_history_row(self, msg):
+        """生成历史列表的一行: (key, 显示文本, 颜色)"""
+        time_str = msg['timestamp'][11:19] if msg['timestamp'] else '??'
+        preview = msg['text'][:25].replace('\n', ' ') if msg['text'] else '(无文本)'
+        attach_str = f"[{len(msg['attachments'])}]" if msg['attachments'] else ""
+        display = f"{msg['memory_type']}[{msg['role'][:3]}] {time_str} {attach_str} {preview}"
+        
+        # 根据记忆类型设置颜色
+        if msg['memory_type'] == "【人设】":
+            color = '#FF5722'  # 深橙色（人设最重要）
+        elif msg['memory_type'] == "【长期】":
+            color = '#E91E63'  # 粉色
+        elif msg['memory_type'] == "【中期】":
+            color = '#9C27B0'  # 紫色
+        elif msg['memory_type'] == "【短期】":
+            color = '#FF9800'  # 橙色
+        else:
+            color = ROLE_COLORS.get(msg['role'], 'black')
+        
+        # 以原始行内容作为 key：会话改写后未变的消息仍保持选中
+        return (msg['line'], display, color)
+            
     def on_history_selected(self, event):
         """选择历史记录时显示详情"""
-        selection = self.history_listbox.curselection()
-        if not selection:
+        index = self.history_list.active_index()
+        if index is None:
             return
             
-        index = selection[0]
         if index < len(self.history):
             msg = self.history[index]
             self.display_message(msg)
@@ -1678,7 +1625,7 @@ class TokenViewerApp:
     
     def delete_selected_history(self):
         """删除选中的历史记录行（支持多选）"""
-        selection = self.history_listbox.curselection()
+        selection = self.history_list.selected_indices()
         if not selection:
             if not self.compression_config.silent_mode:
                 messagebox.showwarning("警告", "请先选择要删除的行")
@@ -1704,27 +1651,21 @@ class TokenViewerApp:
         
         try:
             # 备份文件
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            backup_name = self.backup_session("删除选中行")
             
             # 按降序删除行（从后往前删，避免行号变化）
             new_lines = self.all_lines.copy()
             for line_num in sorted(line_nums, reverse=True):
                 new_lines = new_lines[:line_num-1] + new_lines[line_num:]
             
-            # 保存文件
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-            
-            self.all_lines = new_lines
+            # 保存文件（原子改写）
+            self.rewrite_session_file(new_lines)
             
             # 刷新显示
             self.refresh_current()
             self.load_history()
             
-            self.status_var.set(f"已删除 {len(line_nums)} 行，备份: {backup_path.name}")
+            self.status_var.set(f"已删除 {len(line_nums)} 行，备份: {backup_name}")
             
         except Exception as e:
             if not self.compression_config.silent_mode:
@@ -1765,8 +1706,10 @@ class TokenViewerApp:
             return
             
         try:
-            with open(self.current_jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            with open(self.current_jsonl_path, 'rb') as f:
+                raw = f.read()
+            content = raw.decode('utf-8', errors='ignore')
+            self.edit_base_size = len(raw)  # 保存时合并加载之后追加的内容
                 
             self.edit_text.delete(1.0, tk.END)
             self.edit_text.insert(tk.END, content)
@@ -1790,15 +1733,15 @@ class TokenViewerApp:
                 if line.strip():
                     json.loads(line)
                     
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            backup_name = self.backup_session("保存编辑")
             
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            # 原子改写；加载到编辑区之后 OpenClaw 追加的行会合并到末尾
+            atomic_rewrite(self.current_jsonl_path, content, self.edit_base_size)
+            self.session_tailer.reset()  # 文件已被改写，下次全量同步
+            # 重新载入编辑区（含合并进来的新增行），基准更新为保存后的文件大小，再次保存时仍会合并
+            self.load_file_for_edit()
                 
-            self.status_var.set(f"已保存，备份: {backup_path.name}")
+            self.status_var.set(f"已保存，备份: {backup_name}")
             messagebox.showinfo("成功", f"文件已保存！\n原文件已备份到 backups 目录")
             self.refresh_current()
             
@@ -1824,16 +1767,9 @@ class TokenViewerApp:
             return
             
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            self.backup_session("删除最后N行")
             
-            new_lines = self.all_lines[:-n]
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-                
-            self.all_lines = new_lines
+            self.rewrite_session_file(self.all_lines[:-n])
             self.status_var.set(f"已删除最后 {n} 行")
             self.refresh_current()
             
@@ -1847,14 +1783,8 @@ class TokenViewerApp:
             
         # 找到第一条 message 的位置
         first_msg_index = 0
-        for i, line in enumerate(self.all_lines):
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') == 'message':
-                    first_msg_index = i
-                    break
-            except:
-                pass
+        if self.session.messages:
+            first_msg_index = self.session.messages[0]['index']
         
         max_delete = len(self.all_lines) - first_msg_index - self.compression_config.short_term_keep
         if max_delete <= 0:
@@ -1874,16 +1804,9 @@ class TokenViewerApp:
             return
             
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            self.backup_session("删除前N行")
             
-            new_lines = self.all_lines[n:]
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-                
-            self.all_lines = new_lines
+            self.rewrite_session_file(self.all_lines[n:])
             self.status_var.set(f"已删除前 {n} 行")
             self.refresh_current()
             
@@ -1908,34 +1831,79 @@ class TokenViewerApp:
             return
             
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            self.backup_session("截断")
             
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(self.all_lines[:n])
-                
-            self.all_lines = self.all_lines[:n]
+            self.rewrite_session_file(self.all_lines[:n])
             self.status_var.set(f"已截断为前 {n} 行")
             self.refresh_current()
             
         except Exception as e:
             messagebox.showerror("错误", f"截断失败: {e}")
             
+    def backup_session(self, label=""):
+        """备份当前会话到去重备份仓库，并按保留策略清理旧快照，返回快照名"""
+        name = self.backup_store.snapshot(self.current_jsonl_path, self.current_session_id, label)
+        try:
+            self.backup_store.prune(keep=self.compression_config.backup_keep,
+                                    max_age_days=self.compression_config.backup_max_age_days,
+                                    session_id=self.current_session_id)
+        except Exception as e:
+            print(f"[备份] 清理旧快照失败: {e}")
+        return name
+    
+    def show_restore_backup(self):
+        """显示备份恢复对话框（列出当前会话的快照）"""
+        if not self.current_jsonl_path:
+            messagebox.showwarning("警告", "请先选择会话")
+            return
+        snapshots = self.backup_store.list_snapshots(self.current_session_id)
+        if not snapshots:
+            messagebox.showinfo("提示", "当前会话没有备份")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("恢复备份")
+        dialog.geometry("420x320")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        listbox = tk.Listbox(dialog, font=("Consolas", 9))
+        listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        for snapshot in snapshots:
+            created = datetime.fromtimestamp(snapshot['created']).strftime("%m-%d %H:%M:%S")
+            label = snapshot.get('label', '')
+            listbox.insert(tk.END, f"{created}  {snapshot['size'] // 1024:>6} KB  {label}")
+        
+        def restore():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            snapshot = snapshots[selection[0]]
+            if not messagebox.askyesno("确认", f"确定用备份 {snapshot['name']} 覆盖当前会话吗？\n（当前内容会先备份）"):
+                return
+            try:
+                self.backup_session("恢复前")
+                self.backup_store.restore(snapshot['name'], self.current_jsonl_path)
+                self.session_tailer.reset()  # 文件已被改写，下次全量同步
+                dialog.destroy()
+                self.status_var.set(f"已恢复备份: {snapshot['name']}")
+                self.refresh_current()
+                self.load_history()
+            except Exception as e:
+                messagebox.showerror("错误", f"恢复失败: {e}")
+        
+        ttk.Button(dialog, text="恢复", command=restore).pack(pady=5)
+    
     def backup_file(self):
         """备份文件"""
         if not self.current_jsonl_path or not self.current_jsonl_path.exists():
             return
             
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
+            backup_name = self.backup_session("手动备份")
             
-            self.status_var.set(f"已备份: {backup_path.name}")
-            messagebox.showinfo("成功", f"文件已备份到 backups 目录:\n{backup_path.name}")
+            self.status_var.set(f"已备份: {backup_name}")
+            messagebox.showinfo("成功", f"文件已备份到 backups 目录:\n{backup_name}")
             
         except Exception as e:
             messagebox.showerror("错误", f"备份失败: {e}")
@@ -1968,8 +1936,8 @@ class TokenViewerApp:
             self.refresh_btn.config(text="自动刷新")
             self.status_var.set("自动刷新已开启，再次点击取消")
             self.long_press_progress['value'] = 0
-            # 启动自动刷新循环
-            self.auto_refresh_loop()
+            # 自动刷新由统一调度循环执行，这里立即刷新一次
+            self.schedule_refresh(sessions=True, session=True)
         else:
             # 继续步进（每50ms一次，总共1秒满）
             self.long_press_timer = self.root.after(50, self._long_press_step)
@@ -1984,19 +1952,7 @@ class TokenViewerApp:
             # 如果不是自动刷新模式，执行单次刷新
             self.long_press_progress['value'] = 0
             # 刷新会话列表（检测新开对话）和当前会话
-            self.load_sessions()
-            self.refresh_current()
-            self.load_history()
-    
-    def auto_refresh_loop(self):
-        """自动刷新循环"""
-        if self.is_auto_refresh:
-            # 刷新会话列表（检测新开对话）和当前会话
-            self.load_sessions()
-            self.refresh_current()
-            self.load_history()
-            # 自动刷新间隔1秒
-            self.root.after(1000, self.auto_refresh_loop)
+            self.schedule_refresh(sessions=True, session=True)
     
     def compress_sessions_json(self):
         """压缩 sessions.json，移除历史token统计，保留当前token数"""
@@ -2006,8 +1962,7 @@ class TokenViewerApp:
         
         try:
             # 读取原始文件
-            with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = self.sessions_registry.snapshot()
             
             # 备份原文件
             backup_path = SESSIONS_JSON.with_suffix('.json.backup')
@@ -2029,8 +1984,7 @@ class TokenViewerApp:
                             compressed_count += 1
             
             # 保存压缩后的文件
-            with open(SESSIONS_JSON, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.sessions_registry.save(data)
             
             # 计算压缩效果
             original_size = os.path.getsize(backup_path)
@@ -2095,74 +2049,51 @@ class TokenViewerApp:
             # 启动自动压缩循环
             self.auto_compress_loop()
         else:
+            self.cancel_compression_jobs()
             self.status_var.set("自动压缩已禁用")
     
     def auto_compress_loop(self):
-        """自动压缩循环"""
+        """自动压缩循环（重复启动时只保留一个定时器）"""
+        if self.auto_compress_timer:
+            self.root.after_cancel(self.auto_compress_timer)
+            self.auto_compress_timer = None
         if self.compression_config.auto_compress_enabled and self.current_jsonl_path:
             # 执行压缩并应用
             self.manual_compress_and_apply()
             # 设置下次执行
             interval_ms = self.compression_config.auto_compress_interval * 1000
-            self.root.after(interval_ms, self.auto_compress_loop)
+            self.auto_compress_timer = self.root.after(interval_ms, self.auto_compress_loop)
     
     def check_compression_conditions(self):
         """检查是否满足自动压缩条件（与关系：同时满足才触发）
         返回: (是否满足, 原因)
         """
         try:
-            # 从配置获取阈值
-            min_tokens = self.compression_config.min_token_count
-            min_messages = self.compression_config.min_message_count
-            
-            # 从 sessions.json 获取 token 信息
-            total_tokens = 0
-            if SESSIONS_JSON.exists():
-                with open(SESSIONS_JSON, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key, value in data.items():
-                        if key.startswith("agent:") and value.get('sessionId') == self.current_session_id:
-                            total_tokens = value.get('totalTokens', 0)
-                            break
+            # 同步会话文件，获取有效Token（分词计数或已更新的官方数据）
+            if self.current_jsonl_path and self.current_jsonl_path.exists():
+                self.sync_session_lines()
+            total_tokens = self.get_effective_tokens()
             
             # 统计对话条数（message 类型且 role 为 user 或 assistant）
-            message_count = 0
-            if self.current_jsonl_path and self.current_jsonl_path.exists():
-                with open(self.current_jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    for line in f:
-                        try:
-                            data = json.loads(line.strip())
-                            if data.get('type') == 'message':
-                                msg = data.get('message', {})
-                                role = msg.get('role', '')
-                                if role in ['user', 'assistant']:
-                                    message_count += 1
-                        except:
-                            pass
-            
-            # 检查条件（与关系：同时满足）
-            token_ok = total_tokens >= min_tokens
-            msg_ok = message_count >= min_messages
-            
-            if not token_ok and not msg_ok:
-                return False, f"Token {total_tokens}/{min_tokens}，对话 {message_count}/{min_messages}，均未满足"
-            elif not token_ok:
-                return False, f"Token {total_tokens} < {min_tokens}，对话 {message_count} 已满足"
-            elif not msg_ok:
-                return False, f"Token {total_tokens} 已满足，对话 {message_count} < {min_messages}"
-            
-            return True, f"条件满足：Token {total_tokens}/{min_tokens}，对话 {message_count}/{min_messages}"
+            message_count = self.session.dialog_message_count()
+            
+            return evaluate_compression_conditions(total_tokens, message_count, self.compression_config)
             
         except Exception as e:
             return False, f"检查条件失败: {e}"
     
+
     def manual_compress_and_apply(self):
         """自动执行压缩并应用（静默模式）"""
         if not self.current_jsonl_path:
             return
         
-        api_key = self.api_key_entry.get()
-        if not api_key:
+        if not self.has_api_key():
+            return
+        
+        # 后台服务（daemon）正在自动压缩该会话时不再重复压缩（避免两个进程同时改写）
+        if daemon_compresses(self.current_session_id):
+            self.auto_compress_status = f"自动压缩跳过: 后台服务正在管理该会话 [{datetime.now().strftime('%H:%M:%S')}]"
             return
         
         # 检查AI是否正在输出（避免在AI输出期间压缩）
@@ -2177,197 +2108,90 @@ class TokenViewerApp:
             self.auto_compress_status = f"自动压缩跳过: {reason} [{time_str}]"
             return
         
+        # 同一会话已有压缩任务时直接合并，不再叠加
+        job = self.compression_jobs.get(self.current_session_id)
+        if job is not None and job.active:
+            self.auto_compress_status = f"自动压缩跳过: {job.describe()} [{time_str}]"
+            return
+        
         self.auto_compress_status = f"自动压缩开始: {reason} [{time_str}]"
         
-        # 临时设置静默模式
-        original_silent = self.compression_config.silent_mode
-        self.compression_config.silent_mode = True
+        # 在主线程取记忆结构快照和当前模式（后台任务不再读取会被刷新修改的数据）
+        memory = self.snapshot_memory_structure()
+        mode = self.compress_mode_var.get()
         
-        def compress_worker():
-            try:
-                # 解析当前记忆结构
-                memory = self.parse_memory_structure()
-                
-                # 提取长期和中期记忆内容
-                long_content = ""
-                if memory['long_term']:
-                    long_content = self.extract_message_text(memory['long_term']['data'])
-                
-                mid_content = ""
-                if memory['mid_term']:
-                    mid_content = self.extract_message_text(memory['mid_term']['data'])
-                
-                # 收集短期记忆内容
-                short_contents = []
-                for short in memory['short_terms']:
-                    text = self.extract_message_text(short['data'])
-                    if text and len(text) > 10:
-                        short_contents.append(text[:1000])
-                
-                if not short_contents:
-                    return
-                
-                # 根据模式执行压缩
-                mode = self.compress_mode_var.get()
-                
-                if mode == '长期模式':
-                    # 长期模式：只压缩最近20条短期记忆作为新的长期记忆
-                    # 不传入旧的长期记忆内容，避免累积
-                    all_history = ["【最近对话历史】"]
-                    all_history.extend(short_contents[-20:])
-                    
-                    history_text = "\n\n".join(all_history)
-                    combined_prompt = f"{self.compression_config.compression_prompt}\n\n{history_text}"
-                    new_long_text = self.call_ai_compression(combined_prompt)
-                    
-                    # 中期记忆使用最近10条单独压缩
-                    recent_history = "\n\n".join(short_contents[-10:])
-                    mid_prompt = f"{self.compression_config.compression_prompt}\n\n【最近对话历史】\n\n{recent_history}"
-                    new_mid_text = self.call_ai_compression(mid_prompt)
-                    
-                elif mode == '中期模式':
-                    new_long_text = long_content if long_content else "（无长期记忆）"
-                    
-                    recent_history = "\n\n".join(short_contents[-10:])
-                    mid_prompt = f"{self.compression_config.compression_prompt}\n\n【最近对话历史】\n\n{recent_history}"
-                    new_mid_text = self.call_ai_compression(mid_prompt)
-                    
-                elif mode == '短期模式':
-                    # 短期模式不执行压缩
-                    self.compression_config.silent_mode = original_silent
+        def compress_worker(job):
+            # 按模式请求 AI 生成新的长期/中期记忆（与后台服务共用 compress_memory）
+            result = compress_memory(memory, mode, self.compression_config,
+                                     self.call_ai_compression_many, self.condense_history)
+            if result is None:
+                self.auto_compress_status = f"自动压缩跳过: 没有新增对话 [{datetime.now().strftime('%H:%M:%S')}]"
+                return
+            new_long_text, new_mid_text, folded_until = result
+            
+            # 已取消或超时则丢弃结果
+            job.check()
+            
+            # 在主线程应用压缩
+            def apply_in_main():
+                # 任务结束后会话已切换或任务被取消，不能写入
+                if job.cancelled or job.key != self.current_session_id:
+                    print(f"[压缩任务] 会话已切换或任务已取消，丢弃压缩结果: {job.key}")
                     return
-                    
-                elif mode == '吐槽模式':
-                    new_long_text = long_content if long_content else "（无长期记忆）"
-                    new_mid_text = mid_content if mid_content else "（无中期记忆）"
-                
-                # 在主线程应用压缩
-                def apply_in_main():
-                    try:
-                        self.apply_compression_silent(new_long_text, new_mid_text)
-                    except:
-                        pass
-                    finally:
-                        self.compression_config.silent_mode = original_silent
-                
-                self.root.after(0, apply_in_main)
-                
-            except Exception as e:
-                self.compression_config.silent_mode = original_silent
+                try:
+                    self.apply_compression_silent(new_long_text, new_mid_text, folded_until)
+                except:
+                    pass
+            
+            self.root.after(0, apply_in_main)
         
-        thread = threading.Thread(target=compress_worker, daemon=True)
-        thread.start()
+        # 提交任务（同一会话同时只有一个压缩任务）
+        self.compression_jobs.submit(
+            self.current_session_id, compress_worker,
+            timeout=self.compression_config.compress_job_timeout,
+            on_done=self.on_compression_job_done, name="自动压缩")
     
-    def apply_compression_silent(self, new_long_text, new_mid_text):
-        """静默应用压缩（无弹窗）"""
+    def apply_compression_silent(self, new_long_text, new_mid_text, folded_until=None):
+        """静默应用压缩（无弹窗）
+        
+        folded_until: 已合并进记忆的最后一条消息 id（增量模式的高水位标记），
+                      记录在长期记忆消息的 foldedUntil 字段中
+        """
         try:
             # 备份
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = BACKUP_DIR / f"{self.current_session_id}_{timestamp}.jsonl"
-            import shutil
-            shutil.copy2(self.current_jsonl_path, backup_path)
-            
-            # 查找 compact 标记
-            compact_index = self.find_compact_marker_index()
-            
-            # 构建新的文件内容
-            new_lines = []
-            last_retained_msg_id = None
-            
-            if compact_index == -1:
-                # 首次压缩
-                first_user_index = -1
-                for i, line in enumerate(self.all_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            msg = data.get('message', {})
-                            if msg.get('role', '') == 'user':
-                                first_user_index = i
-                                break
-                    except:
-                        pass
-                
-                if first_user_index == -1:
-                    return
-                
-                new_lines.extend(self.all_lines[:first_user_index])
-                
-                for line in reversed(new_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            last_retained_msg_id = data.get('id')
-                            break
-                    except:
-                        pass
-            else:
-                new_lines.extend(self.all_lines[:compact_index])
-                
-                for line in reversed(new_lines):
-                    try:
-                        data = json.loads(line.strip())
-                        if data.get('type') == 'message':
-                            last_retained_msg_id = data.get('id')
-                            break
-                    except:
-                        pass
-            
-            # 添加 compact 标记
-            compact_msg = self.create_memory_message(CHARACTER_ID, "===COMPACT===\nsummary: AI总结占位")
-            compact_msg['summary'] = "AI总结占位"
-            compact_msg['parentId'] = last_retained_msg_id
-            new_lines.append(json.dumps(compact_msg, ensure_ascii=False) + "\n")
-            
-            # 添加长期和中期记忆
-            long_msg = self.create_memory_message(LONG_TERM_ID, new_long_text)
-            long_msg['parentId'] = CHARACTER_ID
-            new_lines.append(json.dumps(long_msg, ensure_ascii=False) + "\n")
-            
-            mid_msg = self.create_memory_message(MID_TERM_ID, new_mid_text)
-            mid_msg['parentId'] = LONG_TERM_ID
-            new_lines.append(json.dumps(mid_msg, ensure_ascii=False) + "\n")
+            backup_name = self.backup_session("自动压缩")
             
             # 解析当前记忆结构获取短期记忆
             memory = self.parse_memory_structure()
-            recent_shorts = memory['short_terms'][-5:]
-            last_short_id = None
-            
-            for i, short in enumerate(recent_shorts):
-                short_data = short['data'].copy()
-                if i == 0:
-                    short_data['parentId'] = MID_TERM_ID
-                new_lines.append(json.dumps(short_data, ensure_ascii=False) + "\n")
-                last_short_id = short_data.get('id')
-            
-            # 只有吐槽模式才添加 baizhi21
-            mode = self.compress_mode_var.get()
-            if mode == '吐槽模式':
-                mode_content = new_long_text  # 吐槽内容
-                if mode_content:
-                    mode_msg = self.create_memory_message(MODE_MESSAGE_ID, mode_content)
-                    if last_short_id:
-                        mode_msg['parentId'] = last_short_id
-                    else:
-                        mode_msg['parentId'] = MID_TERM_ID
-                    new_lines.append(json.dumps(mode_msg, ensure_ascii=False) + "\n")
-            
-            # 保存
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-            
-            self.all_lines = new_lines
+            
+            # 只有吐槽模式才添加 baizhi21（吐槽内容）
+            mode_content = new_long_text if self.compress_mode_var.get() == '吐槽模式' else None
+            
+            new_lines = build_compressed_lines(self.session, self.all_lines, new_long_text, new_mid_text,
+                                               memory['short_terms'][-5:], mode_content, folded_until)
+            if new_lines is None:
+                return
+            
+            # 保存（原子改写）
+            self.rewrite_session_file(new_lines)
             
             # 记录压缩时间
             self.last_compression_time = time.time()
             self.use_official_tokens = False
             
-            self.status_var.set(f"自动压缩已应用，备份: {backup_path.name}")
+            self.status_var.set(f"自动压缩已应用，备份: {backup_name}")
             self.refresh_current()
             
         except Exception as e:
             self.status_var.set(f"自动压缩失败: {e}")
     
+    def toggle_stream_output(self):
+        """切换流式输出"""
+        self.compression_config.stream_output = self.stream_output_var.get()
+        self.save_compression_config()
+        status = "开启" if self.compression_config.stream_output else "关闭"
+        self.status_var.set(f"流式输出已{status}")
+    
     def toggle_silent_mode(self):
         """切换静默模式"""
         self.compression_config.silent_mode = self.silent_mode_var.get()
@@ -2483,23 +2307,20 @@ class TokenViewerApp:
         
         # 手动读取时清空缓存，重新加载
         print("[文件监控] 手动读取：清空缓存，重新加载")
-        self.file_monitor_last_lines = []
+        self.reset_file_monitor_reader()
         
         # 执行一次读取
         self.check_and_import_file()
     
     def _init_file_monitor(self):
         """初始化文件监控状态"""
-        self.file_monitor_last_content = ""
-        self.file_monitor_last_lines = []
+        self.reset_file_monitor_reader()
         
-        # 预读取现有内容作为基准（不导入）
+        # 预读取现有内容作为基准（不导入，只移动读取偏移）
         if os.path.exists(self.compression_config.file_monitor_path):
             try:
-                with open(self.compression_config.file_monitor_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    lines = f.readlines()
-                self.file_monitor_last_lines = [line.strip() for line in lines if line.strip()]
-                print(f"[文件监控] 预读取 {len(self.file_monitor_last_lines)} 行作为基准")
+                self.read_file_monitor_lines()
+                print(f"[文件监控] 预读取 {self.file_monitor_reader.line_count} 行作为基准")
             except Exception as e:
                 print(f"[文件监控] 预读取失败: {e}")
         
@@ -2526,49 +2347,48 @@ class TokenViewerApp:
         interval_ms = int(1000 / self.compression_config.file_monitor_interval)
         self.file_monitor_timer = self.root.after(interval_ms, self.file_monitor_loop)
     
+    def reset_file_monitor_reader(self):
+        """清空监控文件的读取状态（下次读取时从头导入）"""
+        self.file_monitor_reader.reset(self.compression_config.file_monitor_path or None)
+    
+
+    def read_file_monitor_lines(self):
+        """读取监控文件新增的非空行
+        
+        按字节偏移只读取新写入的内容；文件被轮转（替换）或截断时从头读取新文件。
+        返回: (new_lines, start_index)
+        """
+        return self.file_monitor_reader.read_lines(self.compression_config.file_monitor_path)
+    
+
     def check_and_import_file(self):
-        """检查文件并导入新增内容（基于内容哈希检测新行）"""
+        """检查文件并导入新增内容（按字节偏移只读取新写入的行）"""
         file_path = self.compression_config.file_monitor_path
         if not file_path or not os.path.exists(file_path):
             print(f"[文件监控] 文件不存在: {file_path}")
             return
         
+        # 后台服务正在向该会话导入时不再重复导入
+        if daemon_imports(self.current_session_id):
+            self.status_var.set("文件监控跳过: 后台服务正在导入该会话")
+            return
+        
         try:
-            # 读取文件内容
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                lines = f.readlines()
-            
-            # 过滤空行
-            current_lines = [line.strip() for line in lines if line.strip()]
-            
-            # 将已导入的行转为集合用于快速查找
-            imported_set = set(self.file_monitor_last_lines)
-            
-            # 找出真正的新行（不在已导入集合中的）
-            new_lines = []
-            for line in current_lines:
-                if line not in imported_set:
-                    new_lines.append(line)
-            
-            print(f"[文件监控] 当前文件行数: {len(current_lines)}, 已导入: {len(imported_set)}, 新行: {len(new_lines)}")
+            new_lines, start_index = self.read_file_monitor_lines()
             
             if not new_lines:
-                print(f"[文件监控] 无新增内容")
                 return
             
-            print(f"[文件监控] 新增 {len(new_lines)} 行")
+            print(f"[文件监控] 新增 {len(new_lines)} 行，已读取: {self.file_monitor_reader.line_count}")
             
             # 按5秒时间窗口合并消息
-            merged_messages = self.merge_messages_by_time_window(new_lines, len(imported_set))
+            merged_messages = self.merge_messages_by_time_window(new_lines, start_index)
             print(f"[文件监控] 合并为 {len(merged_messages)} 条消息")
             
-            # 更新已导入的行记录（添加所有当前行，包括可能的手动修改）
-            self.file_monitor_last_lines = current_lines.copy()
-            
             if merged_messages:
                 # 将新消息追加到当前会话
                 self.append_external_messages(merged_messages)
-                self.status_var.set(f"从外部文件导入 {len(merged_messages)} 条消息 (原始{len(new_lines)}行，共{len(current_lines)}行)")
+                self.status_var.set(f"从外部文件导入 {len(merged_messages)} 条消息 (原始{len(new_lines)}行，共{self.file_monitor_reader.line_count}行)")
                 print(f"[文件监控] 导入完成")
             
         except Exception as e:
@@ -2577,150 +2397,20 @@ class TokenViewerApp:
             traceback.print_exc()
     
     def merge_messages_by_time_window(self, lines, start_index=0, window_seconds=5):
-        """双5秒合并策略：本地5秒+时间戳5秒，去除重复内容
-        
-        合并规则：
-        1. 去重：基于内容（去掉时间戳后）去重
-        2. 双5秒：满足任一条件即合并
-           - 本地5秒：相邻行索引差 <= 10（假设每秒2条）
-           - 时间戳5秒：时间戳差值 <= 5秒
-        3. 上限：每批最多10条
-        
-        Args:
-            lines: 消息行列表
-            start_index: 起始行号（用于生成ID）
-            window_seconds: 时间窗口大小（秒），默认5
-        
-        Returns:
-            合并后的消息列表
-        """
-        from datetime import datetime
-        import re
-        
-        if not lines:
-            return []
-        
-        # 解析每行的时间戳和内容
-        parsed_lines = []
-        for i, line in enumerate(lines):
-            timestamp = self._extract_timestamp(line)
-            content = self.remove_timestamp(line)
-            parsed_lines.append({
-                'original': line,
-                'timestamp': timestamp,
-                'content': content,
-                'index': i
-            })
-        
-        # 去重：基于内容（去掉时间戳后）
-        seen_contents = set()
-        unique_lines = []
-        for pl in parsed_lines:
-            content_key = pl['content'].strip()
-            if content_key and content_key not in seen_contents:
-                seen_contents.add(content_key)
-                unique_lines.append(pl)
-        
-        if not unique_lines:
-            return []
-        
-        # 如果只有一行，直接返回
-        if len(unique_lines) == 1:
-            return [self.wrap_external_message(unique_lines[0]['original'], start_index)]
-        
-        # 双5秒合并策略
-        merged = []
-        current_batch = [unique_lines[0]]
-        current_start_idx = start_index
-        
-        for i in range(1, len(unique_lines)):
-            current_line = unique_lines[i]
-            first_line = current_batch[0]
-            
-            # 双5秒判断
-            local_window_ok = False  # 本地5秒（基于索引）
-            timestamp_window_ok = False  # 时间戳5秒
-            
-            # 本地5秒：索引差 <= 10（假设每秒2条，5秒=10条）
-            index_diff = current_line['index'] - first_line['index']
-            local_window_ok = (index_diff <= 10)
-            
-            # 时间戳5秒
-            if first_line['timestamp'] and current_line['timestamp']:
-                time_diff = (current_line['timestamp'] - first_line['timestamp']).total_seconds()
-                timestamp_window_ok = (time_diff <= window_seconds)
-            
-            # 双5秒：满足任一条件即可合并
-            should_merge = local_window_ok or timestamp_window_ok
-            
-            # 如果在任一窗口内且批次未满10条，加入当前批次
-            if should_merge and len(current_batch) < 10:
-                current_batch.append(current_line)
-            else:
-                # 合并当前批次
-                merged_content = "\n".join([cl['original'] for cl in current_batch])
-                merged_msg = self.wrap_external_message(merged_content, current_start_idx)
-                merged.append(merged_msg)
-                
-                # 开始新批次
-                current_batch = [current_line]
-                current_start_idx = start_index + current_line['index']
-        
-        # 处理最后一批
-        if current_batch:
-            merged_content = "\n".join([cl['original'] for cl in current_batch])
-            merged_msg = self.wrap_external_message(merged_content, current_start_idx)
-            merged.append(merged_msg)
-        
-        return merged
+        """双5秒合并策略：本地5秒+时间戳5秒，去除重复内容（规则见引擎模块）"""
+        return merge_messages_by_time_window(lines, start_index, window_seconds)
     
+
     def _extract_timestamp(self, line):
         """从行中提取时间戳"""
-        from datetime import datetime
-        import re
-        
-        patterns = [
-            r'(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)',
-            r'\[(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)[^\]]*\]',
-            r'm:\[(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)[^\]]*\]',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, line)
-            if match:
-                ts_str = match.group(1)
-                try:
-                    return datetime.fromisoformat(ts_str.replace('Z', '+00:00').replace(' ', 'T'))
-                except:
-                    try:
-                        return datetime.strptime(ts_str, '%Y-%m-%d %H:%M:%S')
-                    except:
-                        pass
-        return None
+        return extract_timestamp(line)
     
+
     def remove_timestamp(self, line):
-        """移除行中的时间戳，只保留内容
-        
-        支持的时间戳格式：
-        - 2024-01-01 12:00:00.123
-        - 2024-01-01T12:00:00.123
-        - [2024-01-01 12:00:00]
-        - m:[2024-01-01 12:00:00]
-        """
-        import re
-        
-        # 匹配常见时间戳格式
-        patterns = [
-            r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?\s*',  # 2024-01-01 12:00:00.123
-            r'^\[\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?\]\s*',  # [2024-01-01 12:00:00]
-            r'^m:\[\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?[^\]]*\]\s*',  # m:[2024-01-01 12:00:00 GMT+8]
-        ]
-        
-        for pattern in patterns:
-            line = re.sub(pattern, '', line)
-        
-        return line.strip()
+        """移除行中的时间戳，只保留内容"""
+        return remove_timestamp(line)
     
+
     def parse_external_file(self, content):
         """解析外部文件内容，返回消息列表
         
@@ -2750,34 +2440,10 @@ class TokenViewerApp:
         return messages
     
     def wrap_external_message(self, data, line_index=0):
-        """将外部数据包装成标准message格式（外部文件保持toolResult）
-        
-        Args:
-            data: 可以是字符串或字典
-            line_index: 行号，用于生成唯一ID
-        """
-        from datetime import datetime
-        
-        if isinstance(data, dict):
-            content = data.get('content', data.get('text', str(data)))
-            role = data.get('role', 'toolResult')  # 外部文件保持toolResult
-        else:
-            content = str(data)
-            role = 'toolResult'  # 外部文件保持toolResult
-        
-        # 使用简洁的ID格式：extern + 序号
-        msg_id = f"extern{line_index:04d}"
-        
-        return {
-            "type": "message",
-            "id": msg_id,
-            "timestamp": datetime.now().isoformat() + "Z",
-            "message": {
-                "role": role,
-                "content": [{"type": "text", "text": content}]
-            }
-        }
+        """将外部数据包装成标准message格式（外部文件保持toolResult）"""
+        return wrap_external_message(data, line_index)
     
+
     def get_message_hash(self, msg):
         """获取消息的内容哈希（用于去重）"""
         try:
@@ -2806,45 +2472,28 @@ class TokenViewerApp:
         print(f"[文件监控] 目标文件: {self.current_jsonl_path}")
         
         try:
-            # 读取现有内容
-            existing_lines = []
+            # 先同步会话模型（只读取新增字节），拿到最后一条消息的ID
             if self.current_jsonl_path.exists():
-                with open(self.current_jsonl_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    existing_lines = f.readlines()
-                print(f"[文件监控] 现有文件行数: {len(existing_lines)}")
+                self.sync_session_lines()
+                print(f"[文件监控] 现有文件行数: {len(self.all_lines)}")
             else:
                 print(f"[文件监控] 目标文件不存在，将创建新文件")
             
-            # 找到最后一条消息的parentId
-            last_parent_id = None
-            for line in reversed(existing_lines):
-                try:
-                    data = json.loads(line.strip())
-                    if data.get('type') == 'message':
-                        last_parent_id = data.get('id')
-                        break
-                except:
-                    pass
-            
+            last_parent_id = self.session.last_message_id
             print(f"[文件监控] 最后一条消息ID: {last_parent_id}")
             
-            # 追加新消息
-            new_lines = existing_lines.copy()
+            # 只生成新增的行
+            new_lines = external_message_lines(messages, last_parent_id)
             for i, msg in enumerate(messages):
-                if i == 0 and last_parent_id:
-                    msg['parentId'] = last_parent_id
-                msg_line = json.dumps(msg, ensure_ascii=False) + "\n"
-                new_lines.append(msg_line)
                 print(f"[文件监控] 追加消息 {i+1}: id={msg.get('id')}, parentId={msg.get('parentId')}")
             
-            # 保存
-            print(f"[文件监控] 写入文件，总行数: {len(new_lines)}")
-            with open(self.current_jsonl_path, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-            print("[文件监控] 文件写入完成")
+            # 追加写入（O_APPEND，不改写已有内容）
+            written = append_lines(self.current_jsonl_path, new_lines,
+                                   fsync=self.compression_config.file_monitor_fsync)
+            print(f"[文件监控] 追加写入完成: {len(new_lines)} 行, {written} 字节")
             
-            # 更新内存中的数据
-            self.all_lines = new_lines
+            # 增量更新内存中的数据（只解析刚追加的行）
+            self.sync_session_lines()
             
             # 刷新显示
             print("[文件监控] 刷新UI显示")